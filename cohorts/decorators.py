@@ -52,9 +52,9 @@ def api_auth(function):
                     auth_header[0].lower(), settings.API_AUTH_KEY.lower()))
                 return JsonResponse({'message': 'API Auth token key not recognized.'}, status=403)
 
-            # Now actually validate with the token
+            # Now actually validate with the token; its owner is who the call's queries are charged to
             token = auth_header[1]
-            Token.objects.select_related('user').get(key=token)
+            request.api_user = Token.objects.select_related('user').get(key=token).user
 
             # If a user was found, we've received a valid API call, and can proceed.
             return function(request, *args, **kwargs)
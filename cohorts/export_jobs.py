@@ -0,0 +1,183 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import time
+import logging
+import datetime
+import pytz
+from django.conf import settings
+from django.db import transaction
+from cohorts.models import Export_Job
+from google_helpers.bigquery.bq_support import BigQuerySupport
+from google_helpers.bigquery.export_support import BigQueryExport, BQ_EXTRACT_SHARDED
+
+logger = logging.getLogger('main_logger')
+
+# How often the poller advances outstanding export jobs
+EXPORT_JOB_POLL_SECS = getattr(settings, 'EXPORT_JOB_POLL_SECS', 10)
+# Jobs which BigQuery can't find after this long are given up on
+EXPORT_JOB_MAX_AGE = getattr(settings, 'EXPORT_JOB_MAX_AGE', 6 * 3600)
+
+
+def _now():
+    return datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+
+
+# Record a submitted export, to be advanced by advance_export_jobs. extract takes the file_format, compression,
+# sharded and compose settings of a GCS export.
+def register_export_job(job_id, user, destination, cohort=None, export_type=Export_Job.BQ_TABLE, **extract):
+    return Export_Job.objects.create(
+        job_id=job_id, user=user, cohort=cohort, export_type=export_type, destination=destination, **extract
+    )
+
+
+# Submit the query for a cohort file manifest export to GCS through a BigQueryExportFileList (whose bucket_path and
+# file_name give the destination), and register the job; its extract is started by the poller once the query is done
+def submit_gcs_export(exporter, query, parameters, file_format, user, cohort=None, compression=None, sharded=None,
+                      compose=False):
+    sharded = BQ_EXTRACT_SHARDED if sharded is None else sharded
+    compression = exporter._extract_compression(file_format, compression)
+    job_id = exporter.submit_file_list_to_gcs(query, parameters)
+    return register_export_job(
+        job_id, user, 'gs://{}/{}'.format(exporter.bucket_path, exporter.file_name), cohort=cohort,
+        export_type=Export_Job.GCS, file_format=file_format, compression=compression, sharded=sharded, compose=compose
+    )
+
+
+def _split_gcs_uri(uri):
+    bucket, _, name = uri[len('gs://'):].partition('/')
+    return bucket, name
+
+
+def _table_ref(table):
+    return {'dataset_id': table['datasetId'], 'table_id': table['tableId']}
+
+
+def _fail(export_job, message):
+    export_job.state = Export_Job.ERROR
+    export_job.message = message
+    export_job.date_completed = _now()
+
+
+# Move one job on from its BigQuery status
+def _advance(export_job, job):
+    if job['status']['state'] != 'DONE':
+        export_job.state = Export_Job.RUNNING
+        return
+
+    if 'errorResult' in job['status']:
+        logger.error("[ERROR] Export job {} ({}) failed: {}".format(
+            export_job.id, export_job.job_id, job['status']['errorResult'].get('message', None)))
+        _fail(export_job, "Unable to export cohort file manifest to {}--please contact the administrator.".format(
+            export_job.destination))
+        return
+
+    if export_job.stage == Export_Job.QUERY:
+        export_job.bytes_processed = int(job.get('statistics', {}).get('query', {}).get('totalBytesProcessed', 0))
+        destination = job['configuration']['query']['destinationTable']
+        if export_job.export_type == Export_Job.GCS:
+            # The query has written its (temporary) table; extract it to the bucket
+            bucket, file_name = _split_gcs_uri(export_job.destination)
+            exporter = BigQueryExport(destination['projectId'], destination['datasetId'], destination['tableId'],
+                                      bucket, file_name, None)
+            export_job.job_id = exporter.start_extract(
+                export_job.file_format, _table_ref(destination), export_job.compression, export_job.sharded,
+                export_job.compose
+            )
+            export_job.stage = Export_Job.EXTRACT
+            export_job.state = Export_Job.RUNNING
+            return
+        table = BigQuerySupport(None, None, None).bq_service.tables().get(
+            projectId=destination['projectId'], datasetId=destination['datasetId'], tableId=destination['tableId']
+        ).execute(num_retries=5)
+        if not table or int(table.get('numRows', 0)) <= 0:
+            logger.warning("[WARNING] Export job {} created table {}, but no rows were found.".format(
+                export_job.id, export_job.destination))
+            _fail(export_job, "Table {} created, but no rows found. Export of cohort file manifest may not have "
+                              "succeeded--please contact the administrator.".format(export_job.destination))
+            return
+        export_job.bytes_exported = int(table.get('numBytes', 0))
+        if export_job.cohort:
+            # The cohort's last export is only recorded once its table is known to be complete
+            export_job.cohort.last_exported_date = _now()
+            export_job.cohort.last_exported_table = export_job.destination
+            export_job.cohort.save()
+    else:
+        source = job['configuration']['extract']['sourceTable']
+        bucket, file_name = _split_gcs_uri(export_job.destination)
+        exporter = BigQueryExport(source['projectId'], source['datasetId'], source['tableId'], bucket, file_name, None)
+        result = exporter.extract_result(
+            job, export_job.file_format, _table_ref(source), "cohort file manifest", export_job.compression,
+            export_job.sharded, export_job.compose
+        )
+        if result['status'] != 'success':
+            _fail(export_job, result['message'])
+            return
+        export_job.bytes_exported = result['manifest']['total_size']
+        export_job.manifest = json.dumps(result['manifest'])
+
+    export_job.state = Export_Job.DONE
+    export_job.date_completed = _now()
+    logger.info("[STATUS] Export job {} to {} is done.".format(export_job.id, export_job.destination))
+
+
+# Advance the given outstanding export jobs (or all of them) in one pass: the BigQuery status of every job is fetched
+# in batched requests, and each job's state is updated from it--starting the extract of a GCS export whose query is
+# done, and checking the table or objects written by those which are finished. Each job is claimed with a row lock
+# first, so concurrent passes (eg. two pollers) never advance the same job, or start its extract, twice.
+# returns: the number of jobs checked
+def advance_export_jobs(export_jobs=None):
+    if export_jobs is None:
+        export_jobs = Export_Job.objects.filter(state__in=Export_Job.OUTSTANDING)
+    export_jobs = {x.id: x for x in export_jobs if x.is_outstanding()}
+    if not len(export_jobs):
+        return 0
+
+    start = time.time()
+    statuses = BigQuerySupport(None, None, None).get_job_set_status({
+        x: {'jobReference': {'jobId': export_jobs[x].job_id}} for x in export_jobs
+    })
+    now = _now()
+    checked = 0
+    for key, export_job in export_jobs.items():
+        with transaction.atomic():
+            # Skip jobs another pass holds, and those which have moved on to a new BigQuery job (or finished) since
+            # their status was fetched
+            claimed = Export_Job.objects.select_for_update(skip_locked=True).filter(
+                id=export_job.id, job_id=export_job.job_id, state__in=Export_Job.OUTSTANDING
+            ).first()
+            if claimed is None:
+                continue
+            try:
+                job = statuses.get(key, None)
+                if job is None:
+                    if (now - claimed.date_created).total_seconds() > EXPORT_JOB_MAX_AGE:
+                        _fail(claimed, "Export of cohort file manifest to {} could not be found--please contact the "
+                                       "administrator.".format(claimed.destination))
+                else:
+                    _advance(claimed, job)
+            except Exception as e:
+                logger.error("[ERROR] While advancing export job {}:".format(claimed.id))
+                logger.exception(e)
+                _fail(claimed, "Unable to export cohort file manifest to {}--please contact the administrator.".format(
+                    claimed.destination))
+            claimed.date_checked = now
+            claimed.save()
+            checked += 1
+
+    logger.info("[BENCHMARKING] Advanced {} export jobs in {}s".format(checked, str(round(time.time() - start, 3))))
+    return checked
@@ -0,0 +1,52 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import time
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cohorts.export_jobs import advance_export_jobs, EXPORT_JOB_POLL_SECS
+
+logger = logging.getLogger('main_logger')
+
+
+# Advances every outstanding export job, checking all of their BigQuery jobs in one batched pass per interval. Run
+# it alongside the web workers, so export requests can return as soon as their jobs are submitted.
+class Command(BaseCommand):
+    help = "Poll BigQuery for the status of outstanding cohort export jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=EXPORT_JOB_POLL_SECS,
+                            help="Seconds between passes (default {})".format(EXPORT_JOB_POLL_SECS))
+        parser.add_argument('--once', action='store_true', help="Make a single pass and exit")
+
+    def handle(self, *args, **options):
+        if options['interval'] < 1:
+            raise CommandError("--interval must be at least 1.")
+
+        while True:
+            start = time.time()
+            try:
+                checked = advance_export_jobs()
+                if checked:
+                    self.stdout.write("[STATUS] Checked {} outstanding export jobs.".format(checked))
+            except Exception as e:
+                logger.error("[ERROR] While polling export jobs:")
+                logger.exception(e)
+            if options['once']:
+                return
+            time.sleep(max(options['interval'] - (time.time() - start), 0))
@@ -0,0 +1,40 @@
+# Generated by Django 3.2.20 on 2024-06-03 15:02
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cohorts', '0009_alter_filter_operator'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Export_Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_id', models.CharField(max_length=128)),
+                ('export_type', models.CharField(choices=[('BQ', 'BigQuery Table'), ('GCS', 'Cloud Storage')], default='BQ', max_length=4)),
+                ('stage', models.CharField(choices=[('QUERY', 'Query'), ('EXTRACT', 'Extract')], default='QUERY', max_length=8)),
+                ('state', models.CharField(choices=[('PENDING', 'Pending'), ('RUNNING', 'Running'), ('DONE', 'Done'), ('ERROR', 'Error')], db_index=True, default='PENDING', max_length=8)),
+                ('destination', models.CharField(max_length=1024)),
+                ('file_format', models.CharField(blank=True, max_length=32, null=True)),
+                ('compression', models.CharField(blank=True, max_length=16, null=True)),
+                ('sharded', models.BooleanField(default=False)),
+                ('compose', models.BooleanField(default=False)),
+                ('bytes_processed', models.BigIntegerField(blank=True, null=True)),
+                ('bytes_exported', models.BigIntegerField(blank=True, null=True)),
+                ('message', models.CharField(blank=True, max_length=1024, null=True)),
+                ('manifest', models.TextField(blank=True, null=True)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_checked', models.DateTimeField(blank=True, null=True)),
+                ('date_completed', models.DateTimeField(blank=True, null=True)),
+                ('cohort', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='cohorts.cohort')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -495,3 +495,73 @@ class Cohort_Comments(models.Model):
     user = models.ForeignKey(User, null=False, blank=False, on_delete=models.CASCADE)
     date_created = models.DateTimeField(auto_now_add=True)
     content = models.CharField(max_length=1024, null=False)
+
+
+# A BigQuery export (of a cohort's file manifest to a BQ table, or to GCS) which has been submitted, and whose
+# progress is advanced by cohorts.export_jobs.advance_export_jobs rather than waited on in the request
+class Export_Job(models.Model):
+    BQ_TABLE = 'BQ'
+    GCS = 'GCS'
+    EXPORT_TYPES = (
+        (BQ_TABLE, 'BigQuery Table'),
+        (GCS, 'Cloud Storage')
+    )
+    QUERY = 'QUERY'
+    EXTRACT = 'EXTRACT'
+    STAGES = (
+        (QUERY, 'Query'),
+        (EXTRACT, 'Extract')
+    )
+    PENDING = 'PENDING'
+    RUNNING = 'RUNNING'
+    DONE = 'DONE'
+    ERROR = 'ERROR'
+    STATES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (ERROR, 'Error')
+    )
+    OUTSTANDING = [PENDING, RUNNING]
+
+    # The BigQuery job for the current stage
+    job_id = models.CharField(max_length=128, null=False, blank=False)
+    cohort = models.ForeignKey(Cohort, null=True, blank=True, on_delete=models.SET_NULL)
+    user = models.ForeignKey(User, null=False, blank=False, on_delete=models.CASCADE)
+    export_type = models.CharField(max_length=4, choices=EXPORT_TYPES, default=BQ_TABLE)
+    stage = models.CharField(max_length=8, choices=STAGES, default=QUERY)
+    state = models.CharField(max_length=8, choices=STATES, default=PENDING, db_index=True)
+    # Full table ID, or gs:// URI
+    destination = models.CharField(max_length=1024, null=False, blank=False)
+    # Extract settings, for GCS exports
+    file_format = models.CharField(max_length=32, null=True, blank=True)
+    compression = models.CharField(max_length=16, null=True, blank=True)
+    sharded = models.BooleanField(default=False)
+    compose = models.BooleanField(default=False)
+    bytes_processed = models.BigIntegerField(null=True, blank=True)
+    bytes_exported = models.BigIntegerField(null=True, blank=True)
+    message = models.CharField(max_length=1024, null=True, blank=True)
+    # JSON shard manifest of a finished GCS export
+    manifest = models.TextField(null=True, blank=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_checked = models.DateTimeField(null=True, blank=True)
+    date_completed = models.DateTimeField(null=True, blank=True)
+
+    def is_outstanding(self):
+        return self.state in self.OUTSTANDING
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'cohort_id': self.cohort_id,
+            'export_type': self.export_type,
+            'stage': self.stage,
+            'state': self.state,
+            'destination': self.destination,
+            'bytes_processed': self.bytes_processed,
+            'bytes_exported': self.bytes_exported,
+            'message': self.message,
+            'date_created': self.date_created.strftime("%Y-%m-%d %H:%M:%S") if self.date_created else None,
+            'date_checked': self.date_checked.strftime("%Y-%m-%d %H:%M:%S") if self.date_checked else None,
+            'date_completed': self.date_completed.strftime("%Y-%m-%d %H:%M:%S") if self.date_completed else None
+        }
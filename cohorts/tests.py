@@ -14,12 +14,19 @@
 # limitations under the License.
 #
 
-from django.test import TestCase
+import json
+from unittest.mock import patch
+from django.test import TestCase, RequestFactory
 from django.contrib.auth.models import AnonymousUser, User
 
-from cohorts.models import Cohort
+from cohorts.models import Cohort, Export_Job
+from cohorts.export_jobs import advance_export_jobs
+from cohorts.views.views import export_job_status
 from idc_collections.models import ImagingDataCommonsVersion, DataSetType,DataSource, DataVersion
 from cohorts.utils import _save_cohort, _delete_cohort, _get_cohort_stats
+from cohorts.utils_api_v1 import _admit_api_query
+from google_helpers.bigquery.bq_support import BigQuerySupport
+from google_helpers.bigquery.admission import QueryBudgetExceeded, request_budget_user
 
 class ModelTest(TestCase):
     fixtures = ["db.json"]
@@ -82,8 +89,135 @@ class ModelTest(TestCase):
         self.assertEqual(cohort.active, False)
 
 
+class APIQueryBudgetTest(TestCase):
+    results = {'sql_string': "SELECT 1", 'params': []}
 
+    @classmethod
+    def setUpTestData(cls):
+        cls.token_owner = User.objects.create_user(username='test_api_owner', email='test_api_owner@isb-cgc.org',
+                                                   password='Itsasecrettoeveryone!2')
 
+    def test_charged_to_authenticated_user(self):
+        # An email passed with the call is ignored; the token's owner is charged
+        request = RequestFactory().get("/cohorts/api/preview/manifest/", {'email': 'someone_else@isb-cgc.org'})
+        request.api_user = self.token_owner
+        with patch.object(BigQuerySupport, 'admit_query') as admit:
+            self.assertIsNone(_admit_api_query(request, self.results))
+        admit.assert_called_once_with("SELECT 1", [], self.token_owner.email)
+
+        request = RequestFactory().post("/cohorts/api/v2/preview/query/",
+                                        data=json.dumps({'email': 'someone_else@isb-cgc.org'}),
+                                        content_type="application/json", REMOTE_ADDR="10.0.0.7")
+        request.user = AnonymousUser()
+        self.assertEqual(request_budget_user(request), "ip:10.0.0.7")
+
+    def test_over_budget(self):
+        request = RequestFactory().get("/cohorts/api/preview/manifest/")
+        request.api_user = self.token_owner
+        with patch.object(BigQuerySupport, 'admit_query',
+                          side_effect=QueryBudgetExceeded("Over budget", 10, 5, retry_after=60)):
+            error = _admit_api_query(request, self.results)
+        self.assertEqual((error['code'], error['retry_after']), (429, 60))
+
+
+class ExportJobTest(TestCase):
+    destination = 'isb-cgc-idc-user-data.manifests.manifest_cohort_1'
+    query_done = {
+        'status': {'state': 'DONE'},
+        'statistics': {'query': {'totalBytesProcessed': '1024'}},
+        'configuration': {'query': {'destinationTable': {
+            'projectId': 'isb-cgc-idc-user-data', 'datasetId': 'manifests', 'tableId': 'manifest_cohort_1'
+        }}}
+    }
 
-
-
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='test_export_user', email='test_export_user@isb-cgc.org',
+                                            password='Itsasecrettoeveryone!2')
+        cls.cohort = Cohort.objects.create(name='export cohort')
+
+    def _table_export(self, user=None):
+        return Export_Job.objects.create(job_id='query-1', user=user or self.user, cohort=self.cohort,
+                                         destination=self.destination)
+
+    def test_export_job(self):
+        export_job = self._table_export()
+        self.assertTrue(export_job.is_outstanding())
+        self.assertEqual(export_job.to_dict()['state'], Export_Job.PENDING)
+        export_job.state = Export_Job.ERROR
+        self.assertFalse(export_job.is_outstanding())
+
+    @patch('cohorts.export_jobs.BigQuerySupport')
+    def test_advance_table_export(self, bqs):
+        export_job = self._table_export()
+        bqs.return_value.get_job_set_status.return_value = {export_job.id: {'status': {'state': 'RUNNING'}}}
+        self.assertEqual(advance_export_jobs(), 1)
+        export_job.refresh_from_db()
+        self.assertEqual(export_job.state, Export_Job.RUNNING)
+        # The cohort's last export isn't recorded until its table is complete
+        self.assertIsNone(Cohort.objects.get(id=self.cohort.id).last_exported_table)
+
+        bqs.return_value.get_job_set_status.return_value = {export_job.id: self.query_done}
+        bqs.return_value.bq_service.tables.return_value.get.return_value.execute.return_value = {
+            'numRows': '10', 'numBytes': '2048'
+        }
+        advance_export_jobs()
+        export_job.refresh_from_db()
+        self.assertEqual((export_job.state, export_job.bytes_processed, export_job.bytes_exported),
+                         (Export_Job.DONE, 1024, 2048))
+        self.assertEqual(Cohort.objects.get(id=self.cohort.id).last_exported_table, self.destination)
+        self.assertEqual(advance_export_jobs(), 0)
+
+    @patch('cohorts.export_jobs.BigQuerySupport')
+    def test_failed_export(self, bqs):
+        export_job = self._table_export()
+        bqs.return_value.get_job_set_status.return_value = {export_job.id: {
+            'status': {'state': 'DONE', 'errorResult': {'message': "Access Denied"}}
+        }}
+        advance_export_jobs()
+        export_job.refresh_from_db()
+        self.assertEqual(export_job.state, Export_Job.ERROR)
+        self.assertIsNotNone(export_job.date_completed)
+        self.assertIsNone(Cohort.objects.get(id=self.cohort.id).last_exported_table)
+
+    @patch('cohorts.export_jobs.BigQueryExport')
+    @patch('cohorts.export_jobs.BigQuerySupport')
+    def test_advance_gcs_export(self, bqs, exporter):
+        export_job = Export_Job.objects.create(
+            job_id='query-2', user=self.user, cohort=self.cohort, export_type=Export_Job.GCS,
+            destination='gs://idc-results/user-manifests/job/manifest_1.csv.gz', file_format='CSV',
+            compression='GZIP', compose=True
+        )
+        before_extract = Export_Job.objects.get(id=export_job.id)
+        bqs.return_value.get_job_set_status.return_value = {export_job.id: self.query_done}
+        exporter.return_value.start_extract.return_value = 'extract-2'
+        advance_export_jobs()
+        export_job.refresh_from_db()
+        self.assertEqual((export_job.stage, export_job.state, export_job.job_id),
+                         (Export_Job.EXTRACT, Export_Job.RUNNING, 'extract-2'))
+        exporter.assert_called_once_with('isb-cgc-idc-user-data', 'manifests', 'manifest_cohort_1', 'idc-results',
+                                         'user-manifests/job/manifest_1.csv.gz', None)
+
+        # A pass holding the job from before its extract started (eg. a second poller) leaves it be
+        self.assertEqual(advance_export_jobs([before_extract]), 0)
+        self.assertEqual(exporter.return_value.start_extract.call_count, 1)
+
+    @patch('cohorts.export_jobs.BigQuerySupport')
+    def test_export_job_status(self, bqs):
+        export_job = self._table_export()
+        other_user = User.objects.create_user(username='test_export_other', email='test_export_other@isb-cgc.org',
+                                              password='Itsasecrettoeveryone!2')
+        other_job = self._table_export(other_user)
+
+        request = RequestFactory().get("/cohorts/export_jobs/status/",
+                                       {'ids': "{},{}".format(export_job.id, other_job.id)})
+        request.user = self.user
+        response = json.loads(export_job_status(request).content)
+        self.assertEqual([x['id'] for x in response['jobs']], [export_job.id])
+        self.assertEqual(response['outstanding'], 1)
+        # Progress is read from the database; only the poller calls BigQuery
+        bqs.assert_not_called()
+
+        request = RequestFactory().get("/cohorts/export_jobs/status/", {'ids': "all"})
+        request.user = self.user
+        self.assertEqual(export_job_status(request).status_code, 400)
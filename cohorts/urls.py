@@ -21,8 +21,8 @@ from . import views
 
 urlpatterns = [
     url(r'^$', views.cohorts_list, name='cohort_list'),
-    url(r'^manifests/fetch/(?P<file_name>[A-Za-z\-0-9]+\/manifest_[0-9_]+\.s5cmd)', views.fetch_user_manifest, name='fetch_user_manifest'),
-    url(r'^manifests/check/(?P<file_name>[A-Za-z\-0-9]+\/manifest_[0-9_]+\.s5cmd)', views.check_manifest_ready, name='check_user_manifest'),
+    url(r'^manifests/fetch/(?P<file_name>[A-Za-z\-0-9]+\/manifest_[0-9_]+\.(?:s5cmd|csv\.gz|json\.gz))', views.fetch_user_manifest, name='fetch_user_manifest'),
+    url(r'^manifests/check/(?P<file_name>[A-Za-z\-0-9]+\/manifest_[0-9_]+\.(?:s5cmd|csv\.gz|json\.gz))', views.check_manifest_ready, name='check_user_manifest'),
     url(r'^manifests/fetch/$', views.fetch_user_manifest, name='fetch_user_manifest_base'),
     url(r'^manifests/check/$', views.check_manifest_ready, name='check_user_manifest_base'),
     url(r'^api/$', views.views_api_v1.cohort_list_api, name='cohort_list_api'),
@@ -65,5 +65,6 @@ urlpatterns = [
     url(r'bq_string/(?P<cohort_id>\d+)/', views.get_query_str_response, name='bq_string'),
     url(r'^download_manifest/', views.download_cohort_manifest, name='cohort_manifest_base'),
     url(r'^download_ids/(?P<cohort_id>\d+)/', views.cohort_uuids, name='download_ids'),
+    url(r'^export_jobs/status/$', views.export_job_status, name='export_job_status'),
     url(r'^get_metadata_ajax/$', views.get_metadata, name='metadata_count_ajax')
 ]
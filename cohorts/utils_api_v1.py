@@ -23,6 +23,7 @@ from django.conf import settings
 from idc_collections.models import ImagingDataCommonsVersion
 from idc_collections.collex_metadata_utils import get_bq_metadata, get_bq_string
 from google_helpers.bigquery.bq_support import BigQuerySupport
+from google_helpers.bigquery.admission import QueryBudgetExceeded, request_budget_user
 
 
 logger = logging.getLogger('main_logger')
@@ -103,6 +104,8 @@ def _cohort_manifest_api(request, cohort, info):
     data_version = cohort.get_data_versions()
 
     info = get_manifest_query(request, filters, data_version, info)
+    if 'query' not in info:
+        return info
 
     info['cohort']["filterSet"] = get_filterSet_api(cohort)
 
@@ -138,6 +141,8 @@ def _cohort_preview_manifest_api(request, data, manifest_info):
     # Always preview query against the active version
     data_version = ImagingDataCommonsVersion.objects.filter(active=True)
     manifest_info = get_manifest_query(request, filters, data_version, manifest_info)
+    if 'query' not in manifest_info:
+        return manifest_info
 
     manifest_info['cohort']["filterSet"] = {}
     manifest_info['cohort']["filterSet"]["filters"] = copy.deepcopy(data['filters'])
@@ -159,6 +164,8 @@ def _cohort_query_api(request, cohort, data, info):
     data_version = cohort.get_data_versions()
 
     info = get_query_query(request, filters, data['fields'], data_version, info)
+    if 'query' not in info:
+        return info
 
     info['cohort_def']["filterSet"] = get_filterSet_api(cohort)
 
@@ -175,6 +182,8 @@ def _cohort_preview_query_api(request, data, info):
     data_version = ImagingDataCommonsVersion.objects.filter(active=True)
     # data_version = get_idc_data_version_query_set(data['cohort_def']['filterSet']['idc_data_version'])
     info = get_query_query(request, filters, data['queryFields']['fields'], data_version, info)
+    if 'query' not in info:
+        return info
 
     info['cohort_def']["filterSet"] = {}
     info['cohort_def']["filterSet"]["filters"] = copy.deepcopy(data['cohort_def']['filters'])
@@ -227,6 +236,20 @@ def get_cohort_query(request, filters, data_version, cohort_info):
     return cohort_info
 
 
+# API queries are run by the caller, but are admitted against the query budget of the call's authenticated identity
+# (see request_budget_user) before they're handed out. Returns the error info if the query doesn't fit.
+def _admit_api_query(request, results):
+    try:
+        BigQuerySupport.admit_query(results['sql_string'], results['params'], request_budget_user(request))
+    except QueryBudgetExceeded as e:
+        return {
+            "message": str(e),
+            "code": 429,
+            "retry_after": e.retry_after
+        }
+    return None
+
+
 # Launch a manifest job
 def get_manifest_query(request, filters, data_version, manifest_info):
 
@@ -272,6 +295,10 @@ def get_manifest_query(request, filters, data_version, manifest_info):
         }
         return manifest_info
 
+    budget_error = _admit_api_query(request, results)
+    if budget_error:
+        return budget_error
+
     manifest_info['query'] = results
 
     return manifest_info
@@ -300,6 +327,10 @@ def get_query_query(request, filters, fields, data_version, info):
         }
         return info
 
+    budget_error = _admit_api_query(request, results)
+    if budget_error:
+        return budget_error
+
     info['query'] = results
 
     return info
@@ -21,6 +21,8 @@ import copy
 from django.conf import settings
 from idc_collections.models import ImagingDataCommonsVersion
 from idc_collections.collex_metadata_utils import get_bq_metadata, get_bq_string
+from google_helpers.bigquery.bq_support import BigQuerySupport
+from google_helpers.bigquery.admission import QueryBudgetExceeded, request_budget_user
 
 logger = logging.getLogger('main_logger')
 DENYLIST_RE = settings.DENYLIST_RE
@@ -78,7 +80,9 @@ def _cohort_query_api(request, cohort, data, info):
            filters[filter] = to_numeric_list(value)
 
     data_version = cohort.get_data_versions()
-    info = get_query_query(filters, data['fields'], data_version, info, data["sql"])
+    info = get_query_query(filters, data['fields'], data_version, info, data["sql"], request_budget_user(request))
+    if 'query' not in info:
+        return info
     info['cohort_def']["filterSet"] = get_filterSet_api(cohort)
 
     return info
@@ -93,7 +97,9 @@ def _cohort_preview_query_api(request, data, info):
 
     # Always preview query against the active version
     data_version = ImagingDataCommonsVersion.objects.filter(active=True)
-    info = get_query_query(filters, data['fields'], data_version, info, data['sql'])
+    info = get_query_query(filters, data['fields'], data_version, info, data['sql'], request_budget_user(request))
+    if 'query' not in info:
+        return info
     info['cohort_def']["filterSet"] = {}
     info['cohort_def']["filterSet"]["filters"] = copy.deepcopy(data['cohort_def']['filters'])
     info['cohort_def']["filterSet"]['idc_data_version'] = data_version.values()[0]['version_number']
@@ -102,7 +108,9 @@ def _cohort_preview_query_api(request, data, info):
     return info
 
 
-def get_query_query(filters, fields, data_version, info, sql):
+# Build the query for a set of filters. The query is run by the caller, but it's admitted against the user's query
+# budget here, so an over-budget query is refused before it's handed out.
+def get_query_query(filters, fields, data_version, info, sql, user=None):
 
     # Construct the query from active dataversions
     data_versions = data_version
@@ -116,6 +124,14 @@ def get_query_query(filters, fields, data_version, info, sql):
                 "code": 400
         }
         return info
+    try:
+        BigQuerySupport.admit_query(results['sql_string'], results['params'], user)
+    except QueryBudgetExceeded as e:
+        return {
+            "message": str(e),
+            "code": 429,
+            "retry_after": e.retry_after
+        }
     info['query'] = results
 
     return info
@@ -17,7 +17,6 @@ from __future__ import absolute_import
 
 import sys
 
-from time import sleep
 from builtins import map
 from builtins import next
 from builtins import str
@@ -34,12 +33,13 @@ import datetime
 import time
 import logging
 import math
+from uuid import uuid4
 
 import django
 from request_logging.decorators import no_logging
-from google_helpers.bigquery.cohort_support import BigQuerySupport
 from google_helpers.bigquery.cohort_support import BigQueryCohortSupport
-from google_helpers.bigquery.export_support import BigQueryExportFileList, FILE_LIST_EXPORT_SCHEMA
+from google_helpers.bigquery.export_support import BigQueryExportFileList, FILE_LIST_EXPORT_SCHEMA, COMPOSABLE_FORMATS
+from google_helpers.bigquery.admission import QueryBudgetExceeded, user_query_budget, request_budget_user
 from google_helpers.stackdriver import StackDriverLogger
 from google.cloud import storage
 from google.auth import jwt
@@ -60,7 +60,8 @@ from django.utils import formats
 from django.views.decorators.csrf import csrf_protect, csrf_exempt
 from django.utils.html import escape
 
-from cohorts.models import Cohort, Cohort_Perms, Source, Filter, Cohort_Comments
+from cohorts.models import Cohort, Cohort_Perms, Source, Filter, Cohort_Comments, Export_Job
+from cohorts.export_jobs import register_export_job, submit_gcs_export
 from cohorts.utils import _save_cohort, _delete_cohort, get_cohort_uuids, _get_cohort_stats
 from idc_collections.models import Program, Collection, DataSource, DataVersion, ImagingDataCommonsVersion, Attribute
 from idc_collections.collex_metadata_utils import build_explorer_context, get_bq_metadata, get_bq_string, \
@@ -71,6 +72,12 @@ COHORT_CREATION_LOG_NAME = settings.COHORT_CREATION_LOG_NAME
 
 BQ_ATTEMPT_MAX = 10
 
+MANIFEST_EXPORT_COLUMNS = ["PatientID", "collection_id", "source_DOI", "StudyInstanceUID", "SeriesInstanceUID",
+                           "SOPInstanceUID", "crdc_study_uuid", "crdc_series_uuid", "crdc_instance_uuid", "gcs_url",
+                           "idc_version"]
+MANIFEST_EXPORT_ORDER = ["PatientID", "collection_id", "source_DOI", "StudyInstanceUID", "SeriesInstanceUID",
+                         "SOPInstanceUID", "crdc_study_uuid", "crdc_series_uuid", "crdc_instance_uuid", "gcs_url"]
+
 BMI_MAPPING = {
     'underweight': [0, 18.5],
     'normal weight': [18.5, 25],
@@ -273,10 +280,11 @@ def cohort_detail(request, cohort_id):
         cohort_versions = cohort.get_data_versions()
         initial_filters = {}
 
-        template_values = build_explorer_context(
-            is_dicofdic, source, cohort_versions, initial_filters, fields, order_docs, counts_only, with_related,
-            with_derived, collapse_on, False
-        )
+        with user_query_budget(request_budget_user(request)):
+            template_values = build_explorer_context(
+                is_dicofdic, source, cohort_versions, initial_filters, fields, order_docs, counts_only, with_related,
+                with_derived, collapse_on, False
+            )
 
         file_parts_count = math.ceil(cohort.series_count / (MAX_FILE_LIST_ENTRIES if MAX_FILE_LIST_ENTRIES > 0 else 1))
         bq_string = get_query_string(request, cohort_id)
@@ -300,6 +308,9 @@ def cohort_detail(request, cohort_id):
         logger.exception(e)
         messages.error(request, 'The cohort you were looking for does not exist.')
         return redirect('cohort_list')
+    except QueryBudgetExceeded as e:
+        messages.error(request, str(e))
+        return redirect('cohort_list')
     except Exception as e:
         logger.error("[ERROR] Exception while trying to view a cohort:")
         logger.exception(e)
@@ -487,6 +498,41 @@ def cohort_uuids(request, cohort_id=0):
     return response
 
 
+# The no_submit get_bq_metadata query for a cohort's file manifest. Fields with the same value for the whole cohort
+# (eg. its data version) are filled in from the cohort rather than the tables.
+def _cohort_manifest_query(cohort, field_list, order_by):
+    field_list = list(field_list)
+    static_map = build_static_map(cohort)
+    static_fields = None
+    for x in STATIC_EXPORT_FIELDS:
+        if x in field_list:
+            static_fields = static_fields or {}
+            static_fields[x] = static_map[x]
+            field_list.remove(x)
+
+    base_filters = cohort.get_filters_as_dict_simple()[0]
+    if 'bmi' in base_filters:
+        vals = base_filters['bmi']
+        del base_filters['bmi']
+        for val in vals:
+            if val not in ('None','obese'):
+                if 'bmi_btw' not in base_filters:
+                    base_filters['bmi_btw'] = []
+                base_filters['bmi_btw'].append(BMI_MAPPING[val])
+            elif val == 'obese':
+                base_filters['bmi_gt'] = BMI_MAPPING[val]
+            else:
+                base_filters['bmi'] = 'None'
+
+    return get_bq_metadata(
+        base_filters, field_list, cohort.get_data_versions(),
+        order_by=order_by, no_submit=True,
+        search_child_records_by="StudyInstanceUID", static_fields=static_fields
+    )
+
+
+# Submit the cohorts' file manifest exports to BigQuery tables, leaving them to the poller to finish
+# returns: the response, and the table each cohort is being exported to (or None if the request failed)
 @login_required
 def create_manifest_bq_table(request, cohorts):
     response = None
@@ -495,26 +541,18 @@ def create_manifest_bq_table(request, cohorts):
     try:
         timestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y%m%d_%H%M%S')
 
-        order_by = ["PatientID", "collection_id", "source_DOI", "StudyInstanceUID", "SeriesInstanceUID",
-                    "SOPInstanceUID", "crdc_study_uuid", "crdc_series_uuid", "crdc_instance_uuid", "gcs_url"]
-        field_list = json.loads(req.get(
-            'columns',
-            '["PatientID", "collection_id", "source_DOI", "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID", ' +
-            '"crdc_study_uuid", "crdc_series_uuid", "crdc_instance_uuid", "gcs_url", "idc_version"]'
-        ))
+        field_list = json.loads(req.get('columns', json.dumps(MANIFEST_EXPORT_COLUMNS)))
 
         # We can only ORDER BY columns which we've actually requested
-        order_by = list(set.intersection(set(order_by), set(field_list)))
+        order_by = list(set.intersection(set(MANIFEST_EXPORT_ORDER), set(field_list)))
 
         all_results = {}
         export_jobs = {}
-        static_fields = None
 
         table_schema = {'fields': [x for x in FILE_LIST_EXPORT_SCHEMA['fields'] if x['name'] in field_list]} \
             if len(field_list) < len(FILE_LIST_EXPORT_SCHEMA['fields']) else None
 
         for cohort in cohorts:
-            static_map = build_static_map(cohort)
             cohort_version = "; ".join([str(x) for x in cohort.get_idc_data_version()])
             desc = None
             headers = []
@@ -526,81 +564,47 @@ def create_manifest_bq_table(request, cohorts):
             headers.append("IDC Data Version(s): {}".format(cohort_version))
             desc = "\n".join(headers)
 
-            base_filters = cohort.get_filters_as_dict_simple()[0]
-            if 'bmi' in base_filters:
-                vals = base_filters['bmi']
-                del base_filters['bmi']
-                for val in vals:
-                    if val not in ('None','obese'):
-                        if 'bmi_btw' not in base_filters:
-                            base_filters['bmi_btw'] = []
-                        base_filters['bmi_btw'].append(BMI_MAPPING[val])
-                    elif val == 'obese':
-                        base_filters['bmi_gt'] = BMI_MAPPING[val]
-                    else:
-                        base_filters['bmi'] = 'None'
-
             table_name = "manifest_cohort_{}_{}".format(str(cohort.id), timestamp)
             export_jobs[cohort.id] = {
                 'table_id': '{}.{}.{}'.format(settings.BIGQUERY_USER_DATA_PROJECT_ID,
                                               settings.BIGQUERY_USER_MANIFEST_DATASET,
                                               table_name)
             }
-            for x in STATIC_EXPORT_FIELDS:
-                if x in field_list:
-                    static_fields = static_fields or {}
-                    static_fields[x] = static_map[x]
-                    field_list.remove(x)
-
-            query = get_bq_metadata(
-                base_filters, field_list, cohort.get_data_versions(),
-                order_by=order_by, no_submit=True,
-                search_child_records_by="StudyInstanceUID", static_fields=static_fields
-            )
+
+            query = _cohort_manifest_query(cohort, field_list, order_by)
             export_jobs[cohort.id]['bqs'] = BigQueryExportFileList(**{
                 'project_id': settings.BIGQUERY_USER_DATA_PROJECT_ID,
                 'dataset_id': settings.BIGQUERY_USER_MANIFEST_DATASET,
                 'table_id': table_name,
                 'schema': table_schema
             })
-            export_jobs[cohort.id]['job_id'] = export_jobs[cohort.id]['bqs'].export_file_list_query_to_bq(
-                query['sql_string'], query['params'],
-                cohort.id,
-                user_email=request.user.email,
-                desc=desc or None,
-                for_batch=True
+            with user_query_budget(request_budget_user(request)):
+                submitted = export_jobs[cohort.id]['bqs'].export_file_list_query_to_bq(
+                    query['sql_string'], query['params'],
+                    cohort.id,
+                    user_email=request.user.email,
+                    desc=desc or None,
+                    for_batch=True
+                )
+            if isinstance(submitted, dict):
+                # The export was refused before a job was started, eg. because the table already exists
+                all_results[cohort.id] = {
+                    'status': 'error',
+                    'message': submitted.get('message', "Unable to export cohort file manifest."),
+                    'table_id': export_jobs[cohort.id]['table_id']
+                }
+                continue
+            export_jobs[cohort.id]['job'] = register_export_job(
+                submitted, request.user, export_jobs[cohort.id]['table_id'], cohort=cohort
             )
 
-        not_done = True
-        still_checking = True
-        num_retries = 0
-
-        while still_checking and not_done:
-            not_done = False
-            for cohort in export_jobs:
-                if not BigQuerySupport.check_job_is_done({'jobReference': {'jobId': export_jobs[cohort]['job_id']}}):
-                    not_done = True
-                else:
-                    if cohort not in all_results:
-                        all_results[cohort] = export_jobs[cohort]['bqs'].check_query_to_table_done(
-                            export_jobs[cohort]['job_id'],"cohort file manifest",False
-                        )
-                        all_results[cohort]['table_id'] = export_jobs[cohort]['table_id'] \
-                            if all_results[cohort]['status'] == 'error' \
-                            else all_results[cohort]['full_table_id']
-            if not_done:
-                sleep(1)
-                num_retries += 1
-                still_checking = (num_retries < settings.BQ_MAX_ATTEMPTS)
-
-        if not_done:
-            logger.warning("[WARNING] Not all of the queries completed!")
-
+        # The jobs are left to run; their progress is reported by export_job_status
         for cohort in export_jobs:
-            if not all_results.get(cohort,None):
+            if not all_results.get(cohort, None):
                 all_results[cohort] = {
                     'status': 'long_running',
-                    'table_id': export_jobs[cohort]['table_id']
+                    'table_id': export_jobs[cohort]['table_id'],
+                    'job': export_jobs[cohort]['job'].id
                 }
 
         errors = {x: all_results[x]['message'] for x in all_results if all_results[x]['status'] == 'error'}
@@ -624,9 +628,18 @@ def create_manifest_bq_table(request, cohorts):
             })
             response = JsonResponse({
                 'status': 200,
-                'message': msg
+                'message': msg,
+                'jobs': {x: all_results[x]['job'] for x in all_results if 'job' in all_results[x]},
+                'status_url': reverse('export_job_status')
             })
             tables = { x: all_results[x]['table_id'] for x in all_results }
+    except QueryBudgetExceeded as e:
+        response = JsonResponse({
+            'status': 429,
+            'message': str(e)
+        })
+        if e.retry_after:
+            response['Retry-After'] = str(e.retry_after)
     except Exception as e:
         logger.error("[ERROR] While exporting cohort to BQ:")
         logger.exception(e)
@@ -638,6 +651,96 @@ def create_manifest_bq_table(request, cohorts):
     return response, tables
 
 
+# Export cohort file manifests to the user manifests folder of the results bucket. Only the queries are started here:
+# the poller extracts each one once it's done, progress is reported by export_job_status, and a finished manifest is
+# downloaded through fetch_user_manifest.
+@login_required
+def create_manifest_gcs_export(request, cohorts):
+    response = None
+    req = request.GET or request.POST
+    try:
+        timestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y%m%d_%H%M%S')
+
+        field_list = json.loads(req.get('columns', json.dumps(MANIFEST_EXPORT_COLUMNS)))
+        order_by = list(set.intersection(set(MANIFEST_EXPORT_ORDER), set(field_list)))
+
+        # Manifests are fetched as a single object, so only formats whose shards can be composed are offered
+        file_format = req.get('file_format', 'CSV').upper()
+        if file_format not in COMPOSABLE_FORMATS:
+            return JsonResponse({
+                'status': 400,
+                'message': "Manifests can only be exported as {}.".format(" or ".join(COMPOSABLE_FORMATS))
+            })
+        ext = "{}.gz".format('csv' if file_format == 'CSV' else 'json')
+
+        jobs = {}
+        file_names = {}
+        for cohort in cohorts:
+            query = _cohort_manifest_query(cohort, field_list, order_by)
+            # Named like the manifests written by submit_manifest_job, so fetch_user_manifest can serve them
+            file_names[cohort.id] = "{}/manifest_{}_{}.{}".format(str(uuid4()), str(cohort.id), timestamp, ext)
+            exporter = BigQueryExportFileList(
+                settings.BIGQUERY_PROJECT_ID, None, None, bucket_path=settings.RESULT_BUCKET,
+                file_name="{}/{}".format(settings.USER_MANIFESTS_FOLDER, file_names[cohort.id])
+            )
+            with user_query_budget(request_budget_user(request)):
+                jobs[cohort.id] = submit_gcs_export(
+                    exporter, query['sql_string'], query['params'], file_format, request.user, cohort=cohort,
+                    compose=True
+                ).id
+
+        response = JsonResponse({
+            'status': 200,
+            'message': "Your manifest export has started. It can be downloaded once it's complete.",
+            'jobs': jobs,
+            'file_names': file_names,
+            'status_url': reverse('export_job_status')
+        })
+    except QueryBudgetExceeded as e:
+        response = JsonResponse({
+            'status': 429,
+            'message': str(e)
+        })
+        if e.retry_after:
+            response['Retry-After'] = str(e.retry_after)
+    except Exception as e:
+        logger.error("[ERROR] While exporting cohort manifest to GCS:")
+        logger.exception(e)
+        response = JsonResponse({
+            'status': 500,
+            'message': "There was an error exporting your cohort manifest. Please contact the administrator."
+        })
+
+    return response
+
+
+# Progress of the user's export jobs, as last recorded by the poller (see cohorts.export_jobs): those given as a
+# comma-separated list of job handles in 'ids', or otherwise their most recent ones
+@login_required
+def export_job_status(request):
+    req = request.GET or request.POST
+    try:
+        export_jobs = Export_Job.objects.filter(user=request.user)
+        ids = [int(x) for x in req.get('ids', '').split(',') if len(x.strip())]
+        if len(ids):
+            export_jobs = export_jobs.filter(id__in=ids)
+        export_jobs = list(export_jobs.order_by('-date_created')[:max(len(ids), 20)])
+        return JsonResponse({
+            'status': 200,
+            'jobs': [x.to_dict() for x in export_jobs],
+            'outstanding': len([x for x in export_jobs if x.is_outstanding()])
+        })
+    except ValueError:
+        return JsonResponse({'status': 400, 'message': "Job IDs must be integers."}, status=400)
+    except Exception as e:
+        logger.error("[ERROR] While checking export jobs for user {}:".format(str(request.user.email)))
+        logger.exception(e)
+        return JsonResponse({
+            'status': 500,
+            'message': "There was an error checking your exports. Please contact the administrator."
+        }, status=500)
+
+
 @login_required
 def download_cohort_manifest(request, cohort_id=0):
     try:
@@ -654,22 +757,18 @@ def download_cohort_manifest(request, cohort_id=0):
 
         try:
             cohorts = Cohort.objects.filter(id__in=cohort_ids)
-            tables = None
             for cohort in cohorts:
                 Cohort_Perms.objects.get(cohort=cohort, user=request.user)
 
             if req.get('manifest-type', 'file-manifest') == 'bq-manifest':
+                # The cohorts' last_exported_table is set by the poller once each export is done
                 response, tables = create_manifest_bq_table(request, cohorts)
+            elif req.get('manifest-type', 'file-manifest') == 'gcs-manifest':
+                response = create_manifest_gcs_export(request, cohorts)
             else:
                 response = create_file_manifest(request, cohorts.first())
             if not response:
                 raise Exception("Response from manifest creation was None!")
-
-            if req.get('manifest-type','file-manifest') == 'bq-manifest':
-                for cohort in cohorts:
-                    cohort.last_exported_date = datetime.datetime.utcnow()
-                    cohort.last_exported_table = tables[cohort.id]
-                    cohort.save()
             return response
         except ObjectDoesNotExist:
             logger.error("[ERROR] User ID {} attempted to access one or more of these cohorts, " +
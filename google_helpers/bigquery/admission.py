@@ -0,0 +1,251 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.conf import settings
+from idc_collections.metadata_cache import MetadataCache, make_cache_key
+from google_helpers.bigquery.result_cache import normalize_sql, normalize_params
+
+logger = logging.getLogger('main_logger')
+
+# Admission control for user-originated queries: each is dry-run first, and only run if its estimated bytes processed
+# fit both the per-query limit and what's left of the user's budget for the current window.
+BQ_ADMISSION_CONTROL = getattr(settings, 'BQ_ADMISSION_CONTROL', True)
+BQ_MAX_BYTES_PER_QUERY = getattr(settings, 'BQ_MAX_BYTES_PER_QUERY', 200 * 1024 ** 3)
+BQ_MAX_BYTES_PER_USER = getattr(settings, 'BQ_MAX_BYTES_PER_USER', 2 * 1024 ** 4)
+# Length, in seconds, of the window a user's budget applies to
+BQ_USER_BUDGET_WINDOW = getattr(settings, 'BQ_USER_BUDGET_WINDOW', 3600)
+# 'local' to track usage per process, or the alias of a Django cache to share it between workers
+BQ_ADMISSION_BACKEND = getattr(settings, 'BQ_ADMISSION_BACKEND', 'local')
+BQ_DRY_RUN_CACHE_TTL = getattr(settings, 'BQ_DRY_RUN_CACHE_TTL', 3600)
+
+ADMISSION_STATS = {
+    'dry_runs': 0,
+    'dry_run_cache_hits': 0,
+    'admitted': 0,
+    'rejected': 0,
+    'estimated_bytes': 0,
+    'actual_bytes': 0,
+    'completed': 0
+}
+_stats_lock = threading.Lock()
+_local = threading.local()
+
+_dry_run_cache = MetadataCache("bq_dry_runs", max_entries=512)
+
+# Estimates for admitted jobs, by job ID, awaiting their actual bytes processed
+_pending_estimates = OrderedDict()
+_MAX_PENDING_ESTIMATES = 1024
+
+
+class QueryBudgetExceeded(Exception):
+
+    def __init__(self, message, estimated_bytes, limit, retry_after=None):
+        super(QueryBudgetExceeded, self).__init__(message)
+        self.estimated_bytes = estimated_bytes
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+def _count(stat, value=1):
+    with _stats_lock:
+        ADMISSION_STATS[stat] += value
+
+
+def get_admission_stats():
+    with _stats_lock:
+        stats = dict(ADMISSION_STATS)
+    # How far off the dry-run estimates are from what the queries actually processed
+    stats['actual_to_estimated'] = round(stats['actual_bytes'] / stats['estimated_bytes'], 4) \
+        if stats['estimated_bytes'] else None
+    return stats
+
+
+def _format_bytes(num_bytes):
+    for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+        if num_bytes < 1024 or unit == 'TiB':
+            return "{} {}".format(round(num_bytes, 1), unit)
+        num_bytes /= 1024.0
+
+
+class LocalUsageBackend(object):
+
+    def __init__(self):
+        self._usage = {}
+        self._lock = threading.Lock()
+
+    def get(self, user, window):
+        with self._lock:
+            return self._usage.get((user, window,), 0)
+
+    def add(self, user, window, num_bytes, ttl):
+        with self._lock:
+            # Drop any earlier windows as we go
+            for key in [x for x in self._usage if x[1] < window]:
+                del self._usage[key]
+            self._usage[(user, window,)] = self._usage.get((user, window,), 0) + num_bytes
+            return self._usage[(user, window,)]
+
+
+class DjangoUsageBackend(object):
+
+    def __init__(self, alias):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+
+    @staticmethod
+    def _key(user, window):
+        return "bq_usage:{}:{}".format(make_cache_key(user), window)
+
+    def get(self, user, window):
+        return self.cache.get(self._key(user, window)) or 0
+
+    def add(self, user, window, num_bytes, ttl):
+        key = self._key(user, window)
+        self.cache.add(key, 0, timeout=ttl)
+        return self.cache.incr(key, num_bytes)
+
+
+_usage_backend = None
+_usage_lock = threading.Lock()
+
+
+def _get_usage_backend():
+    global _usage_backend
+    if _usage_backend is None:
+        with _usage_lock:
+            if _usage_backend is None:
+                _usage_backend = LocalUsageBackend() if BQ_ADMISSION_BACKEND == 'local' \
+                    else DjangoUsageBackend(BQ_ADMISSION_BACKEND)
+    return _usage_backend
+
+
+# Queries with the same shape--the same SQL, up to formatting, and the same parameter names and types--scan the same
+# columns of the same tables, so one dry run serves for all of them
+def query_shape_key(sql, parameters=None):
+    shape = []
+    for param in normalize_params(parameters):
+        param.pop('parameterValue', None)
+        shape.append(param)
+    return make_cache_key(normalize_sql(sql), shape)
+
+
+def estimate_query_bytes(sql, parameters, dry_run):
+    key = query_shape_key(sql, parameters)
+    estimate = _dry_run_cache.get(key)
+    if estimate is not None:
+        _count('dry_run_cache_hits')
+        return estimate
+    _count('dry_runs')
+    estimate = int(dry_run(sql, parameters))
+    _dry_run_cache.put(key, estimate, ttl=BQ_DRY_RUN_CACHE_TTL)
+    return estimate
+
+
+# Dry-run a query (or reuse the dry run of one of the same shape) and check it against the per-query limit and the
+# user's remaining budget, charging it to that budget if it's admitted. A query over either raises
+# QueryBudgetExceeded at once--never waiting on the request thread--with the seconds until the user's budget resets
+# as its retry_after.
+#
+# dry_run: callable taking (sql, parameters) and returning the query's estimated bytes processed
+# user: the identity to charge (see request_budget_user); if None, only the per-query limit applies
+# returns: the estimated bytes processed, or None if admission control is disabled
+def admit_query(sql, parameters, dry_run, user=None):
+    if not BQ_ADMISSION_CONTROL:
+        return None
+    estimate = estimate_query_bytes(sql, parameters, dry_run)
+    if estimate > BQ_MAX_BYTES_PER_QUERY:
+        _count('rejected')
+        logger.warning("[WARNING] Rejected query for {}: estimated {} exceeds the per-query limit of {}.".format(
+            user, _format_bytes(estimate), _format_bytes(BQ_MAX_BYTES_PER_QUERY)))
+        raise QueryBudgetExceeded(
+            "This query would process an estimated {}, over the limit of {} per query. Please narrow your filters."
+            .format(_format_bytes(estimate), _format_bytes(BQ_MAX_BYTES_PER_QUERY)), estimate, BQ_MAX_BYTES_PER_QUERY
+        )
+    if user:
+        backend = _get_usage_backend()
+        window = int(time.time() // BQ_USER_BUDGET_WINDOW)
+        used = backend.get(user, window)
+        if used + estimate > BQ_MAX_BYTES_PER_USER:
+            retry_after = int((window + 1) * BQ_USER_BUDGET_WINDOW - time.time()) + 1
+            _count('rejected')
+            logger.warning("[WARNING] Rejected query for {}: estimated {} with {} already used this window.".format(
+                user, _format_bytes(estimate), _format_bytes(used)))
+            raise QueryBudgetExceeded(
+                "This query would process an estimated {}, and you have used {} of your {} allowance. Please try "
+                "again in {} minutes.".format(_format_bytes(estimate), _format_bytes(used),
+                                              _format_bytes(BQ_MAX_BYTES_PER_USER), max(retry_after // 60, 1)),
+                estimate, BQ_MAX_BYTES_PER_USER, retry_after
+            )
+        backend.add(user, window, estimate, BQ_USER_BUDGET_WINDOW * 2)
+    _count('admitted')
+    return estimate
+
+
+# Remember an admitted job's estimate, so it can be compared with what the job actually processed
+def track_admitted_job(job_id, estimate):
+    if estimate is not None:
+        with _stats_lock:
+            _pending_estimates[job_id] = estimate
+            while len(_pending_estimates) > _MAX_PENDING_ESTIMATES:
+                _pending_estimates.popitem(last=False)
+
+
+# Record the bytes processed by a finished job against its dry-run estimate, if it was admitted here
+def record_job_bytes(job):
+    if not job or job.get('status', {}).get('state', None) != 'DONE':
+        return
+    job_id = job['jobReference']['jobId']
+    with _stats_lock:
+        estimate = _pending_estimates.pop(job_id, None)
+    if estimate is None:
+        return
+    actual = int(job.get('statistics', {}).get('query', {}).get('totalBytesProcessed', 0))
+    _count('estimated_bytes', estimate)
+    _count('actual_bytes', actual)
+    _count('completed')
+    logger.debug("[BENCHMARKING] Job {} processed {} against an estimated {}".format(
+        job_id, _format_bytes(actual), _format_bytes(estimate)))
+
+
+# The identity a request's queries are charged to: the owner of the API token it was authenticated with (see
+# cohorts.decorators.api_auth), or its logged in user, or failing both its client address. It's never taken from the
+# request's parameters, which a caller could use to charge another account or to spread queries over many budgets.
+def request_budget_user(request):
+    for user in [getattr(request, 'api_user', None), getattr(request, 'user', None)]:
+        if user is not None and getattr(user, 'is_authenticated', False):
+            return user.email or user.username
+    return "ip:{}".format(request.META.get('REMOTE_ADDR', None) or "unknown")
+
+
+# While active, every query job BigQuerySupport inserts on this thread is admitted against the given user's budget
+@contextmanager
+def user_query_budget(user):
+    previous = getattr(_local, 'user', None)
+    _local.user = user
+    try:
+        yield
+    finally:
+        _local.user = previous
+
+
+# The user whose budget queries on this thread are charged to, if any
+def current_budget_user():
+    return getattr(_local, 'user', None)
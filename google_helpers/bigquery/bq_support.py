@@ -17,18 +17,45 @@
 from builtins import str
 import logging
 import re
-from time import sleep
 from uuid import uuid4
 import copy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
+from googleapiclient.errors import HttpError
 from google_helpers.bigquery.service import get_bigquery_service
 from google_helpers.bigquery.abstract import BigQueryABC
+from google_helpers.bigquery.job_waiter import JobWaiter, wait_for_job
+from google_helpers.bigquery.result_cache import bq_result_cache_key, cached_bq_result
+from google_helpers.bigquery.row_decoder import get_row_decoder
+from google_helpers.bigquery.streaming_insert import StreamingInserter
+from google_helpers.bigquery.load_export import RowExporter
+from google_helpers.bigquery.admission import admit_query as admit_query_, current_budget_user, track_admitted_job, \
+    record_job_bytes
+from google_helpers.bigquery.storage_read import BigQueryStorageReader, storage_read_available, \
+    get_job_destination, BQ_STORAGE_READ_STREAMS
 from .utils import build_bq_where_clause as build_bq_where_clause_, FIXED_TYPES
 
 logger = logging.getLogger('main_logger')
 
 MAX_INSERT = settings.MAX_BQ_INSERT
 BQ_ATTEMPT_MAX = settings.BQ_MAX_ATTEMPTS
+# Number of job status requests sent in a single batch when polling a set of jobs
+BQ_POLL_BATCH_SIZE = getattr(settings, 'BQ_POLL_BATCH_SIZE', 50)
+# Rows per page, and number of pages fetched concurrently, when iterating over a job's results
+BQ_PAGE_SIZE = getattr(settings, 'BQ_PAGE_SIZE', 10000)
+BQ_PAGE_FETCH_WORKERS = getattr(settings, 'BQ_PAGE_FETCH_WORKERS', 4)
+# Run queries without a destination table through jobs.query, which returns the results in its response if the
+# query finishes within BQ_FAST_QUERY_TIMEOUT_MS; queries which take longer continue as ordinary jobs
+BQ_FAST_QUERY = getattr(settings, 'BQ_FAST_QUERY', True)
+BQ_FAST_QUERY_TIMEOUT_MS = getattr(settings, 'BQ_FAST_QUERY_TIMEOUT_MS', 10000)
+# Rows returned in the jobs.query response itself; any more are paged in with jobs.getQueryResults
+BQ_FAST_QUERY_MAX_RESULTS = getattr(settings, 'BQ_FAST_QUERY_MAX_RESULTS', 10000)
+
+FAST_QUERY_STATS = {
+    'completed': 0,
+    'fell_back': 0
+}
 
 
 class BigQuerySupport(BigQueryABC):
@@ -56,29 +83,14 @@ class BigQuerySupport(BigQueryABC):
             "rows": insertable_rows
         }
 
+    # Stream rows into this object's table, in size-aware batches sent concurrently; see StreamingInserter
     def _streaming_insert(self, rows):
+        return StreamingInserter(self.project_id, self.dataset_id, self.table_id).insert(rows)
 
-        table_data = self.bq_service.tabledata()
-        index = 0
-        next = 0
-        response = None
-
-        while next is not None and index < len(rows):
-            next = MAX_INSERT+index
-            body = None
-            if next > len(rows):
-                next = None
-                body = self._build_request_body_from_rows(rows[index:])
-            else:
-                body = self._build_request_body_from_rows(rows[index:next])
-
-            response = table_data.insertAll(projectId=self.project_id,
-                                            datasetId=self.dataset_id,
-                                            tableId=self.table_id,
-                                            body=body).execute(num_retries=5)
-            index = next
-
-        return response
+    # Write rows into this object's table by streaming or, for large sets, a load job; see RowExporter
+    def _bulk_insert(self, rows):
+        return RowExporter(self.project_id, self.dataset_id, self.table_id, schema=self.table_schema,
+                           executing_project=self.executing_project).export(rows)
 
     # Get all the tables for this object's project ID
     def get_tables(self):
@@ -277,17 +289,88 @@ class BigQuerySupport(BigQueryABC):
         if cost_est:
             job_desc['configuration']['dryRun'] = True
 
-        return self.bq_service.jobs().insert(
+        # Queries run on behalf of a user (see admission.user_query_budget) must fit their budget
+        estimate = None
+        if not cost_est and current_budget_user():
+            estimate = admit_query_(query, parameters, self.dry_run_bytes, current_budget_user())
+
+        query_job = self.bq_service.jobs().insert(
             projectId=self.executing_project,
             body=job_desc).execute(num_retries=5)
 
+        track_admitted_job(job_id, estimate)
+
+        return query_job
+
+    # Estimated bytes processed by a query, from a dry run
+    def dry_run_bytes(self, query, parameters=None):
+        dry_run = self.insert_bq_query_job(query, parameters, cost_est=True)
+        return int(dry_run['statistics']['query']['totalBytesProcessed'])
+
+    # Run a query through jobs.query, which waits up to BQ_FAST_QUERY_TIMEOUT_MS for it to finish and, if it does,
+    # returns the first page of results in the same response. If it doesn't, the response still carries the job's
+    # reference, and the query carries on as an ordinary job.
+    def run_fast_query(self, query, parameters=None, max_results=BQ_FAST_QUERY_MAX_RESULTS):
+        request = {
+            'query': query,
+            'useLegacySql': False,
+            'timeoutMs': BQ_FAST_QUERY_TIMEOUT_MS,
+            'maxResults': max_results,
+            # Makes the request safe to retry: BigQuery won't run the same request ID twice
+            'requestId': str(uuid4())
+        }
+        if parameters:
+            request['parameterMode'] = 'NAMED'
+            request['queryParameters'] = parameters
+
+        estimate = None
+        if current_budget_user():
+            estimate = admit_query_(query, parameters, self.dry_run_bytes, current_budget_user())
+
+        response = self.bq_service.jobs().query(projectId=self.executing_project, body=request).execute(num_retries=5)
+
+        track_admitted_job(response['jobReference']['jobId'], estimate)
+        if response.get('jobComplete', False):
+            FAST_QUERY_STATS['completed'] += 1
+            record_job_bytes({
+                'jobReference': response['jobReference'],
+                'status': {'state': 'DONE'},
+                'statistics': {'query': {'totalBytesProcessed': response.get('totalBytesProcessed', 0)}}
+            })
+        else:
+            FAST_QUERY_STATS['fell_back'] += 1
+        return response
+
     # Runs a basic, optionally parameterized query
     # If self.project_id, self.dataset_id, and self.table_id are set they will be used as the destination table for
     # the query WRITE_DISPOSITION is assumed to be for an empty table unless specified
     def execute_query(self, query, parameters=None, write_disposition='WRITE_EMPTY',
                       cost_est=False, with_schema=False, paginated=False, no_results=False):
 
-        query_job = self.insert_bq_query_job(query,parameters,write_disposition,cost_est)
+        # Queries without a destination whose results are wanted can take the jobs.query fast path
+        if BQ_FAST_QUERY and not cost_est and not no_results and not (self.project_id and self.dataset_id and self.table_id):
+            try:
+                response = self.run_fast_query(
+                    query, parameters, settings.MAX_BQ_RECORD_RESULT if paginated else BQ_FAST_QUERY_MAX_RESULTS
+                )
+            except HttpError as e:
+                # jobs.query reports a failed query as an error response, where a job would just have failed
+                logger.error("[ERROR] During query: {}".format(str(e)))
+                logger.error("[ERROR] Error'd out query: {}".format(query))
+                return None
+            job_ref = self._job_ref(response)
+            if response.get('jobComplete', False):
+                logger.info("[STATUS] Query {} done within the jobs.query timeout.".format(job_ref['jobId']))
+                if paginated:
+                    return self.fetch_job_result_page(job_ref, first_page=response)
+                if with_schema:
+                    return self.fetch_job_results_with_schema(job_ref, first_page=response)
+                return self.fetch_job_results(job_ref, first_page=response)
+            logger.debug("[STATUS] Query {} still running after {}ms, waiting on the job.".format(
+                job_ref['jobId'], BQ_FAST_QUERY_TIMEOUT_MS))
+            query_job = {'jobReference': response['jobReference']}
+        else:
+            query_job = self.insert_bq_query_job(query,parameters,write_disposition,cost_est)
         logger.debug("query_job: {}".format(query_job))
 
         job_id = query_job['jobReference']['jobId']
@@ -304,6 +387,7 @@ class BigQuerySupport(BigQueryABC):
                 }
 
         job_is_done = self.await_job_is_done(query_job)
+        record_job_bytes(job_is_done)
 
         # Parse the final disposition
         if no_results:
@@ -336,19 +420,30 @@ class BigQuerySupport(BigQueryABC):
 
         return query_results
 
-    # Check for a job's status for the maximum number of attempts, return the final resulting response
-    def await_job_is_done(self, query_job):
-        done = self.job_is_done(query_job)
-        retries = 0
-
-        while not done and retries < BQ_ATTEMPT_MAX:
-            retries += 1
-            sleep(1)
-            done = self.job_is_done(query_job)
-
-        return self.bq_service.jobs().get(
-            projectId=self.executing_project, jobId=query_job['jobReference']['jobId']
-        ).execute(num_retries=5)
+    def _job_ref(self, query_job):
+        job_ref = {'projectId': self.executing_project, 'jobId': query_job['jobReference']['jobId']}
+        if query_job['jobReference'].get('location', None):
+            job_ref['location'] = query_job['jobReference']['location']
+        return job_ref
+
+    # Wait for a job to finish, or for the deadline (in seconds) to pass, and return the final resulting response
+    def await_job_is_done(self, query_job, deadline=None):
+        return wait_for_job(self.bq_service, self._job_ref(query_job), deadline)
+
+    # Wait for a set of query jobs to finish, or for the deadline (in seconds) to pass, long-polling one outstanding
+    # job at a time and re-checking the whole set whenever it returns
+    # returns: dict of <key>: <True|False>
+    def await_job_set_is_done(self, query_jobs, deadline=None):
+        waiter = JobWaiter(self.bq_service, deadline)
+        done = {key: False for key in query_jobs}
+        while True:
+            done.update(self.job_set_is_done({key: query_jobs[key] for key in done if not done[key]}))
+            pending = [key for key in done if not done[key]]
+            if not len(pending) or waiter.expired():
+                break
+            waiter.pause(self._job_ref(query_jobs[pending[0]]))
+        waiter.finish(all(done.values()))
+        return done
 
     # Check to see if query job is done
     def job_is_done(self, query_job):
@@ -357,11 +452,63 @@ class BigQuerySupport(BigQueryABC):
 
         return job_is_done and job_is_done['status']['state'] == 'DONE'
 
+    # Fetch the current job resource for each of a set of jobs, using batched requests on this instance's client
+    # rather than one request per job. Jobs whose part of a batch fails, or every job in a batch which can't be sent,
+    # are checked with individual requests instead.
+    #
+    # query_jobs: dict of <key>: <job resource or {'jobReference': {'jobId': <job ID>}}>
+    # returns: dict of <key>: <job resource>, or None for any job whose status couldn't be retrieved
+    def get_job_set_status(self, query_jobs):
+        statuses = {key: None for key in query_jobs}
+        keys = list(query_jobs.keys())
+
+        def _job_get(key):
+            return self.bq_service.jobs().get(
+                projectId=self.executing_project, jobId=query_jobs[key]['jobReference']['jobId']
+            )
+
+        def _record_status(request_id, response, exception):
+            if exception is not None:
+                logger.warning("[WARNING] Couldn't retrieve the status of job {}: {}".format(
+                    query_jobs[keys[int(request_id)]]['jobReference']['jobId'], str(exception)))
+            else:
+                statuses[keys[int(request_id)]] = response
+
+        for start in range(0, len(keys), BQ_POLL_BATCH_SIZE):
+            chunk = range(start, min(start+BQ_POLL_BATCH_SIZE, len(keys)))
+            try:
+                batch = self.bq_service.new_batch_http_request(callback=_record_status)
+                for i in chunk:
+                    batch.add(_job_get(keys[i]), request_id=str(i))
+                batch.execute()
+            except Exception as e:
+                logger.warning("[WARNING] Batched job status request failed, checking jobs individually: {}".format(str(e)))
+            for i in chunk:
+                if statuses[keys[i]] is None:
+                    try:
+                        statuses[keys[i]] = _job_get(keys[i]).execute(num_retries=5)
+                    except Exception as e:
+                        _record_status(str(i), None, e)
+
+        for status in statuses.values():
+            record_job_bytes(status)
+
+        return statuses
+
+    # Check to see which of a set of query jobs are done
+    # returns: dict of <key>: <True|False>
+    def job_set_is_done(self, query_jobs):
+        statuses = self.get_job_set_status(query_jobs)
+        done = {key: bool(statuses[key] and statuses[key]['status']['state'] == 'DONE') for key in statuses}
+        logger.debug("[STATUS] {} of {} jobs done.".format(len([x for x in done if done[x]]), len(done)))
+        return done
+
     # TODO: shim until we have time to rework this into a single method
     # Fetch the results of a job based on the reference provided
-    def fetch_job_result_page(self, job_ref, page_token=None, maxResults=settings.MAX_BQ_RECORD_RESULT):
+    # first_page: a page already in hand (eg. a jobs.query response) to use instead of fetching one
+    def fetch_job_result_page(self, job_ref, page_token=None, maxResults=settings.MAX_BQ_RECORD_RESULT, first_page=None):
 
-        page = self.bq_service.jobs().getQueryResults(
+        page = first_page or self.bq_service.jobs().getQueryResults(
             pageToken=page_token,
             maxResults=maxResults,
             **job_ref).execute(num_retries=2)
@@ -379,16 +526,17 @@ class BigQuerySupport(BigQueryABC):
 
     # TODO: shim until we have time to rework this into a single method
     # Fetch the results of a job based on the reference provided
-    def fetch_job_results_with_schema(self, job_ref):
+    def fetch_job_results_with_schema(self, job_ref, first_page=None):
         result = []
         page_token = None
         schema = None
         totalFound = None
 
         while True:
-            page = self.bq_service.jobs().getQueryResults(
+            page = first_page or self.bq_service.jobs().getQueryResults(
                 pageToken=page_token,
                 **job_ref).execute(num_retries=2)
+            first_page = None
             if not schema:
                 schema = page['schema']
             if int(page['totalRows']) == 0:
@@ -411,16 +559,72 @@ class BigQuerySupport(BigQueryABC):
 
         return {'results': result, 'schema': schema, 'totalFound': totalFound}
 
+    # Generator over the raw rows of a job's results, in order. After the first page (which gives the total row count)
+    # up to max_parallel further pages are fetched concurrently by startIndex, each on its own thread's client. Pages
+    # are only requested up to max_buffered_pages ahead of the row being consumed, so a slow consumer (eg. a CSV
+    # writer) holds at most that many pages in memory.
+    def iter_job_results(self, job_ref, page_size=BQ_PAGE_SIZE, max_parallel=BQ_PAGE_FETCH_WORKERS,
+                         max_buffered_pages=None):
+        max_buffered_pages = max(max_buffered_pages or max_parallel * 2, max_parallel)
+        first = self.bq_service.jobs().getQueryResults(maxResults=page_size, **job_ref).execute(num_retries=2)
+        total = int(first['totalRows'])
+        rows = first.get('rows', [])
+        for row in rows:
+            yield row
+        if len(rows) >= total:
+            return
+
+        def _fetch(start, count):
+            page = get_bigquery_service().jobs().getQueryResults(
+                startIndex=start, maxResults=count, **job_ref).execute(num_retries=2)
+            return page.get('rows', [])
+
+        starts = iter(range(len(rows), total, page_size))
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=max_parallel)
+
+        def _fill():
+            while len(pending) < max_buffered_pages:
+                start = next(starts, None)
+                if start is None:
+                    break
+                count = min(page_size, total - start)
+                pending.append((start, count, executor.submit(_fetch, start, count),))
+
+        try:
+            _fill()
+            while len(pending):
+                start, count, page = pending.popleft()
+                page_rows = page.result()
+                _fill()
+                for row in page_rows:
+                    yield row
+                # Pages can come back short if they hit the response size limit; pick up the rest in line
+                fetched = len(page_rows)
+                while fetched < count:
+                    page_rows = _fetch(start + fetched, count - fetched)
+                    if not len(page_rows):
+                        logger.warning("[WARNING] Job {} returned no rows at index {} of {}.".format(
+                            job_ref['jobId'], start + fetched, total))
+                        break
+                    for row in page_rows:
+                        yield row
+                    fetched += len(page_rows)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
     # Fetch the results of a job based on the reference provided
-    def fetch_job_results(self, job_ref):
+    # first_page: the first page of results, if already in hand (eg. a jobs.query response)
+    def fetch_job_results(self, job_ref, first_page=None):
         logger.info(str(job_ref))
         result = []
         page_token = None
 
         while True:
-            page = self.bq_service.jobs().getQueryResults(
+            page = first_page or self.bq_service.jobs().getQueryResults(
                 pageToken=page_token,
                 **job_ref).execute(num_retries=2)
+            first_page = None
 
             if int(page['totalRows']) == 0:
                 break
@@ -429,6 +633,8 @@ class BigQuerySupport(BigQueryABC):
             result.extend(rows)
 
             if len(result) > settings.MAX_BQ_RECORD_RESULT:
+                logger.warning("[WARNING] Results of job {} truncated at {} of {} rows; use stream_job_results ".format(
+                    job_ref['jobId'], len(result), page['totalRows']) + "to read all of them.")
                 break
 
             page_token = page.get('pageToken')
@@ -437,6 +643,33 @@ class BigQuerySupport(BigQueryABC):
 
         return result
 
+    # Generator over every row of a finished query job's results, without the MAX_BQ_RECORD_RESULT limit. Reads the
+    # job's destination table through the Storage Read API in parallel Arrow streams when that's available (or a
+    # single stream, if the query is ordered), yielding dicts of typed values (or pyarrow.RecordBatch objects, with
+    # as_batches). Otherwise pages through jobs.getQueryResults, yielding dicts of the API's string values.
+    def stream_job_results(self, job_ref, as_batches=False, selected_fields=None):
+        if storage_read_available():
+            table, ordered = get_job_destination(self.bq_service, job_ref)
+            # Parallel streams interleave their rows, which would lose an ORDER BY
+            reader = BigQueryStorageReader(max_streams=1 if ordered else BQ_STORAGE_READ_STREAMS,
+                                           executing_project=self.executing_project)
+            if as_batches:
+                for batch in reader.iter_batches(table, selected_fields):
+                    yield batch
+            else:
+                for row in reader.iter_rows(table, selected_fields):
+                    yield row
+            return
+        if as_batches:
+            raise Exception("Arrow record batches require the BigQuery Storage Read API and pyarrow.")
+        schema = self.bq_service.jobs().getQueryResults(maxResults=0, **job_ref).execute(num_retries=2)['schema']
+        names = [x['name'] for x in schema['fields']]
+        for row in self.iter_job_results(job_ref):
+            record = {names[i]: cell['v'] for i, cell in enumerate(row['f'])}
+            if selected_fields:
+                record = {x: record[x] for x in selected_fields}
+            yield record
+
     def fetch_job_resource(self, job_ref):
         return self.bq_service.jobs().get(**job_ref).execute(num_retries=5)
 
@@ -449,10 +682,32 @@ class BigQuerySupport(BigQueryABC):
         return bqs._streaming_insert(rows)
 
     # Execute a query, optionally parameterized, and fetch its results
+    #
+    # cache_versions: if provided, the IDs of the data versions the query reads; the results are then cached under
+    #   the query, its parameters, and these versions. Paginated and no_results calls are never cached, as their
+    #   results point back at the job.
+    # immutable: True if every version read is inactive, so the results can be cached without an expiry
     @classmethod
-    def execute_query_and_fetch_results(cls, query, parameters=None, with_schema=False, paginated=False, no_results=False):
-        bqs = cls(None, None, None)
-        return bqs.execute_query(query, parameters, with_schema=with_schema, paginated=paginated, no_results=no_results)
+    def execute_query_and_fetch_results(cls, query, parameters=None, with_schema=False, paginated=False, no_results=False,
+                                        cache_versions=None, immutable=False):
+        def _execute():
+            bqs = cls(None, None, None)
+            return bqs.execute_query(query, parameters, with_schema=with_schema, paginated=paginated,
+                                     no_results=no_results)
+
+        if cache_versions is None or paginated or no_results:
+            return _execute()
+        return cached_bq_result(
+            bq_result_cache_key(query, parameters, cache_versions, with_schema), _execute, immutable
+        )
+
+    # Decode raw v2 result rows into tuples (or namedtuples or dicts, per row_type) of Python-typed values, using a
+    # decoder compiled for their schema
+    #
+    # schema: the result schema, eg. from a with_schema fetch, or built with row_decoder.make_result_schema
+    @staticmethod
+    def decode_rows(rows, schema, row_type='tuple'):
+        return get_row_decoder(schema, row_type).decode_rows(rows or [])
 
     @classmethod
     # Execute a query, optionally parameterized, to be saved on a temp table
@@ -473,12 +728,25 @@ class BigQuerySupport(BigQueryABC):
         bqs = cls(None, None, None)
         return bqs.job_is_done(query_job)
 
+    # Check the status of a set of BQ jobs, keyed however the caller likes
+    @classmethod
+    def check_job_set_is_done(cls, query_jobs):
+        bqs = cls(None, None, None)
+        return bqs.job_set_is_done(query_jobs)
+
     # Do a 'dry run' query, which estimates the cost
     @classmethod
     def estimate_query_cost(cls, query, parameters=None):
         bqs = cls(None, None, None)
         return bqs.execute_query(query, parameters, cost_est=True)
 
+    # Admit a query run on a user's behalf elsewhere (eg. SQL handed out through the API), without running it here;
+    # raises admission.QueryBudgetExceeded if it doesn't fit
+    @classmethod
+    def admit_query(cls, query, parameters=None, user=None):
+        bqs = cls(None, None, None)
+        return admit_query_(query, parameters, bqs.dry_run_bytes, user)
+
     # Given a job reference, fetch out the results
     @classmethod
     def get_job_results(cls, job_reference):
@@ -488,18 +756,24 @@ class BigQuerySupport(BigQueryABC):
     # Given a job reference for a running job, await the completion,
     # then fetch and return the results
     @classmethod
-    def wait_for_done(cls, query_job):
+    def wait_for_done(cls, query_job, deadline=None):
         bqs = cls(None, None, None)
-        return bqs.await_job_is_done(query_job)
+        return bqs.await_job_is_done(query_job, deadline)
 
     # Given a job reference for a running job, await the completion,
     # then fetch and return the results
     @classmethod
-    def wait_for_done_and_get_results(cls, query_job):
+    def wait_for_done_and_get_results(cls, query_job, deadline=None):
         bqs = cls(None, None, None)
-        check_done = bqs.await_job_is_done(query_job)
+        check_done = bqs.await_job_is_done(query_job, deadline)
         return bqs.fetch_job_results(check_done['jobReference'])
 
+    # Given a job reference, stream out all of the results (see stream_job_results)
+    @classmethod
+    def get_job_results_stream(cls, job_reference, as_batches=False, selected_fields=None):
+        bqs = cls(None, None, None)
+        return bqs.stream_job_results(job_reference, as_batches, selected_fields)
+
     # Given a BQ service and a job reference, fetch out the results
     @classmethod
     def get_job_resource(cls, job_id, project_id):
@@ -535,7 +809,7 @@ class BigQuerySupport(BigQueryABC):
     
     # Method for submitting a group of jobs and awaiting the results of the whole set
     @classmethod
-    def insert_job_batch_and_get_results(cls, query_set):
+    def insert_job_batch_and_get_results(cls, query_set, deadline=None):
         logger.info(str(query_set))
         bqs = cls(None, None, None)
         submitted_job_set = {}
@@ -544,25 +818,13 @@ class BigQuerySupport(BigQueryABC):
             query['job_id'] = job_obj['jobReference']['jobId']
             submitted_job_set[job_obj['jobReference']['jobId']] = job_obj
 
-        not_done = True
-        still_checking = True
-        num_retries = 0
-
-        while still_checking and not_done:
-            not_done = False
-            for job in submitted_job_set:
-                if not BigQuerySupport.check_job_is_done(submitted_job_set[job]):
-                    not_done = True
-            if not_done:
-                sleep(1)
-                num_retries += 1
-                still_checking = (num_retries < settings.BQ_MAX_ATTEMPTS)
-
-        if not_done:
+        job_done = bqs.await_job_set_is_done(submitted_job_set, deadline)
+
+        if not all(job_done.values()):
             logger.warn("[WARNING] Not all of the queries completed!")
 
         for query in query_set:
-            if bqs.job_is_done(submitted_job_set[query['job_id']]):
+            if job_done.get(query['job_id'], False):
                 query['bq_results'] = bqs.fetch_job_results(submitted_job_set[query['job_id']]['jobReference'])
                 query['result_schema'] = BigQuerySupport.get_result_schema(submitted_job_set[query['job_id']]['jobReference'])
             else:
@@ -54,6 +54,6 @@ class BigQueryCohortSupport(BigQuerySupport):
         for sample in samples:
             rows.append(self._build_row(cohort_id, case_barcode=sample['case_barcode'], sample_barcode=sample['sample_barcode'], project_id=sample['project_id']))
 
-        response = self._streaming_insert(rows)
+        response = self._bulk_insert(rows)
 
         return response
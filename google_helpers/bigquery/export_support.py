@@ -16,15 +16,20 @@
 
 from builtins import str
 from copy import deepcopy
+import io
+import re
+import gzip
 import logging
 import datetime
-from time import sleep
 from django.conf import settings
 from uuid import uuid4
 from google_helpers.bigquery.service import get_bigquery_service
 from google_helpers.storage_service import get_storage_resource
 from google_helpers.bigquery.abstract import BigQueryExportABC
 from google_helpers.bigquery.bq_support import BigQuerySupport
+from google_helpers.bigquery.job_waiter import wait_for_job
+from google_helpers.bigquery.admission import admit_query, current_budget_user, track_admitted_job
+from googleapiclient.http import MediaIoBaseUpload
 
 BQ_ATTEMPT_MAX = 10
 
@@ -32,6 +37,24 @@ logger = logging.getLogger('main_logger')
 
 MAX_INSERT = settings.MAX_BQ_INSERT
 
+# Extract to wildcard-sharded objects by default, so BigQuery can write the shards in parallel
+BQ_EXTRACT_SHARDED = getattr(settings, 'BQ_EXTRACT_SHARDED', False)
+# When shards are composed into a single object, keep the shards as well
+BQ_EXTRACT_KEEP_SHARDS = getattr(settings, 'BQ_EXTRACT_KEEP_SHARDS', False)
+
+# Compression codecs each extract format supports; the first is used if none is given
+EXTRACT_COMPRESSION = {
+    'CSV': ['GZIP', 'NONE'],
+    'NEWLINE_DELIMITED_JSON': ['GZIP', 'NONE'],
+    'AVRO': ['SNAPPY', 'DEFLATE', 'NONE'],
+    'PARQUET': ['ZSTD', 'SNAPPY', 'GZIP', 'NONE']
+}
+# Formats whose shards are plain concatenable text (gzip members concatenate into a valid gzip stream); AVRO and
+# PARQUET files are self-contained containers and can't be composed
+COMPOSABLE_FORMATS = ['CSV', 'NEWLINE_DELIMITED_JSON']
+# Most source objects a single GCS compose request accepts
+GCS_COMPOSE_MAX_SOURCES = 32
+
 FILE_LIST_EXPORT_SCHEMA = {
     'fields': [
          {
@@ -96,32 +119,251 @@ class BigQueryExport(BigQueryExportABC, BigQuerySupport):
         }
 
     def _streaming_insert(self, rows):
-        bigquery_service = get_bigquery_service()
-        table_data = bigquery_service.tabledata()
-
-        index = 0
-        next = 0
-
         logger.info("[STATUS] Beginning row stream...")
-        while index < len(rows) and next is not None:
-            next = MAX_INSERT+index
-            body = None
-            if next > len(rows):
-                next = None
-                body = self._build_request_body_from_rows(rows[index:])
-            else:
-                body = self._build_request_body_from_rows(rows[index:next])
-
-            response = table_data.insertAll(projectId=self.project_id,
-                                            datasetId=self.dataset_id,
-                                            tableId=self.table_id,
-                                            body=body).execute()
-            index = next
+        response = super(BigQueryExport, self)._streaming_insert(rows)
         logger.info("[STATUS] ...done.")
 
         return response
 
-    def _table_to_gcs(self, file_format, dataset_and_table, export_type, table_job_id=None):
+    # Check an extract format and compression pair, filling in the format's default compression if none is given;
+    # returns the compression to use
+    @staticmethod
+    def _extract_compression(file_format, compression=None):
+        if file_format not in EXTRACT_COMPRESSION:
+            raise Exception("Unsupported extract format: {}".format(file_format))
+        if compression is None:
+            return EXTRACT_COMPRESSION[file_format][0]
+        if compression not in EXTRACT_COMPRESSION[file_format]:
+            raise Exception("Compression {} is not supported for {} extracts; use one of {}.".format(
+                compression, file_format, ", ".join(EXTRACT_COMPRESSION[file_format])))
+        return compression
+
+    # Shard names for this export's file_name: BigQuery replaces the wildcard with a zero-padded 12-digit shard
+    # number, eg. manifest.csv.gz -> manifest-000000000000.csv.gz. Returns (wildcard object name, shard name pattern).
+    def _shard_names(self):
+        path, _, base = self.file_name.rpartition('/')
+        stem, dot, ext = base.partition('.')
+        prefix = "{}{}{}-".format(path, '/' if path else '', stem)
+        return "{}*{}{}".format(prefix, dot, ext), re.compile("^{}\\d{{12}}{}$".format(re.escape(prefix), re.escape(dot + ext)))
+
+    # List the shards an extract wrote, in order, as [{'uri', 'name', 'size'}]
+    def _list_shards(self, storage):
+        wildcard, pattern = self._shard_names()
+        shards = []
+        page_token = None
+        while True:
+            response = storage.objects().list(
+                bucket=self.bucket_path, prefix=wildcard.split('*')[0], pageToken=page_token, fields="items(name,size),nextPageToken"
+            ).execute(num_retries=5)
+            for item in response.get('items', []):
+                if pattern.match(item['name']):
+                    shards.append({
+                        'uri': 'gs://{}/{}'.format(self.bucket_path, item['name']),
+                        'name': item['name'],
+                        'size': int(item['size'])
+                    })
+            page_token = response.get('nextPageToken', None)
+            if not page_token:
+                break
+        return sorted(shards, key=lambda x: x['name'])
+
+    # Compose the named objects, in order, into self.file_name. A compose request takes at most 32 sources, so larger
+    # sets are composed in rounds, through intermediate objects which are deleted afterwards. Returns the final
+    # object's metadata.
+    def _compose_objects(self, storage, names, content_type):
+        intermediates = []
+        round_num = 0
+        try:
+            while len(names) > GCS_COMPOSE_MAX_SOURCES:
+                round_num += 1
+                composed = []
+                for i in range(0, len(names), GCS_COMPOSE_MAX_SOURCES):
+                    target = "{}.compose-{}-{}".format(self.file_name, round_num, i // GCS_COMPOSE_MAX_SOURCES)
+                    storage.objects().compose(destinationBucket=self.bucket_path, destinationObject=target, body={
+                        'sourceObjects': [{'name': x} for x in names[i:i+GCS_COMPOSE_MAX_SOURCES]],
+                        'destination': {'contentType': content_type}
+                    }).execute(num_retries=5)
+                    composed.append(target)
+                intermediates.extend(composed)
+                names = composed
+            return storage.objects().compose(destinationBucket=self.bucket_path, destinationObject=self.file_name, body={
+                'sourceObjects': [{'name': x} for x in names],
+                'destination': {'contentType': content_type}
+            }).execute(num_retries=5)
+        finally:
+            self._delete_objects(storage, intermediates)
+
+    def _delete_objects(self, storage, names):
+        for name in names:
+            try:
+                storage.objects().delete(bucket=self.bucket_path, object=name).execute(num_retries=5)
+            except Exception as e:
+                logger.warning("[WARNING] Unable to delete gs://{}/{}: {}".format(self.bucket_path, name, str(e)))
+
+    # Upload a CSV header line for the given table, to be composed ahead of the (headerless) shards
+    def _upload_csv_header(self, storage, bq_service, dataset_and_table, compression):
+        table = bq_service.tables().get(
+            projectId=self.project_id, datasetId=dataset_and_table['dataset_id'], tableId=dataset_and_table['table_id']
+        ).execute(num_retries=5)
+        header = (",".join([x['name'] for x in table['schema']['fields']]) + "\n").encode('utf-8')
+        if compression == 'GZIP':
+            header = gzip.compress(header)
+        name = "{}.header".format(self.file_name)
+        storage.objects().insert(bucket=self.bucket_path, name=name, media_body=MediaIoBaseUpload(
+            io.BytesIO(header), mimetype='application/octet-stream')).execute(num_retries=5)
+        return name
+
+    # Build the manifest of a finished sharded extract, composing the shards into self.file_name first if asked to
+    def _finish_sharded_extract(self, storage, bq_service, dataset_and_table, file_format, compression, compose):
+        shards = self._list_shards(storage)
+        manifest = {
+            'format': file_format,
+            'compression': compression,
+            'shards': [{'uri': x['uri'], 'size': x['size']} for x in shards],
+            'total_size': sum([x['size'] for x in shards]),
+            'composed_uri': None
+        }
+        if compose and len(shards):
+            sources = [x['name'] for x in shards]
+            header = None
+            if file_format == 'CSV':
+                header = self._upload_csv_header(storage, bq_service, dataset_and_table, compression)
+                sources.insert(0, header)
+            try:
+                composed = self._compose_objects(
+                    storage, sources, 'text/csv' if file_format == 'CSV' else 'application/x-ndjson')
+            finally:
+                if header:
+                    self._delete_objects(storage, [header])
+            manifest['composed_uri'] = 'gs://{}/{}'.format(self.bucket_path, self.file_name)
+            manifest['total_size'] = int(composed['size'])
+            if not BQ_EXTRACT_KEEP_SHARDS:
+                self._delete_objects(storage, [x['name'] for x in shards])
+                manifest['shards'] = [{'uri': manifest['composed_uri'], 'size': manifest['total_size']}]
+        return manifest
+
+    # Start an extract of a table to GCS, without waiting for it; returns the extract job's ID. See _table_to_gcs for
+    # compression, sharded and compose.
+    def start_extract(self, file_format, dataset_and_table, compression=None, sharded=None, compose=False):
+        sharded = BQ_EXTRACT_SHARDED if sharded is None else sharded
+        compression = self._extract_compression(file_format, compression)
+        if compose and file_format not in COMPOSABLE_FORMATS:
+            raise Exception("{} extracts can't be composed into a single object.".format(file_format))
+
+        job_id = str(uuid4())
+
+        export_config = {
+            'jobReference': {
+                'projectId': self.project_id,
+                'jobId': job_id
+            },
+            'configuration': {
+                'extract': {
+                    'sourceTable': {
+                        'projectId': self.project_id,
+                        'datasetId': dataset_and_table['dataset_id'],
+                        'tableId': dataset_and_table['table_id']
+                    },
+                    'destinationUris': ['gs://{}/{}'.format(
+                        self.bucket_path, self._shard_names()[0] if sharded else self.file_name)],
+                    'destinationFormat': file_format,
+                    'compression': compression
+                }
+            }
+        }
+        if file_format == 'AVRO':
+            # Write DATE, TIMESTAMP etc. as Avro logical types rather than their underlying strings and longs
+            export_config['configuration']['extract']['useAvroLogicalTypes'] = True
+        elif file_format == 'CSV' and sharded and compose:
+            # Every shard would carry its own header; one is composed in ahead of them instead
+            export_config['configuration']['extract']['printHeader'] = False
+
+        get_bigquery_service().jobs().insert(
+            projectId=settings.BIGQUERY_PROJECT_ID,
+            body=export_config).execute(num_retries=5)
+
+        return job_id
+
+    # Result of a finished extract job started by start_extract, after checking what it wrote to the bucket
+    def extract_result(self, job, file_format, dataset_and_table, export_type, compression=None, sharded=None,
+                       compose=False):
+        sharded = BQ_EXTRACT_SHARDED if sharded is None else sharded
+        compression = self._extract_compression(file_format, compression)
+
+        result = {
+            'status': None,
+            'message': None
+        }
+
+        if 'status' in job and 'errors' in job['status']:
+            msg = "Export of {} to GCS bucket {} was unsuccessful, reason: {}".format(
+                export_type, self.bucket_path, job['status']['errors'][0]['message'])
+            logger.error("[ERROR] {}".format(msg))
+            result['status'] = 'error'
+            result['message'] = "Unable to export {} to bucket {}--please contact the administrator.".format(
+                export_type, self.bucket_path)
+        elif sharded:
+            manifest = self._finish_sharded_extract(
+                get_storage_resource(), get_bigquery_service(), dataset_and_table, file_format, compression, compose)
+            if manifest['total_size'] > 0:
+                logger.info("[STATUS] Successfully exported {} into {} GCS object(s) under gs://{}/".format(
+                    export_type, len(manifest['shards']), self.bucket_path))
+                result['status'] = 'success'
+                result['message'] = "{}MB".format(str(round((float(manifest['total_size'])/1000000),2)))
+                result['manifest'] = manifest
+            else:
+                msg = "Export of {} to gs://{}/{} wrote no data".format(
+                    export_type, self.bucket_path, self._shard_names()[0])
+                logger.warning("[WARNING] {}.".format(msg))
+                result['status'] = 'error'
+                result['message'] = msg + "--please contact the administrator."
+        else:
+            # Check the file
+            exported_file = get_storage_resource().objects().get(bucket=self.bucket_path, object=self.file_name).execute()
+            if not exported_file:
+                msg = "Export file {}/{} not found".format(self.bucket_path, self.file_name)
+                logger.error("[ERROR] ".format({msg}))
+                if 'errors' in job:
+                    logger.error('[ERROR] Errors seen: {}'.format(job['errors'][0]['message']))
+                result['status'] = 'error'
+                result['message'] = "Unable to export {} to file {}/{}--please contact the administrator.".format(
+                    export_type, self.bucket_path, self.file_name)
+            else:
+                if int(exported_file['size']) > 0:
+                    logger.info("[STATUS] Successfully exported {} into GCS file gs://{}/{}".format(export_type,
+                                                                                                  self.bucket_path,
+                                                                                                  self.file_name))
+                    result['status'] = 'success'
+                    result['message'] = "{}MB".format(str(round((float(exported_file['size'])/1000000),2)))
+                    result['manifest'] = {
+                        'format': file_format,
+                        'compression': compression,
+                        'shards': [{'uri': 'gs://{}/{}'.format(self.bucket_path, self.file_name),
+                                    'size': int(exported_file['size'])}],
+                        'total_size': int(exported_file['size']),
+                        'composed_uri': None
+                    }
+                else:
+                    msg = "File gs://{}/{} created, but appears empty. Export of {} may not have succeeded".format(
+                        export_type,
+                        self.bucket_path,
+                        self.file_name
+                    )
+                    logger.warn("[WARNING] {}.".format(msg))
+                    result['status'] = 'error'
+                    result['message'] = msg + "--please contact the administrator."
+
+        return result
+
+    # Extract a table to GCS.
+    #
+    # compression: the codec to use--GZIP or NONE for CSV and NEWLINE_DELIMITED_JSON, SNAPPY, DEFLATE or NONE for AVRO,
+    #   ZSTD, SNAPPY, GZIP or NONE for PARQUET; defaults to the first of those for the format
+    # sharded: extract to wildcard-sharded objects alongside file_name, which BigQuery writes in parallel (and requires
+    #   for tables over 1GB); the result then includes a 'manifest' of the shards' URIs and sizes
+    # compose: compose the shards into the single object file_name (CSV and NEWLINE_DELIMITED_JSON only)
+    def _table_to_gcs(self, file_format, dataset_and_table, export_type, table_job_id=None, deadline=None,
+                      compression=None, sharded=None, compose=False):
 
         bq_service = get_bigquery_service()
 
@@ -133,12 +375,9 @@ class BigQueryExport(BigQueryExportABC, BigQuerySupport):
         # presence of a table_job_id means the export query was still running when this
         # method was called; give it another round of checks
         if table_job_id:
-            job_is_done = bq_service.jobs().get(projectId=settings.BIGQUERY_PROJECT_ID, jobId=table_job_id).execute()
-            retries = 0
-            while (job_is_done and not job_is_done['status']['state'] == 'DONE') and retries < BQ_ATTEMPT_MAX:
-                retries += 1
-                sleep(1)
-                job_is_done = bq_service.jobs().get(projectId=settings.BIGQUERY_PROJECT_ID, jobId=table_job_id).execute()
+            job_is_done = wait_for_job(
+                bq_service, {'projectId': settings.BIGQUERY_PROJECT_ID, 'jobId': table_job_id}, deadline
+            )
 
             if job_is_done and not job_is_done['status']['state'] == 'DONE':
                 logger.debug(str(job_is_done))
@@ -153,79 +392,17 @@ class BigQueryExport(BigQueryExportABC, BigQuerySupport):
                     'table_id': job_is_done['configuration']['query']['destinationTable']['tableId']
                 }
 
-        job_id = str(uuid4())
+        job_id = self.start_extract(file_format, dataset_and_table, compression, sharded, compose)
 
-        export_config = {
-            'jobReference': {
-                'projectId': self.project_id,
-                'jobId': job_id
-            },
-            'configuration': {
-                'extract': {
-                    'sourceTable': {
-                        'projectId': self.project_id,
-                        'datasetId': dataset_and_table['dataset_id'],
-                        'tableId': dataset_and_table['table_id']
-                    },
-                    'destinationUris': ['gs://{}/{}'.format(self.bucket_path, self.file_name)],
-                    'destinationFormat': file_format,
-                    'compression': 'GZIP'
-                }
-            }
-        }
-
-        export_job = bq_service.jobs().insert(
-            projectId=settings.BIGQUERY_PROJECT_ID,
-            body=export_config).execute(num_retries=5)
-
-        job_is_done = bq_service.jobs().get(projectId=settings.BIGQUERY_PROJECT_ID,
-                                            jobId=job_id).execute()
-
-        retries = 0
-
-        while (job_is_done and not job_is_done['status']['state'] == 'DONE') and retries < BQ_ATTEMPT_MAX:
-            retries += 1
-            sleep(1)
-            job_is_done = bq_service.jobs().get(projectId=settings.BIGQUERY_PROJECT_ID, jobId=job_id).execute()
+        job_is_done = wait_for_job(
+            bq_service, {'projectId': settings.BIGQUERY_PROJECT_ID, 'jobId': job_id}, deadline, job_type='extract'
+        )
 
         logger.debug("[STATUS] extraction job_is_done: {}".format(str(job_is_done)))
 
         if job_is_done and job_is_done['status']['state'] == 'DONE':
-            if 'status' in job_is_done and 'errors' in job_is_done['status']:
-                msg = "Export of {} to GCS bucket {} was unsuccessful, reason: {}".format(
-                    export_type, self.bucket, job_is_done['status']['errors'][0]['message'])
-                logger.error("[ERROR] {}".format(msg))
-                result['status'] = 'error'
-                result['message'] = "Unable to export {} to bucket {}--please contact the administrator.".format(
-                    export_type, self.bucket)
-            else:
-                # Check the file
-                exported_file = get_storage_resource().objects().get(bucket=self.bucket_path, object=self.file_name).execute()
-                if not exported_file:
-                    msg = "Export file {}/{} not found".format(self.bucket_path, self.file_name)
-                    logger.error("[ERROR] ".format({msg}))
-                    export_result = bq_service.jobs().get(projectId=settings.BIGQUERY_PROJECT_ID, jobId=job_id).execute()
-                    if 'errors' in export_result:
-                        logger.error('[ERROR] Errors seen: {}'.format(export_result['errors'][0]['message']))
-                    result['status'] = 'error'
-                    result['message'] = "Unable to export {} to file {}/{}--please contact the administrator.".format(
-                        export_type, self.bucket_path, self.file_name)
-                else:
-                    if int(exported_file['size']) > 0:
-                        logger.info("[STATUS] Successfully exported {} into GCS file gs://{}/{}".format(export_type,
-                                                                                                      self.bucket_path,
-                                                                                                      self.file_name))
-                        result['status'] = 'success'
-                        result['message'] = "{}MB".format(str(round((float(exported_file['size'])/1000000),2)))
-                    else:
-                        msg = "File gs://{}/{} created, but appears empty. Export of {} may not have succeeded".format(
-                            export_type,
-                            self.bucket_path,
-                            self.file_name
-                        )
-                        logger.warn("[WARNING] {}.".format(msg))
-                        result['status'] = 'error'
-                        result['message'] = msg + "--please contact the administrator."
+            result = self.extract_result(job_is_done, file_format, dataset_and_table, export_type, compression,
+                                         sharded, compose)
         else:
             logger.debug(str(job_is_done))
             msg = "Export of {} to gs://{}/{} did not complete in the time allowed".format(export_type, self.bucket_path, self.file_name)
@@ -235,16 +412,10 @@ class BigQueryExport(BigQueryExportABC, BigQuerySupport):
 
         return result
 
-    def check_query_to_table_done(self, job_id, export_type, to_temp):
-        job_is_done = self.bq_service.jobs().get(projectId=settings.BIGQUERY_PROJECT_ID, jobId=job_id).execute()
-
-        retries = 0
-
-        while (job_is_done and not job_is_done['status']['state'] == 'DONE') and retries < BQ_ATTEMPT_MAX:
-            retries += 1
-            sleep(1)
-            job_is_done = self.bq_service.jobs().get(projectId=settings.BIGQUERY_PROJECT_ID,
-                                                jobId=job_id).execute()
+    def check_query_to_table_done(self, job_id, export_type, to_temp, deadline=None):
+        job_is_done = wait_for_job(
+            self.bq_service, {'projectId': settings.BIGQUERY_PROJECT_ID, 'jobId': job_id}, deadline
+        )
 
         result = {
             'status': None,
@@ -357,10 +528,16 @@ class BigQueryExport(BigQueryExportABC, BigQuerySupport):
         if parameters:
             query_data['configuration']['query']['queryParameters'] = parameters
 
+        estimate = None
+        if current_budget_user():
+            estimate = admit_query(query, parameters, self.dry_run_bytes, current_budget_user())
+
         self.bq_service.jobs().insert(
             projectId=settings.BIGQUERY_PROJECT_ID,
             body=query_data).execute(num_retries=5)
 
+        track_admitted_job(job_id, estimate)
+
         if for_batch:
             return job_id
         return self.check_query_to_table_done(job_id, export_type, to_temp)
@@ -387,7 +564,7 @@ class BigQueryExport(BigQueryExportABC, BigQuerySupport):
         if 'tableErrors' in check_dataset_table:
             return check_dataset_table
 
-        return self._streaming_insert(rows)
+        return self._bulk_insert(rows)
 
     def get_schema(self):
         return deepcopy(self.table_schema)
@@ -453,9 +630,20 @@ class BigQueryExportFileList(BigQueryExport):
 
         return result
 
-    # Export a cohort file manifest to the GCS bucket referenced by bucket_path from a parameterized
-    # BQ query, using the query's temp-table to perform the extract
-    def export_file_list_to_gcs(self, file_format, query, parameters):
+    # Start the query for a cohort file manifest export to GCS, without waiting for it; returns the query's job ID.
+    # Once the query is done, the export is finished with start_extract on its (temporary) destination table--see
+    # cohorts.export_jobs, which registers the export and has the poller do both.
+    def submit_file_list_to_gcs(self, query, parameters):
+        return self.export_query_to_bq(None, query, parameters, "cohort file manifest", True, for_batch=True)
+
+    # Deprecated: waits on both the query and the extract in the calling thread. Kept for callers outside this
+    # package; in a request, use cohorts.export_jobs.submit_gcs_export instead, which leaves the waiting to the poller.
+    #
+    # Export a cohort file manifest to the GCS bucket referenced by bucket_path from a parameterized BQ query, using
+    # the query's temp-table to perform the extract. See _table_to_gcs for compression, sharded and compose.
+    def export_file_list_to_gcs(self, file_format, query, parameters, compression=None, sharded=None, compose=False):
+        logger.warning("[WARNING] export_file_list_to_gcs is deprecated and blocks until the export is done; use "
+                       "cohorts.export_jobs.submit_gcs_export.")
 
         # Export the query to our temp table
         query_result = self.export_query_to_bq(None, query, parameters, "cohort file manifest", True)
@@ -465,7 +653,10 @@ class BigQueryExportFileList(BigQueryExport):
                 file_format,
                 query_result['message'],
                 "cohort file manifest",
-                query_result['jobId'] if 'jobId' in query_result else None
+                query_result['jobId'] if 'jobId' in query_result else None,
+                compression=compression,
+                sharded=sharded,
+                compose=compose
             )
             return export_result
         else:
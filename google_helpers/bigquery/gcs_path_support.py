@@ -14,6 +14,7 @@
 # limitations under the License.
 #
 
+import json
 import logging
 from django.conf import settings
 from google_helpers.bigquery.bq_support import BigQuerySupport
@@ -21,6 +22,10 @@ from google_helpers.bigquery.bq_support import BigQuerySupport
 logger = logging.getLogger('main_logger')
 
 MAX_INSERT = settings.MAX_BQ_INSERT
+# Path sets up to this many rows, and this many bytes once serialized, are passed to queries as an ARRAY<STRUCT>
+# parameter instead of being written to a table; the whole query request, parameters included, is capped at 10MB
+BQ_PATH_PARAM_MAX_ROWS = getattr(settings, 'BQ_PATH_PARAM_MAX_ROWS', 20000)
+BQ_PATH_PARAM_MAX_BYTES = getattr(settings, 'BQ_PATH_PARAM_MAX_BYTES', 6 * 1024 * 1024)
 
 TEMP_PATH_SCHEMA = {
     'fields': [
@@ -65,7 +70,76 @@ class BigQueryGcsPathSupport(BigQuerySupport):
             'file_gcs_path': gcs_path
         }
 
-    # Create the path table and optionally insert a set of rows
+    def _build_rows(self, paths):
+        return [self._build_row(
+            gdc_file_id, paths[gdc_file_id]['case_barcode'], paths[gdc_file_id]['sample_barcode'],
+            paths[gdc_file_id]['case_gdc_id'], paths[gdc_file_id]['sample_gdc_id'], paths[gdc_file_id]['gcs_path']
+        ) for gdc_file_id in paths]
+
+    # The path rows as an ARRAY<STRUCT<...>> query parameter, with a struct field for each column of the path table
+    # schema. A query reads it as a table with UNNEST(@<name>).
+    @staticmethod
+    def build_paths_parameter(rows, name='paths'):
+        fields = [x['name'] for x in TEMP_PATH_SCHEMA['fields']]
+        return {
+            'name': name,
+            'parameterType': {
+                'type': 'ARRAY',
+                'arrayType': {
+                    'type': 'STRUCT',
+                    'structTypes': [{'name': x, 'type': {'type': 'STRING'}} for x in fields]
+                }
+            },
+            'parameterValue': {
+                # A NULL struct field is given by omitting its value
+                'arrayValues': [{'structValues': {
+                    x: ({'value': row[x]} if row.get(x, None) is not None else {}) for x in fields
+                }} for row in rows]
+            }
+        }
+
+    # Make a set of paths available to a query. Typical sets are passed as an ARRAY<STRUCT> parameter, so no table is
+    # made at all, and the paths are visible to the query immediately; sets too large for a query request are
+    # written to this object's table with a load job (see add_temp_path_table).
+    #
+    # returns: {'table_clause': <FROM/JOIN clause for the paths, to alias in the query>,
+    #   'parameters': <query parameters to add to the query's>}, or None if the paths couldn't be written
+    def get_paths_source(self, paths, param_name='paths'):
+        rows = self._build_rows(paths)
+        if len(rows) <= BQ_PATH_PARAM_MAX_ROWS:
+            param = self.build_paths_parameter(rows, param_name)
+            if len(json.dumps(param)) <= BQ_PATH_PARAM_MAX_BYTES:
+                return {'table_clause': "UNNEST(@{})".format(param_name), 'parameters': [param]}
+        logger.info("[STATUS] {} paths are too many to pass as a parameter; writing them to {}.".format(
+            len(rows), self.table_id))
+        response = self.add_temp_path_table(paths)
+        # Rows are only written to a newly made table, so anything other than an insert response is a failure
+        if 'kind' not in response or 'insertErrors' in response:
+            logger.error("[ERROR] Couldn't write paths to {}: {}".format(self.table_id, str(response)))
+            return None
+        return {
+            'table_clause': "`{}.{}.{}`".format(self.project_id, self.dataset_id, self.table_id),
+            'parameters': []
+        }
+
+    # Run a query over a set of paths. The query has a {paths} placeholder where the paths' table clause goes, eg.
+    #   SELECT f.file_gcs_path, m.* FROM {paths} f JOIN `isb-cgc.metadata.files` m ON m.file_gdc_id = f.file_gdc_id
+    # and the path parameter, if the paths are passed as one, is added to the query's own parameters. The query is
+    # run without a destination, so its results never land in the path table.
+    #
+    # returns: the query's results (see BigQuerySupport.execute_query_and_fetch_results), or None if the paths
+    #   couldn't be written
+    def execute_query_with_paths(self, query, paths, parameters=None, param_name='paths', with_schema=False):
+        source = self.get_paths_source(paths, param_name)
+        if source is None:
+            return None
+        params = (parameters or []) + source['parameters']
+        return BigQuerySupport.execute_query_and_fetch_results(
+            query.format(paths=source['table_clause']), params if len(params) else None, with_schema=with_schema
+        )
+
+    # Create the path table and optionally insert a set of rows. Large sets are written with a load job, so they're
+    # visible to queries as soon as this returns.
     def add_temp_path_table(self, paths=None):
 
         response = self._confirm_dataset_and_table(
@@ -76,14 +150,7 @@ class BigQueryGcsPathSupport(BigQuerySupport):
 
         if 'status' in response and response['status'] == 'TABLE_MADE':
             if paths:
-                rows = []
-                for gdc_file_id in paths:
-                    rows.append(self._build_row(
-                        gdc_file_id, paths[gdc_file_id]['case_barcode'], paths[gdc_file_id]['sample_barcode'],
-                        paths[gdc_file_id]['case_gdc_id'], paths[gdc_file_id]['sample_gdc_id'], paths[gdc_file_id]['gcs_path'])
-                    )
-
-                response = self._streaming_insert(rows)
+                response = self._bulk_insert(self._build_rows(paths))
         else:
             logger.warn("[WARNING] Table {} was not successfully made!".format(self.table_id))
 
@@ -91,13 +158,6 @@ class BigQueryGcsPathSupport(BigQuerySupport):
 
     # Add rows to the GCS path table
     def add_rows(self, paths):
-        rows = []
-        for gdc_file_id in paths:
-            rows.append(self._build_row(
-                gdc_file_id, paths[gdc_file_id]['case_barcode'], paths[gdc_file_id]['sample_barcode'],
-                paths[gdc_file_id]['case_gdc_id'], paths[gdc_file_id]['sample_gdc_id'], paths[gdc_file_id]['gcs_path'])
-            )
-
-        response = self._streaming_insert(rows)
+        response = self._bulk_insert(self._build_rows(paths))
 
         return response
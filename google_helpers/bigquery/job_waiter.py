@@ -0,0 +1,134 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import time
+import random
+import logging
+import threading
+from googleapiclient.errors import HttpError
+from django.conf import settings
+
+logger = logging.getLogger('main_logger')
+
+# Default overall time, in seconds, a caller will wait on a job before giving up
+BQ_WAIT_DEADLINE = getattr(settings, 'BQ_WAIT_DEADLINE', settings.BQ_MAX_ATTEMPTS)
+# Longest single jobs.getQueryResults long-poll, in milliseconds
+BQ_LONG_POLL_MS = getattr(settings, 'BQ_LONG_POLL_MS', 10000)
+# Backoff schedule, in seconds, for jobs which can't be long-polled (extracts, loads, copies)
+BQ_BACKOFF_INITIAL = getattr(settings, 'BQ_BACKOFF_INITIAL', 0.25)
+BQ_BACKOFF_MAX = getattr(settings, 'BQ_BACKOFF_MAX', 8)
+BQ_BACKOFF_MULTIPLIER = getattr(settings, 'BQ_BACKOFF_MULTIPLIER', 1.5)
+
+# Upper bounds, in seconds, of the time-to-done histogram buckets
+JOB_WAIT_BUCKETS = [0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256]
+
+JOB_WAIT_STATS = {}
+_stats_lock = threading.Lock()
+
+
+def _record_job_wait(job_type, elapsed, done):
+    with _stats_lock:
+        stats = JOB_WAIT_STATS.get(job_type, None)
+        if stats is None:
+            stats = JOB_WAIT_STATS[job_type] = {
+                'count': 0,
+                'timeouts': 0,
+                'total_secs': 0.0,
+                'buckets': {str(x): 0 for x in JOB_WAIT_BUCKETS + ['inf']}
+            }
+        if not done:
+            stats['timeouts'] += 1
+            return
+        stats['count'] += 1
+        stats['total_secs'] += elapsed
+        bucket = next((x for x in JOB_WAIT_BUCKETS if elapsed <= x), 'inf')
+        stats['buckets'][str(bucket)] += 1
+
+
+# Time-to-done histograms per job type, as a dict of <job type>: {count, timeouts, total_secs, mean_secs, buckets},
+# where buckets maps each bucket's upper bound in seconds to the number of jobs which completed within it
+def get_job_wait_stats():
+    with _stats_lock:
+        stats = {}
+        for job_type, type_stats in JOB_WAIT_STATS.items():
+            stats[job_type] = dict(type_stats)
+            stats[job_type]['buckets'] = dict(type_stats['buckets'])
+            stats[job_type]['mean_secs'] = round(type_stats['total_secs'] / type_stats['count'], 3) \
+                if type_stats['count'] else None
+    return stats
+
+
+# Paces the wait on one or more BigQuery jobs against an overall deadline.
+#
+# Query jobs are waited on by long-polling jobs.getQueryResults, which returns as soon as the job completes (or the
+# poll times out), so short queries don't pay for a fixed sleep. Other job types can't be long-polled, and instead
+# wait with exponential backoff, jittered between half and all of the current interval.
+class JobWaiter(object):
+
+    def __init__(self, bq_service, deadline=None, job_type='query'):
+        self.bq_service = bq_service
+        self.job_type = job_type
+        self.deadline = deadline if deadline is not None else BQ_WAIT_DEADLINE
+        self.start = time.time()
+        self.polls = 0
+        self._backoff = BQ_BACKOFF_INITIAL
+
+    def remaining(self):
+        return max(self.deadline - (time.time() - self.start), 0)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    # Wait until the job may have progressed, or the deadline passes
+    # job_ref: the job reference (projectId, jobId, and optionally location) to long-poll, for query jobs
+    def pause(self, job_ref=None):
+        self.polls += 1
+        if self.job_type == 'query' and job_ref:
+            timeout_ms = int(min(self.remaining() * 1000, BQ_LONG_POLL_MS))
+            if timeout_ms > 0:
+                try:
+                    self.bq_service.jobs().getQueryResults(
+                        timeoutMs=timeout_ms, maxResults=0, **job_ref
+                    ).execute(num_retries=2)
+                    return
+                except HttpError as e:
+                    # A failed query job raises its error here; the caller's next status check will report it
+                    logger.debug("[STATUS] Long-poll of job {} returned an error: {}".format(job_ref['jobId'], str(e)))
+                    return
+        time.sleep(min(random.uniform(self._backoff / 2, self._backoff), self.remaining()))
+        self._backoff = min(self._backoff * BQ_BACKOFF_MULTIPLIER, BQ_BACKOFF_MAX)
+
+    def finish(self, done):
+        elapsed = time.time() - self.start
+        _record_job_wait(self.job_type, elapsed, done)
+        logger.debug("[BENCHMARKING] {} job wait {} after {}s and {} polls".format(
+            self.job_type, "completed" if done else "timed out", str(round(elapsed, 3)), self.polls))
+
+
+# Wait for a single job to finish, or the deadline to pass
+#
+# job_ref: {'projectId': <project which executed the job>, 'jobId': <job ID>[, 'location': <location>]}
+# deadline: overall seconds to wait; defaults to BQ_WAIT_DEADLINE
+# job_type: 'query' to long-poll the job's results, anything else ('extract', 'load', ...) to back off
+# returns: the last job resource retrieved from jobs.get
+def wait_for_job(bq_service, job_ref, deadline=None, job_type='query'):
+    waiter = JobWaiter(bq_service, deadline, job_type)
+    job = bq_service.jobs().get(**job_ref).execute(num_retries=5)
+    while job and job['status']['state'] != 'DONE' and not waiter.expired():
+        waiter.pause(job_ref)
+        job = bq_service.jobs().get(**job_ref).execute(num_retries=5)
+    waiter.finish(bool(job and job['status']['state'] == 'DONE'))
+    return job
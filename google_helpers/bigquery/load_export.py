@@ -0,0 +1,166 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import gzip
+import json
+import time
+import logging
+import tempfile
+from uuid import uuid4
+from googleapiclient.http import MediaIoBaseUpload
+from django.conf import settings
+from google_helpers.bigquery.service import get_bigquery_service
+from google_helpers.bigquery.job_waiter import wait_for_job
+from google_helpers.bigquery.streaming_insert import StreamingInserter
+
+logger = logging.getLogger('main_logger')
+
+# Row sets with at least this many rows, or this many bytes of JSON, are written with a load job instead of streamed
+BQ_LOAD_MIN_ROWS = getattr(settings, 'BQ_LOAD_MIN_ROWS', 10000)
+BQ_LOAD_MIN_BYTES = getattr(settings, 'BQ_LOAD_MIN_BYTES', 8 * 1024 * 1024)
+# Size of each resumable upload request; must be a multiple of 256KB
+BQ_LOAD_CHUNK_SIZE = getattr(settings, 'BQ_LOAD_CHUNK_SIZE', 8 * 1024 * 1024)
+# Load files are kept in memory up to this size, and spill to disk beyond it
+BQ_LOAD_SPOOL_SIZE = getattr(settings, 'BQ_LOAD_SPOOL_SIZE', 32 * 1024 * 1024)
+BQ_LOAD_DEADLINE = getattr(settings, 'BQ_LOAD_DEADLINE', 600)
+
+
+# Writes rows into a table by whichever of the two APIs suits the size of the set: small sets are streamed with
+# tabledata.insertAll (see StreamingInserter), as they're visible at once and a load job has a fixed overhead; large
+# sets are serialized once to a gzipped newline-delimited JSON temp file, uploaded through a resumable upload, and
+# loaded with a single load job, which is cheaper, not subject to the streaming rate limits, and leaves no rows in the
+# streaming buffer for later copy or extract jobs to miss.
+class RowExporter(object):
+
+    def __init__(self, project_id, dataset_id, table_id, schema=None, min_rows=BQ_LOAD_MIN_ROWS,
+                 min_bytes=BQ_LOAD_MIN_BYTES, executing_project=None, bq_service=None):
+        self.project_id = project_id
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+        self.schema = schema
+        self.min_rows = min_rows
+        self.min_bytes = min_bytes
+        self.executing_project = executing_project or settings.BIGQUERY_PROJECT_ID
+        self.bq_service = bq_service
+
+    # Serialize rows as gzipped NDJSON into a spooled temp file; returns (file, uncompressed bytes written). Lines
+    # already serialized (while sizing the set up) are written first.
+    @staticmethod
+    def _write_load_file(rows, lines=None):
+        load_file = tempfile.SpooledTemporaryFile(max_size=BQ_LOAD_SPOOL_SIZE)
+        written = 0
+        with gzip.GzipFile(fileobj=load_file, mode='wb', compresslevel=1) as zipped:
+            for line in lines or []:
+                zipped.write(line)
+                written += len(line)
+            for row in rows:
+                line = (json.dumps(row, default=str) + "\n").encode('utf-8')
+                zipped.write(line)
+                written += len(line)
+        load_file.seek(0)
+        return load_file, written
+
+    # 'stream' or 'load' for a row set, along with the lines serialized while deciding (so they're not serialized
+    # again). Sets with at least min_rows rows go straight to a load; others are serialized until they pass min_bytes.
+    def choose(self, rows):
+        if len(rows) >= self.min_rows:
+            return 'load', None
+        lines = []
+        size = 0
+        for row in rows:
+            lines.append((json.dumps(row, default=str) + "\n").encode('utf-8'))
+            size += len(lines[-1])
+            if size >= self.min_bytes:
+                return 'load', lines
+        return 'stream', lines
+
+    def _load(self, rows, lines=None):
+        start = time.time()
+        bq_service = self.bq_service or get_bigquery_service()
+        load_file, written = self._write_load_file(rows[len(lines or []):], lines)
+        job_id = str(uuid4())
+        load_config = {
+            'sourceFormat': 'NEWLINE_DELIMITED_JSON',
+            'destinationTable': {
+                'projectId': self.project_id,
+                'datasetId': self.dataset_id,
+                'tableId': self.table_id
+            },
+            'writeDisposition': 'WRITE_APPEND',
+            'createDisposition': 'CREATE_NEVER'
+        }
+        if self.schema:
+            load_config['schema'] = self.schema if 'fields' in self.schema else {'fields': self.schema}
+        try:
+            media = MediaIoBaseUpload(load_file, mimetype='application/octet-stream', chunksize=BQ_LOAD_CHUNK_SIZE,
+                                      resumable=True)
+            request = bq_service.jobs().insert(projectId=self.executing_project, body={
+                'jobReference': {'projectId': self.executing_project, 'jobId': job_id},
+                'configuration': {'load': load_config}
+            }, media_body=media)
+            job = None
+            while job is None:
+                status, job = request.next_chunk(num_retries=5)
+        finally:
+            load_file.close()
+
+        job_ref = {'projectId': self.executing_project, 'jobId': job_id}
+        if job.get('jobReference', {}).get('location', None):
+            job_ref['location'] = job['jobReference']['location']
+        job = wait_for_job(bq_service, job_ref, BQ_LOAD_DEADLINE, job_type='load')
+
+        response = {'kind': 'bigquery#tableDataInsertAllResponse', 'loadJob': job_ref}
+        if not job or job['status']['state'] != 'DONE':
+            logger.error("[ERROR] Load job {} into {} did not finish within {}s.".format(
+                job_id, self.table_id, BQ_LOAD_DEADLINE))
+            response['insertErrors'] = [{'errors': [{'reason': 'timeout', 'message': "Load job {} did not finish.".format(job_id)}]}]
+        elif 'errorResult' in job['status']:
+            logger.error("[ERROR] Load job {} into {} failed: {}".format(job_id, self.table_id, job['status']['errorResult']))
+            # A load is all or nothing, so its errors aren't tied to any one row
+            response['insertErrors'] = [{'errors': job['status'].get('errors', [job['status']['errorResult']])}]
+        logger.debug("[BENCHMARKING] Loaded {} rows ({} bytes of JSON) into {} in {}s".format(
+            len(rows), written, self.table_id, str(round(time.time() - start, 3))))
+        return response
+
+    # Write the rows to the table; returns an insertAll-style response, with insertErrors if any rows failed
+    def export(self, rows):
+        if not len(rows):
+            return {'kind': 'bigquery#tableDataInsertAllResponse'}
+        method, lines = self.choose(rows)
+        logger.info("[STATUS] Writing {} rows to {} with a {}.".format(
+            len(rows), self.table_id, "load job" if method == 'load' else "streaming insert"))
+        if method == 'load':
+            return self._load(rows, lines)
+        return StreamingInserter(self.project_id, self.dataset_id, self.table_id, bq_service=self.bq_service).insert(rows)
+
+
+# Time writing num_rows synthetic file list rows through each API, against bq_service (eg. a local stand-in, to
+# measure the client-side cost of each path). Returns a dict of rows per second for each.
+def benchmark_row_export(bq_service, num_rows=100000):
+    rows = [{
+        'cohort_id': 1, 'collection_id': "tcga_luad", 'PatientID': "TCGA-05-{}".format(i % 5000),
+        'SeriesInstanceUID': "1.3.6.1.4.1.14519.5.2.1.{}".format(i), 'gcs_url': "gs://idc-open/{}.dcm".format(uuid4())
+    } for i in range(num_rows)]
+    results = {}
+    for method, min_rows in [('stream', num_rows + 1,), ('load', 0,)]:
+        exporter = RowExporter('idc-dev', 'manifests', 'benchmark', min_rows=min_rows,
+                               min_bytes=(0 if method == 'load' else 1024 ** 4), bq_service=bq_service)
+        start = time.time()
+        exporter.export(rows)
+        results[method] = round(num_rows / (time.time() - start), 1)
+    logger.info("[BENCHMARKING] Exporting {} rows: streaming {} rows/s, load job {} rows/s".format(
+        num_rows, results['stream'], results['load']))
+    return results
@@ -14,14 +14,32 @@
 # limitations under the License.
 #
 
+import os
+import time
+import atexit
 import logging
+import threading
+from collections import deque
 from django.conf import settings
 from google_helpers.bigquery.bq_support import BigQuerySupport
+from google_helpers.bigquery.streaming_insert import StreamingInserter
 
 logger = logging.getLogger('main_logger')
 
 MAX_INSERT = settings.MAX_BQ_INSERT
 
+# Metrics rows are buffered and written from a background thread, rather than inserted on the request path
+METRICS_BQ_BUFFERED = getattr(settings, 'METRICS_BQ_BUFFERED', True)
+# Most rows held waiting to be written
+METRICS_BQ_QUEUE_SIZE = getattr(settings, 'METRICS_BQ_QUEUE_SIZE', 10000)
+# Rows are written once this many are waiting, or the oldest has waited METRICS_BQ_FLUSH_SECS
+METRICS_BQ_BATCH_SIZE = getattr(settings, 'METRICS_BQ_BATCH_SIZE', 500)
+METRICS_BQ_FLUSH_SECS = getattr(settings, 'METRICS_BQ_FLUSH_SECS', 5)
+# What to do with a row when the queue is full: 'drop_oldest' to make room by discarding the oldest waiting row, or
+# 'block' to wait up to METRICS_BQ_BLOCK_SECS for room (and drop the new row if none is made)
+METRICS_BQ_FULL_POLICY = getattr(settings, 'METRICS_BQ_FULL_POLICY', 'drop_oldest')
+METRICS_BQ_BLOCK_SECS = getattr(settings, 'METRICS_BQ_BLOCK_SECS', 1)
+
 
 class BigQueryMetricsSupport(BigQuerySupport):
 
@@ -31,9 +49,148 @@ class BigQueryMetricsSupport(BigQuerySupport):
     # Add rows to the metrics table specified by table
     # Note that this is a class method therefor the rows must be supplied formatted ready
     # for insertion, build_row will not be called!
+    # Unless METRICS_BQ_BUFFERED is off, the rows are only queued, and are written by the metrics writer's thread
     @classmethod
     def add_rows_to_table(cls, rows, table):
+        if METRICS_BQ_BUFFERED:
+            return get_metrics_writer().add(table, rows)
         bqs = cls(table)
         return bqs._streaming_insert(rows)
 
 
+# Buffers metrics rows in a bounded in-process queue and writes them to their tables from a background thread, in
+# batches of up to batch_size, or sooner once the oldest waiting row is flush_secs old. Adding rows never waits on
+# BigQuery; when the queue is full, rows are dropped (oldest first) or the caller briefly waits for room, per policy.
+# Anything still waiting is written at interpreter shutdown.
+class BufferedMetricsWriter(object):
+
+    def __init__(self, max_queued=METRICS_BQ_QUEUE_SIZE, batch_size=METRICS_BQ_BATCH_SIZE,
+                 flush_secs=METRICS_BQ_FLUSH_SECS, policy=METRICS_BQ_FULL_POLICY, block_secs=METRICS_BQ_BLOCK_SECS,
+                 project_id=None, dataset_id=None):
+        self.max_queued = max_queued
+        self.batch_size = batch_size
+        self.flush_secs = flush_secs
+        self.policy = policy
+        self.block_secs = block_secs
+        self.project_id = project_id or settings.BIGQUERY_PROJECT_ID
+        self.dataset_id = dataset_id or settings.METRICS_BQ_DATASET
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._stats = {'queued': 0, 'flushed': 0, 'dropped': 0, 'failed': 0}
+        self._thread = None
+        self._pid = None
+        self._closed = False
+
+    # Start the writer thread if it isn't running in this process (it won't be after a fork)
+    def _ensure_thread(self):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="bq-metrics-writer", daemon=True)
+        self._thread.start()
+
+    # Queue rows for the given table; returns an insertAll-style response noting how many were queued
+    def add(self, table, rows):
+        queued = 0
+        with self._cond:
+            if self._closed:
+                raise Exception("The metrics writer has been closed.")
+            self._ensure_thread()
+            for row in rows:
+                if len(self._queue) >= self.max_queued:
+                    if self.policy == 'block':
+                        # Have the writer thread make room now, rather than when the batch comes due
+                        self._cond.notify_all()
+                        self._cond.wait_for(lambda: len(self._queue) < self.max_queued, self.block_secs)
+                    if len(self._queue) >= self.max_queued:
+                        self._stats['dropped'] += 1
+                        if self.policy == 'block':
+                            continue
+                        self._queue.popleft()
+                self._queue.append((time.time(), table, row,))
+                self._stats['queued'] += 1
+                queued += 1
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+        return {'kind': 'bigquery#tableDataInsertAllResponse', 'queued': queued}
+
+    def _ready(self):
+        return len(self._queue) >= min(self.batch_size, self.max_queued) or self._closed or \
+            (len(self._queue) and time.time() - self._queue[0][0] >= self.flush_secs)
+
+    def _take_batch(self):
+        batch = []
+        while len(self._queue) and len(batch) < self.batch_size:
+            batch.append(self._queue.popleft())
+        # Waiting adders may now have room
+        self._cond.notify_all()
+        return batch
+
+    def _write(self, batch):
+        by_table = {}
+        for queued_at, table, row in batch:
+            by_table.setdefault(table, []).append(row)
+        for table, rows in by_table.items():
+            try:
+                response = StreamingInserter(self.project_id, self.dataset_id, table).insert(rows)
+                failed = len(response.get('insertErrors', []))
+            except Exception as e:
+                logger.error("[ERROR] While writing {} metrics rows to {}:".format(len(rows), table))
+                logger.exception(e)
+                failed = len(rows)
+            with self._cond:
+                self._stats['flushed'] += len(rows) - failed
+                self._stats['failed'] += failed
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ready():
+                    # Wake when the oldest waiting row comes due, or to check again
+                    timeout = self.flush_secs if not len(self._queue) \
+                        else max(self.flush_secs - (time.time() - self._queue[0][0]), 0.01)
+                    self._cond.wait(timeout)
+                if self._closed and not len(self._queue):
+                    return
+                batch = self._take_batch()
+            self._write(batch)
+
+    # Write everything waiting, from the calling thread
+    def flush(self):
+        while True:
+            with self._cond:
+                batch = self._take_batch()
+            if not len(batch):
+                return
+            self._write(batch)
+
+    # Stop the writer thread once it has written everything waiting
+    def close(self, timeout=10):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._queue)
+        return stats
+
+
+_metrics_writer = None
+_metrics_writer_lock = threading.Lock()
+
+
+def get_metrics_writer():
+    global _metrics_writer
+    if _metrics_writer is None:
+        with _metrics_writer_lock:
+            if _metrics_writer is None:
+                _metrics_writer = BufferedMetricsWriter()
+                atexit.register(_metrics_writer.close)
+    return _metrics_writer
+
+
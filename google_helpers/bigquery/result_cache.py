@@ -0,0 +1,289 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import re
+import copy
+import json
+import time
+import logging
+import threading
+from django.conf import settings
+from idc_collections.metadata_cache import MetadataCache, make_cache_key
+
+logger = logging.getLogger('main_logger')
+
+# Caching of BigQuery results. Results of queries which only touch inactive (and so immutable) data versions never
+# expire; anything touching an active version expires after BQ_RESULT_CACHE_TTL seconds.
+BQ_RESULT_CACHE = getattr(settings, 'BQ_RESULT_CACHE', True)
+# 'local' for a per-process cache, or the alias of a Django cache (eg. a memcached or Redis backend in CACHES) to
+# share results between workers
+BQ_RESULT_CACHE_BACKEND = getattr(settings, 'BQ_RESULT_CACHE_BACKEND', 'local')
+BQ_RESULT_CACHE_SIZE = getattr(settings, 'BQ_RESULT_CACHE_SIZE', 128)
+BQ_RESULT_CACHE_TTL = getattr(settings, 'BQ_RESULT_CACHE_TTL', 300)
+# Largest result stored, in rows and in (JSON-encoded) bytes; bigger results are returned but not cached, as a local
+# cache holds BQ_RESULT_CACHE_SIZE of them per worker, and copies each one on every get and set
+BQ_RESULT_CACHE_MAX_ROWS = getattr(settings, 'BQ_RESULT_CACHE_MAX_ROWS', 5000)
+BQ_RESULT_CACHE_MAX_BYTES = getattr(settings, 'BQ_RESULT_CACHE_MAX_BYTES', 2 * 1024 * 1024)
+# Longest time, in seconds, a request will wait on an identical in-flight request before running its own
+BQ_RESULT_CACHE_FLIGHT_WAIT = getattr(settings, 'BQ_RESULT_CACHE_FLIGHT_WAIT', 120)
+
+_QUOTED = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`)")
+
+
+# Collapse runs of whitespace outside of quoted strings and identifiers, so formatting differences in otherwise
+# identical SQL don't produce different cache keys
+def normalize_sql(sql):
+    parts = _QUOTED.split(sql.strip())
+    return "".join([part if i % 2 else re.sub(r"\s+", " ", part) for i, part in enumerate(parts)])
+
+
+# Flatten and sort a BigQuery API query parameter set by parameter name. Scalar array values are sorted as well, as
+# array parameters are only used for IN UNNEST(...) membership tests, where order doesn't matter.
+def normalize_params(parameters):
+    flat = []
+
+    def _flatten(params):
+        for param in params or []:
+            if isinstance(param, (list, tuple)):
+                _flatten(param)
+            else:
+                flat.append(param)
+    _flatten(parameters)
+
+    normalized = []
+    for param in sorted(flat, key=lambda x: x.get('name', '')):
+        param = json.loads(json.dumps(param, default=str))
+        array_values = param.get('parameterValue', {}).get('arrayValues', None)
+        if array_values and all(['value' in x for x in array_values]):
+            param['parameterValue']['arrayValues'] = sorted(array_values, key=lambda x: str(x['value']))
+        normalized.append(param)
+    return normalized
+
+
+# Whether a result is small enough to cache: a row list (or a with_schema result's 'results') of at most
+# BQ_RESULT_CACHE_MAX_ROWS rows, which encodes to at most BQ_RESULT_CACHE_MAX_BYTES
+def is_cacheable_result(result):
+    rows = result.get('results', None) if isinstance(result, dict) else result
+    if isinstance(rows, list) and len(rows) > BQ_RESULT_CACHE_MAX_ROWS:
+        return False
+    try:
+        return len(json.dumps(result, default=str)) <= BQ_RESULT_CACHE_MAX_BYTES
+    except (TypeError, ValueError):
+        return False
+
+
+# Cache key for a query: normalized SQL, normalized parameters, and the set of data versions it reads
+def bq_result_cache_key(sql, parameters=None, versions=None, *extra):
+    return "bq_result:{}".format(make_cache_key(
+        normalize_sql(sql), normalize_params(parameters), sorted([str(x) for x in (versions or [])]), extra
+    ))
+
+
+class LocalResultCacheBackend(object):
+
+    def __init__(self, max_entries=BQ_RESULT_CACHE_SIZE):
+        self.cache = MetadataCache("bq_results", max_entries=max_entries)
+        self._flights = set()
+        self._lock = threading.Lock()
+
+    # Results are copied in and out, so callers can't alter each other's (or the cache's) copy
+    def get(self, key):
+        return copy.deepcopy(self.cache.get(key))
+
+    def set(self, key, value, ttl=None):
+        self.cache.put(key, copy.deepcopy(value), ttl=ttl)
+
+    # Mark a query as being run; a local backend only ever sees this process's queries
+    def add_flight(self, key, ttl):
+        with self._lock:
+            if key in self._flights:
+                return False
+            self._flights.add(key)
+            return True
+
+    def delete_flight(self, key):
+        with self._lock:
+            self._flights.discard(key)
+
+    def has_flight(self, key):
+        with self._lock:
+            return key in self._flights
+
+
+# Backed by a Django cache, so results (and in-flight markers) are shared between every worker using that cache
+class DjangoResultCacheBackend(object):
+
+    def __init__(self, alias):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, ttl=None):
+        # A timeout of None stores the value for as long as the cache will keep it
+        self.cache.set(key, value, timeout=ttl)
+
+    def add_flight(self, key, ttl):
+        return self.cache.add("{}:flight".format(key), os.getpid(), timeout=ttl)
+
+    def delete_flight(self, key):
+        self.cache.delete("{}:flight".format(key))
+
+    def has_flight(self, key):
+        return self.cache.get("{}:flight".format(key)) is not None
+
+
+class _Flight(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+# Result cache with single-flight deduplication: when identical requests arrive together, only the first runs its
+# query, and the rest wait for and share its result--threads in the same process directly, and other workers (with a
+# shared backend) by watching the cache for the result to appear.
+class BigQueryResultCache(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'shared_flights': 0, 'errors': 0, 'oversized': 0}
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _backend_get(self, key):
+        try:
+            return self.backend.get(key)
+        except Exception as e:
+            self._count('errors')
+            logger.warning("[WARNING] BigQuery result cache lookup failed: {}".format(str(e)))
+            return None
+
+    # Return the cached result for key, or run compute() to produce (and cache) it. A result of None, or one too large
+    # to cache (see is_cacheable_result), isn't stored.
+    #
+    # immutable: True if the result can never change (eg. the query only reads inactive data versions), in which
+    #   case it is stored without an expiry
+    def get_or_compute(self, key, compute, immutable=False):
+        result = self._backend_get(key)
+        if result is not None:
+            self._count('hits')
+            return result
+
+        with self._lock:
+            flight = self._flights.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            self._count('shared_flights')
+            if flight.event.wait(BQ_RESULT_CACHE_FLIGHT_WAIT) and flight.result is not None:
+                return copy.deepcopy(flight.result)
+            return compute()
+
+        try:
+            result = self._await_other_worker(key)
+            if result is None:
+                self._count('misses')
+                claimed = self._claim(key)
+                try:
+                    result = compute()
+                    if result is not None and not is_cacheable_result(result):
+                        self._count('oversized')
+                        logger.debug("[STATUS] BigQuery result for {} is too large to cache.".format(key))
+                    elif result is not None:
+                        try:
+                            self.backend.set(key, result, ttl=None if immutable else BQ_RESULT_CACHE_TTL)
+                        except Exception as e:
+                            self._count('errors')
+                            logger.warning("[WARNING] BigQuery result cache store failed: {}".format(str(e)))
+                finally:
+                    if claimed:
+                        self.backend.delete_flight(key)
+            flight.result = result
+            return result
+        finally:
+            flight.event.set()
+            with self._lock:
+                self._flights.pop(key, None)
+
+    def _claim(self, key):
+        try:
+            return self.backend.add_flight(key, BQ_RESULT_CACHE_FLIGHT_WAIT)
+        except Exception as e:
+            self._count('errors')
+            logger.warning("[WARNING] Couldn't mark BigQuery query as in flight: {}".format(str(e)))
+            return False
+
+    # If another worker is already running this query, wait for its result to land in the shared cache
+    def _await_other_worker(self, key):
+        try:
+            if not self.backend.has_flight(key):
+                return None
+        except Exception:
+            return None
+        self._count('shared_flights')
+        start = time.time()
+        delay = 0.1
+        while (time.time() - start) < BQ_RESULT_CACHE_FLIGHT_WAIT:
+            time.sleep(delay)
+            delay = min(delay * 2, 2)
+            result = self._backend_get(key)
+            if result is not None:
+                self._count('hits')
+                return result
+            try:
+                if not self.backend.has_flight(key):
+                    # The other worker finished without a result, or gave up; run the query here
+                    return self._backend_get(key)
+            except Exception:
+                return None
+        return None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_bq_result_cache():
+    global _result_cache
+    if _result_cache is None:
+        with _result_cache_lock:
+            if _result_cache is None:
+                backend = LocalResultCacheBackend() if BQ_RESULT_CACHE_BACKEND == 'local' \
+                    else DjangoResultCacheBackend(BQ_RESULT_CACHE_BACKEND)
+                _result_cache = BigQueryResultCache(backend)
+    return _result_cache
+
+
+# Run compute() through the result cache, or directly if caching is disabled
+def cached_bq_result(key, compute, immutable=False):
+    if not BQ_RESULT_CACHE:
+        return compute()
+    return get_bq_result_cache().get_or_compute(key, compute, immutable)
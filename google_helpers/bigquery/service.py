@@ -14,13 +14,12 @@
 # limitations under the License.
 #
 
-from oauth2client.client import flow_from_clientsecrets, GoogleCredentials
-from googleapiclient import discovery
+from oauth2client.client import flow_from_clientsecrets
 from oauth2client.file import Storage
 from oauth2client import tools
 from django.conf import settings
-import httplib2
 import sys
+from google_helpers.client_factory import get_google_service
 
 import logging
 
@@ -32,12 +31,7 @@ BIGQUERY_SCOPES = ['https://www.googleapis.com/auth/bigquery',
 
 def get_bigquery_service():
 
-    credentials = GoogleCredentials.from_stream(settings.GOOGLE_APPLICATION_CREDENTIALS).create_scoped(BIGQUERY_SCOPES)
-    http = httplib2.Http()
-    http = credentials.authorize(http)
-    service = discovery.build('bigquery', 'v2', http=http, cache_discovery=False)
-
-    return service
+    return get_google_service('bigquery', 'v2', BIGQUERY_SCOPES)
 
 
 def authorize_credentials_with_Google():
@@ -45,9 +39,6 @@ def authorize_credentials_with_Google():
     # documentation: https://developers.google.com/accounts/docs/application-default-credentials
     SCOPES = ['https://www.googleapis.com/auth/bigquery']
     # credentials = GoogleCredentials.get_application_default().create_scoped(SCOPES)
-    credentials = GoogleCredentials.from_stream(settings.GOOGLE_APPLICATION_CREDENTIALS).create_scoped(SCOPES)
-    http = httplib2.Http()
-    http = credentials.authorize(http)
-    service = discovery.build('bigquery', 'v2', http=http, cache_discovery=False)
+    service = get_google_service('bigquery', 'v2', SCOPES)
     if settings.DEBUG: logger.debug(' big query authorization '+sys._getframe().f_code.co_name)
     return service
@@ -0,0 +1,163 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import re
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+
+logger = logging.getLogger('main_logger')
+
+# The Storage Read API client and pyarrow are optional; without them, results are paged through jobs.getQueryResults
+try:
+    from google.cloud.bigquery_storage import BigQueryReadClient, types as bq_storage_types
+except ImportError:
+    BigQueryReadClient = None
+    bq_storage_types = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+BQ_STORAGE_READ = getattr(settings, 'BQ_STORAGE_READ', True)
+# Most parallel streams to request for a read session
+BQ_STORAGE_READ_STREAMS = getattr(settings, 'BQ_STORAGE_READ_STREAMS', 4)
+# Most record batches held in memory, across all streams, before the readers wait on the consumer
+BQ_STORAGE_READ_BUFFER = getattr(settings, 'BQ_STORAGE_READ_BUFFER', 8)
+
+STORAGE_READ_SCOPES = ['https://www.googleapis.com/auth/bigquery', 'https://www.googleapis.com/auth/cloud-platform']
+
+
+def storage_read_available():
+    return bool(BQ_STORAGE_READ and BigQueryReadClient is not None and pyarrow is not None)
+
+
+def get_storage_read_client():
+    from google.oauth2 import service_account
+    credentials = service_account.Credentials.from_service_account_file(
+        settings.GOOGLE_APPLICATION_CREDENTIALS, scopes=STORAGE_READ_SCOPES
+    )
+    return BigQueryReadClient(credentials=credentials)
+
+
+# The destination table of a query job, as a {projectId, datasetId, tableId} dict, and whether the job's results are
+# ordered. Every query job has a destination table, even if it's only the anonymous table BigQuery keeps its results
+# in. Any ORDER BY in the query counts as ordered, even one in a subquery or window, which at worst costs parallelism.
+def get_job_destination(bq_service, job_ref):
+    job = bq_service.jobs().get(**job_ref).execute(num_retries=5)
+    ordered = bool(re.search(r'\bORDER\s+BY\b', job['configuration']['query'].get('query', ""), re.IGNORECASE))
+    return job['configuration']['query']['destinationTable'], ordered
+
+
+# Reads a table through the BigQuery Storage Read API: one read session split into parallel streams, each decoded
+# from Arrow as it arrives. Batches come out in whatever order the streams deliver them, so a table whose row order
+# matters must be read with max_streams=1; a bounded buffer between the stream readers and the consumer means a slow
+# consumer pauses the readers rather than piling up batches in memory.
+#
+# client: anything with the BigQueryReadClient create_read_session/read_rows interface
+class BigQueryStorageReader(object):
+
+    def __init__(self, client=None, max_streams=BQ_STORAGE_READ_STREAMS, buffer_batches=BQ_STORAGE_READ_BUFFER,
+                 executing_project=None):
+        if pyarrow is None:
+            raise Exception("pyarrow is required to read from the BigQuery Storage Read API.")
+        self.client = client or get_storage_read_client()
+        self.max_streams = max_streams
+        self.buffer_batches = buffer_batches
+        self.executing_project = executing_project or settings.BIGQUERY_PROJECT_ID
+
+    def create_read_session(self, table, selected_fields=None, row_restriction=None):
+        table_path = "projects/{}/datasets/{}/tables/{}".format(table['projectId'], table['datasetId'], table['tableId'])
+        read_options = {}
+        if selected_fields:
+            read_options['selected_fields'] = selected_fields
+        if row_restriction:
+            read_options['row_restriction'] = row_restriction
+        if bq_storage_types is not None:
+            requested = bq_storage_types.ReadSession(
+                table=table_path, data_format=bq_storage_types.DataFormat.ARROW,
+                read_options=bq_storage_types.ReadSession.TableReadOptions(**read_options)
+            )
+        else:
+            requested = {'table': table_path, 'data_format': 'ARROW', 'read_options': read_options}
+        return self.client.create_read_session(
+            parent="projects/{}".format(self.executing_project), read_session=requested,
+            max_stream_count=self.max_streams
+        )
+
+    # Generator of pyarrow.RecordBatch objects for the table
+    def iter_batches(self, table, selected_fields=None, row_restriction=None):
+        start = time.time()
+        session = self.create_read_session(table, selected_fields, row_restriction)
+        streams = list(session.streams)
+        if not len(streams):
+            return
+        schema = pyarrow.ipc.read_schema(pyarrow.py_buffer(session.arrow_schema.serialized_schema))
+
+        buffer = queue.Queue(maxsize=self.buffer_batches)
+        stop = threading.Event()
+        stream_done = object()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    continue
+
+        def _read_stream(stream):
+            try:
+                for response in self.client.read_rows(stream.name):
+                    if stop.is_set():
+                        return
+                    _put(pyarrow.ipc.read_record_batch(
+                        pyarrow.py_buffer(response.arrow_record_batch.serialized_record_batch), schema
+                    ))
+                _put(stream_done)
+            except Exception as e:
+                _put(e)
+
+        executor = ThreadPoolExecutor(max_workers=len(streams))
+        rows = 0
+        try:
+            for stream in streams:
+                executor.submit(_read_stream, stream)
+            remaining = len(streams)
+            while remaining:
+                item = buffer.get()
+                if item is stream_done:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    rows += item.num_rows
+                    yield item
+            logger.debug("[BENCHMARKING] Read {} rows over {} streams from {} in {}s".format(
+                rows, len(streams), table['tableId'], str(round(time.time() - start, 3))))
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
+
+    # Generator of rows as dicts of Python-typed values (REPEATED fields as lists, RECORDs as dicts)
+    def iter_rows(self, table, selected_fields=None, row_restriction=None):
+        for batch in self.iter_batches(table, selected_fields, row_restriction):
+            for row in batch.to_pylist():
+                yield row
@@ -0,0 +1,174 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import time
+import random
+import logging
+import threading
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
+from django.conf import settings
+from google_helpers.bigquery.service import get_bigquery_service
+from google_helpers.bigquery.job_waiter import BQ_BACKOFF_INITIAL, BQ_BACKOFF_MAX, BQ_BACKOFF_MULTIPLIER
+
+logger = logging.getLogger('main_logger')
+
+MAX_INSERT = settings.MAX_BQ_INSERT
+# Largest serialized insertAll request body to send; the API rejects anything over 10MB
+BQ_INSERT_MAX_BYTES = getattr(settings, 'BQ_INSERT_MAX_BYTES', 9 * 1024 * 1024)
+# Most insertAll requests in flight at once
+BQ_INSERT_WORKERS = getattr(settings, 'BQ_INSERT_WORKERS', 4)
+# Most attempts made for any one row
+BQ_INSERT_MAX_ATTEMPTS = getattr(settings, 'BQ_INSERT_MAX_ATTEMPTS', 5)
+
+# insertErrors reasons which will fail the same way however often a row is retried
+PERMANENT_INSERT_ERRORS = ['invalid', 'invalidQuery', 'notFound', 'accessDenied', 'duplicate']
+# HTTP statuses worth retrying a whole request for
+RETRYABLE_STATUSES = [429, 500, 502, 503, 504]
+
+# Bytes added to the request body by the {"rows": [...]} wrapper and the separators between rows
+_BODY_OVERHEAD = 64
+
+
+# Streams rows into a table with tabledata.insertAll.
+#
+# Rows are packed into requests by both count (MAX_BQ_INSERT) and serialized size (BQ_INSERT_MAX_BYTES), and the
+# requests are sent BQ_INSERT_WORKERS at a time. Each row gets an insertId when it's packed, so BigQuery drops any
+# duplicates created by a retry. Only the rows reported in a response's insertErrors are retried, with backoff, and
+# only if their errors aren't permanent (eg. a row which doesn't match the schema); rows in a request which failed
+# outright are retried as a whole, and a request rejected as too large is split in two.
+class StreamingInserter(object):
+
+    def __init__(self, project_id, dataset_id, table_id, max_rows=MAX_INSERT, max_bytes=BQ_INSERT_MAX_BYTES,
+                 workers=BQ_INSERT_WORKERS, max_attempts=BQ_INSERT_MAX_ATTEMPTS, bq_service=None):
+        self.project_id = project_id
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.max_attempts = max_attempts
+        # By default each sending thread uses its own client; a given service is shared by all of them
+        self.bq_service = bq_service
+        self._lock = threading.Lock()
+        self._stats = None
+
+    # Pack the rows, as (index, insertable row) entries, into batches within the row count and byte limits. Rows
+    # which can't fit in a request even alone are returned separately.
+    def pack(self, rows):
+        batches = []
+        oversized = []
+        batch = []
+        batch_bytes = _BODY_OVERHEAD
+        for index, row in enumerate(rows):
+            insertable = {'insertId': str(uuid4()), 'json': row}
+            size = len(json.dumps(insertable, default=str)) + 1
+            if size + _BODY_OVERHEAD > self.max_bytes:
+                oversized.append(index)
+                continue
+            if len(batch) and (len(batch) >= self.max_rows or batch_bytes + size > self.max_bytes):
+                batches.append(batch)
+                batch = []
+                batch_bytes = _BODY_OVERHEAD
+            batch.append((index, insertable,))
+            batch_bytes += size
+        if len(batch):
+            batches.append(batch)
+        return batches, oversized
+
+    def _count(self, stat, value=1):
+        with self._lock:
+            self._stats[stat] += value
+
+    # Send one batch, retrying as needed; returns a list of insertErrors entries, indexed into the original rows
+    def _send(self, batch):
+        table_data = (self.bq_service or get_bigquery_service()).tabledata()
+        failed = []
+        pending = batch
+        backoff = BQ_BACKOFF_INITIAL
+        attempt = 0
+        while len(pending):
+            attempt += 1
+            self._count('requests')
+            try:
+                response = table_data.insertAll(
+                    projectId=self.project_id, datasetId=self.dataset_id, tableId=self.table_id,
+                    body={'rows': [x[1] for x in pending]}
+                ).execute()
+            except HttpError as e:
+                status = int(e.resp.status)
+                if status == 413 and len(pending) > 1:
+                    # Too large after all; send each half separately
+                    half = len(pending) // 2
+                    return failed + self._send(pending[:half]) + self._send(pending[half:])
+                if status not in RETRYABLE_STATUSES or attempt >= self.max_attempts:
+                    logger.error("[ERROR] Streaming insert of {} rows into {} failed: {}".format(
+                        len(pending), self.table_id, str(e)))
+                    return failed + [{'index': x[0], 'errors': [{'reason': 'requestFailed', 'message': str(e)}]}
+                                     for x in pending]
+                self._count('retried_rows', len(pending))
+            else:
+                errors = response.get('insertErrors', [])
+                if not len(errors):
+                    self._count('inserted_rows', len(pending))
+                    return failed
+                errors_by_pos = {int(x['index']): x['errors'] for x in errors}
+                retry = []
+                for pos, entry in enumerate(pending):
+                    row_errors = errors_by_pos.get(pos, None)
+                    if row_errors is None:
+                        self._count('inserted_rows')
+                    elif any(x.get('reason', None) in PERMANENT_INSERT_ERRORS for x in row_errors) \
+                            or attempt >= self.max_attempts:
+                        failed.append({'index': entry[0], 'errors': row_errors})
+                    else:
+                        retry.append(entry)
+                self._count('retried_rows', len(retry))
+                pending = retry
+            if len(pending):
+                time.sleep(random.uniform(backoff / 2, backoff))
+                backoff = min(backoff * BQ_BACKOFF_MULTIPLIER, BQ_BACKOFF_MAX)
+        return failed
+
+    # Insert the rows; returns an insertAll-style response, with an insertErrors list (indexed into rows) if any
+    # couldn't be inserted
+    def insert(self, rows):
+        start = time.time()
+        self._stats = {'requests': 0, 'inserted_rows': 0, 'retried_rows': 0}
+        batches, oversized = self.pack(rows)
+        errors = [{'index': x, 'errors': [{'reason': 'rowTooLarge', 'message': "Row exceeds the {} byte request limit.".format(
+            self.max_bytes)}]} for x in oversized]
+
+        if len(batches) == 1 or self.workers <= 1:
+            for batch in batches:
+                errors.extend(self._send(batch))
+        elif len(batches):
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(batches))) as executor:
+                for batch_errors in executor.map(self._send, batches):
+                    errors.extend(batch_errors)
+
+        logger.debug("[BENCHMARKING] Streamed {} of {} rows into {} in {} requests ({} row retries) in {}s".format(
+            self._stats['inserted_rows'], len(rows), self.table_id, self._stats['requests'],
+            self._stats['retried_rows'], str(round(time.time() - start, 3))))
+
+        response = {'kind': 'bigquery#tableDataInsertAllResponse'}
+        if len(errors):
+            logger.warning("[WARNING] {} of {} rows could not be inserted into {}.".format(
+                len(errors), len(rows), self.table_id))
+            response['insertErrors'] = sorted(errors, key=lambda x: x['index'])
+        return response
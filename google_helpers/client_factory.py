@@ -0,0 +1,278 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import re
+import json
+import time
+import logging
+import datetime
+import tempfile
+import threading
+from http.client import HTTPException
+
+import httplib2
+from googleapiclient import discovery
+from oauth2client.client import GoogleCredentials
+from django.conf import settings
+
+logger = logging.getLogger('main_logger')
+
+# Directory discovery documents are written to once fetched, so that restarts and new workers never re-download them
+GOOGLE_DISCOVERY_CACHE_DIR = getattr(settings, 'GOOGLE_DISCOVERY_CACHE_DIR',
+                                     os.path.join(tempfile.gettempdir(), "idc_discovery_cache"))
+# Retries of a discovery document fetch which fails with a server or connection error, and the delay before the first
+# of them (doubled for each one after)
+GOOGLE_DISCOVERY_RETRIES = getattr(settings, 'GOOGLE_DISCOVERY_RETRIES', 2)
+GOOGLE_DISCOVERY_BACKOFF = getattr(settings, 'GOOGLE_DISCOVERY_BACKOFF', 0.5)
+# Access tokens are refreshed proactively once they are within this many seconds of expiring
+GOOGLE_TOKEN_REFRESH_MARGIN = getattr(settings, 'GOOGLE_TOKEN_REFRESH_MARGIN', 300)
+
+DISCOVERY_URIS = [discovery.DISCOVERY_URI, discovery.V2_DISCOVERY_URI]
+
+
+# Process-wide source of authorized Google API clients.
+#
+# Credentials are parsed once per scope set (and delegated subject) and shared by every thread; their access tokens
+# are reused until they near expiry. Discovery documents are parsed once and kept in memory, backed by an on-disk
+# cache. httplib2.Http objects are not thread-safe, so each thread receives its own authorized Http, and its own
+# service objects built on top of it. All state is discarded if the process is found to have been forked (eg. by a
+# gunicorn pre-fork worker), as sockets and locks do not survive a fork.
+class GoogleClientFactory(object):
+
+    def __init__(self, credentials_file=None):
+        self.credentials_file = credentials_file
+        self._docs = {}
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.RLock()
+        self._credentials = {}
+        self._local = threading.local()
+        self._stats = {
+            'credential_loads': 0,
+            'token_refreshes': 0,
+            'discovery_fetches': 0,
+            'discovery_disk_hits': 0,
+            'clients_built': 0,
+            'clients_reused': 0,
+            'build_secs': 0.0
+        }
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            logger.info("[STATUS] Process {} forked from {}; resetting Google API client state.".format(
+                os.getpid(), self._pid))
+            self._reset()
+
+    def _credentials_path(self):
+        return self.credentials_file or settings.GOOGLE_APPLICATION_CREDENTIALS
+
+    @staticmethod
+    def _scope_key(scopes):
+        if isinstance(scopes, str):
+            scopes = [scopes]
+        return tuple(sorted(set(scopes or [])))
+
+    # Scoped (and optionally delegated) credentials, parsed from disk only the first time a given scope set is asked for
+    def get_credentials(self, scopes, subject=None):
+        self._check_fork()
+        key = (self._scope_key(scopes), subject,)
+        with self._lock:
+            credentials = self._credentials.get(key, None)
+            if credentials is None:
+                credentials = GoogleCredentials.from_stream(self._credentials_path())
+                if key[0] and credentials.create_scoped_required():
+                    credentials = credentials.create_scoped(list(key[0]))
+                if subject:
+                    credentials = credentials.create_delegated(subject)
+                self._credentials[key] = credentials
+                self._stats['credential_loads'] += 1
+        return credentials
+
+    # Refresh a token ahead of its expiry, so a request never has to pay for the exchange (or a 401 round trip)
+    def _ensure_token(self, credentials):
+        expiry = getattr(credentials, 'token_expiry', None)
+        now = datetime.datetime.utcnow()
+        if credentials.access_token and expiry and \
+                (expiry - now) > datetime.timedelta(seconds=GOOGLE_TOKEN_REFRESH_MARGIN):
+            return
+        with self._lock:
+            expiry = getattr(credentials, 'token_expiry', None)
+            if not credentials.access_token or not expiry or \
+                    (expiry - now) <= datetime.timedelta(seconds=GOOGLE_TOKEN_REFRESH_MARGIN):
+                credentials.refresh(httplib2.Http())
+                self._stats['token_refreshes'] += 1
+
+    def _thread_state(self):
+        state = getattr(self._local, 'state', None)
+        if state is None:
+            state = self._local.state = {'http': {}, 'services': {}}
+        return state
+
+    # An authorized Http object belonging to the calling thread
+    def get_http(self, scopes, subject=None):
+        credentials = self.get_credentials(scopes, subject)
+        state = self._thread_state()
+        key = (self._scope_key(scopes), subject,)
+        http = state['http'].get(key, None)
+        if http is None:
+            http = state['http'][key] = credentials.authorize(httplib2.Http())
+        self._ensure_token(credentials)
+        return http
+
+    @staticmethod
+    def _doc_filename(service_name, version):
+        return "{}.{}.json".format(re.sub(r'[^\w.-]', '_', service_name), re.sub(r'[^\w.-]', '_', version))
+
+    # The parsed discovery document for a service, looked up in memory, then the on-disk cache, and only then
+    # fetched from Google
+    def get_discovery_document(self, service_name, version):
+        key = (service_name, version,)
+        doc = self._docs.get(key, None)
+        if doc is not None:
+            return doc
+        with self._lock:
+            doc = self._docs.get(key, None)
+            if doc is not None:
+                return doc
+            filename = self._doc_filename(service_name, version)
+            path = os.path.join(GOOGLE_DISCOVERY_CACHE_DIR, filename)
+            if os.path.isfile(path):
+                try:
+                    with open(path, 'r') as doc_file:
+                        doc = json.load(doc_file)
+                    self._stats['discovery_disk_hits'] += 1
+                except Exception as e:
+                    logger.warning("[WARNING] Unreadable discovery document at {}: {}".format(path, str(e)))
+            if doc is None:
+                content = self._fetch_discovery_document(service_name, version)
+                doc = json.loads(content)
+                self._stats['discovery_fetches'] += 1
+                try:
+                    os.makedirs(GOOGLE_DISCOVERY_CACHE_DIR, exist_ok=True)
+                    tmp_path = os.path.join(GOOGLE_DISCOVERY_CACHE_DIR, "{}.{}".format(filename, os.getpid()))
+                    with open(tmp_path, 'w') as doc_file:
+                        doc_file.write(content)
+                    os.replace(tmp_path, os.path.join(GOOGLE_DISCOVERY_CACHE_DIR, filename))
+                except Exception as e:
+                    logger.warning("[WARNING] Couldn't write the discovery cache for {} {}: {}".format(
+                        service_name, version, str(e)))
+            self._docs[key] = doc
+        return doc
+
+    # Fetch a discovery document from the first of DISCOVERY_URIS which has it. Server and connection errors are
+    # retried with backoff, as build_with_retries did for the builders; a document which isn't found isn't.
+    @staticmethod
+    def _fetch_discovery_document(service_name, version):
+        http = httplib2.Http()
+        last_error = None
+        for attempt in range(GOOGLE_DISCOVERY_RETRIES + 1):
+            if attempt:
+                logger.info("[STATUS] Retrying the discovery document for {} {} ({})".format(
+                    service_name, version, last_error))
+                time.sleep(GOOGLE_DISCOVERY_BACKOFF * (2 ** (attempt - 1)))
+            retry = False
+            for uri in DISCOVERY_URIS:
+                try:
+                    resp, content = http.request(uri.replace('{api}', service_name).replace('{apiVersion}', version))
+                except (HTTPException, OSError) as e:
+                    last_error = str(e)
+                    retry = True
+                    continue
+                if resp.status < 400:
+                    return content.decode('utf-8') if isinstance(content, bytes) else content
+                last_error = "status {}".format(resp.status)
+                retry = retry or resp.status >= 500 or resp.status == 429
+            if not retry:
+                break
+        raise Exception("Couldn't retrieve the discovery document for {} {} ({})".format(
+            service_name, version, last_error))
+
+    # A service object for the calling thread, built once against that thread's authorized Http
+    def get_service(self, service_name, version, scopes, subject=None):
+        start = time.time()
+        http = self.get_http(scopes, subject)
+        state = self._thread_state()
+        key = (service_name, version, self._scope_key(scopes), subject,)
+        service = state['services'].get(key, None)
+        if service is None:
+            service = discovery.build_from_document(self.get_discovery_document(service_name, version), http=http)
+            state['services'][key] = service
+            with self._lock:
+                self._stats['clients_built'] += 1
+                self._stats['build_secs'] += time.time() - start
+            logger.debug("[BENCHMARKING] Built {} {} client in {}s".format(
+                service_name, version, str(round(time.time() - start, 4))))
+        else:
+            with self._lock:
+                self._stats['clients_reused'] += 1
+        return service
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['credential_sets'] = len(self._credentials)
+            stats['discovery_documents'] = len(self._docs)
+        return stats
+
+
+GOOGLE_CLIENT_FACTORY = GoogleClientFactory()
+
+
+def get_google_service(service_name, version, scopes, subject=None):
+    return GOOGLE_CLIENT_FACTORY.get_service(service_name, version, scopes, subject)
+
+
+def get_google_http(scopes, subject=None):
+    return GOOGLE_CLIENT_FACTORY.get_http(scopes, subject)
+
+
+def get_google_credentials(scopes, subject=None):
+    return GOOGLE_CLIENT_FACTORY.get_credentials(scopes, subject)
+
+
+# Time client construction the way the builders used to do it (re-reading the key file, a fresh Http, a fresh token
+# exchange and a parse of the discovery document on every call) against the factory, for the given number of calls.
+# Returns a dict of mean seconds per construction for each approach.
+def benchmark_client_construction(service_name='bigquery', version='v2', scopes=None, iterations=10):
+    scopes = scopes or ['https://www.googleapis.com/auth/bigquery']
+    results = {}
+
+    start = time.time()
+    for i in range(iterations):
+        credentials = GoogleCredentials.from_stream(settings.GOOGLE_APPLICATION_CREDENTIALS).create_scoped(scopes)
+        http = credentials.authorize(httplib2.Http())
+        credentials.refresh(httplib2.Http())
+        discovery.build(service_name, version, http=http, cache_discovery=False)
+    results['uncached'] = (time.time() - start) / iterations
+
+    factory = GoogleClientFactory()
+    start = time.time()
+    factory.get_service(service_name, version, scopes)
+    results['factory_first'] = time.time() - start
+
+    start = time.time()
+    for i in range(iterations):
+        factory.get_service(service_name, version, scopes)
+    results['factory_warm'] = (time.time() - start) / iterations
+
+    logger.info("[BENCHMARKING] {} {} client construction over {} calls: uncached {}s, factory first {}s, factory warm {}s".format(
+        service_name, version, iterations, str(round(results['uncached'], 4)), str(round(results['factory_first'], 4)),
+        str(round(results['factory_warm'], 6))
+    ))
+    return results
@@ -14,10 +14,7 @@
 # limitations under the License.
 #
 
-from oauth2client.client import GoogleCredentials
-from django.conf import settings
-import httplib2
-from .utils import build_with_retries
+from .client_factory import get_google_service
 
 
 def get_sql_resource():
@@ -27,9 +24,4 @@ def get_sql_resource():
         'https://www.googleapis.com/auth/sqlservice.admin'
     ]
 
-    credentials = GoogleCredentials.from_stream(
-        settings.GOOGLE_APPLICATION_CREDENTIALS).create_scoped(CLOUDSQL_SCOPES)
-    http = httplib2.Http()
-    http = credentials.authorize(http)
-    service = build_with_retries('sqladmin', 'v1beta4', None, 2, http=http)
-    return service
+    return get_google_service('sqladmin', 'v1beta4', CLOUDSQL_SCOPES)
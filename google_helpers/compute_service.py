@@ -16,12 +16,9 @@ limitations under the License.
 
 """
 
-from oauth2client.client import GoogleCredentials
-from django.conf import settings
-import httplib2
 # from .utils import build_with_retries
 
-from googleapiclient.discovery import build
+from .client_factory import get_google_service
 
 COMPUTE_SCOPES = ['https://www.googleapis.com/auth/compute',
                   'https://www.googleapis.com/auth/cloud-platform']
@@ -36,7 +33,4 @@ COMPUTE_SCOPES = ['https://www.googleapis.com/auth/compute',
 #     return service
 
 def get_compute_resource():
-    credentials = GoogleCredentials.from_stream(settings.GOOGLE_APPLICATION_CREDENTIALS).create_scoped(COMPUTE_SCOPES)
-    http = credentials.authorize(httplib2.Http())
-    service = build('compute', 'v1', http=http, cache_discovery=False)
-    return service
+    return get_google_service('compute', 'v1', COMPUTE_SCOPES)
@@ -15,10 +15,8 @@
 #
 from __future__ import absolute_import
 
-from oauth2client.service_account import ServiceAccountCredentials
 from django.conf import settings
-from httplib2 import Http
-from .utils import build_with_retries
+from .client_factory import get_google_service, get_google_http
 
 
 GOOGLE_GROUP_ADMIN = settings.GOOGLE_GROUP_ADMIN
@@ -36,11 +34,6 @@ DIRECTORY_SCOPES = [
 
 def get_directory_resource():
 
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        GOOGLE_APPLICATION_CREDENTIALS, DIRECTORY_SCOPES)
-    delegated_credentials = credentials.create_delegated(GOOGLE_GROUP_ADMIN)
+    service = get_google_service('admin', 'directory_v1', DIRECTORY_SCOPES, subject=GOOGLE_GROUP_ADMIN)
 
-    http_auth = delegated_credentials.authorize(Http())
-    service = build_with_retries('admin', 'directory_v1', None, 2, http=http_auth)
-
-    return service, http_auth
\ No newline at end of file
+    return service, get_google_http(DIRECTORY_SCOPES, subject=GOOGLE_GROUP_ADMIN)
\ No newline at end of file
@@ -14,10 +14,8 @@
 # limitations under the License.
 # 
 
-from oauth2client.service_account import ServiceAccountCredentials
-from googleapiclient import discovery
 from django.conf import settings
-from httplib2 import Http
+from .client_factory import get_google_service, get_google_http
 
 
 GOOGLE_APPLICATION_CREDENTIALS = settings.GOOGLE_APPLICATION_CREDENTIALS
@@ -32,11 +30,7 @@ GENOMICS_SCOPES = [
 
 def get_genomics_resource():
 
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        GOOGLE_APPLICATION_CREDENTIALS, GENOMICS_SCOPES)
-
-    http_auth = credentials.authorize(Http())
-    service = discovery.build('genomics', 'v1', http=http_auth, cache_discovery=False)
-    return service, http_auth
+    service = get_google_service('genomics', 'v1', GENOMICS_SCOPES)
+    return service, get_google_http(GENOMICS_SCOPES)
 
 
@@ -14,10 +14,7 @@
 # limitations under the License.
 #
 
-from oauth2client.client import GoogleCredentials
-from django.conf import settings
-import httplib2
-from .utils import build_with_retries
+from .client_factory import get_google_service
 
 
 def get_iam_resource():
@@ -28,9 +25,4 @@ def get_iam_resource():
         'https://www.googleapis.com/auth/cloud-platform'
     ]
 
-    credentials = GoogleCredentials.from_stream(
-        settings.GOOGLE_APPLICATION_CREDENTIALS).create_scoped(IAM_SCOPES)
-    http = httplib2.Http()
-    http = credentials.authorize(http)
-    service = build_with_retries('iam', 'v1', None, 2, http=http)
-    return service
+    return get_google_service('iam', 'v1', IAM_SCOPES)
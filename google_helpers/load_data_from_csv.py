@@ -24,11 +24,14 @@ from builtins import str
 import argparse
 import logging
 import json
-import time
 import uuid
 import sys
 
 from google_helpers.bigquery.service import get_bigquery_service
+from google_helpers.bigquery.job_waiter import wait_for_job
+
+# Load jobs were historically waited on indefinitely, so they get a generous default deadline (in seconds)
+LOAD_JOB_DEADLINE = 3600
 
 logger = logging.getLogger(__name__)
 
@@ -82,31 +85,30 @@ def load_table(bigquery, project_id, dataset_id, table_name, source_schema,
 
 
 # [START poll_job]
-def poll_job(bigquery, job):
-    """Waits for a job to complete."""
+def poll_job(bigquery, job, deadline=LOAD_JOB_DEADLINE):
+    """Waits for a job to complete, or for deadline seconds to pass."""
 
     logger.info('Waiting for poll_job for table {} to finish...'.format(
         job['configuration']['load']['destinationTable']['tableId']))
 
-    request = bigquery.jobs().get(
-        projectId=job['jobReference']['projectId'],
-        jobId=job['jobReference']['jobId'])
+    job_ref = {'projectId': job['jobReference']['projectId'], 'jobId': job['jobReference']['jobId']}
+    if job['jobReference'].get('location'):
+        job_ref['location'] = job['jobReference']['location']
 
-    while True:
-        result = request.execute(num_retries=2)
+    result = wait_for_job(bigquery, job_ref, deadline, job_type='load')
 
-        if 'errors' in result['status']:
-            logger.warn('Error loading table: {}'.format(
-                job['configuration']['load']['destinationTable']['tableId']))
-            raise RuntimeError(json.dumps(result['status']['errors'], indent=4))
+    if 'errors' in result['status']:
+        logger.warn('Error loading table: {}'.format(
+            job['configuration']['load']['destinationTable']['tableId']))
+        raise RuntimeError(json.dumps(result['status']['errors'], indent=4))
 
-        if result['status']['state'] == 'DONE':
-            if 'errorResult' in result['status']:
-                raise RuntimeError(result['status']['errorResult'])
-            logger.info('poll_job complete.')
-            return
+    if result['status']['state'] == 'DONE':
+        if 'errorResult' in result['status']:
+            raise RuntimeError(result['status']['errorResult'])
+        logger.info('poll_job complete.')
+        return
 
-        time.sleep(1)
+    raise RuntimeError('Load job {} did not complete within {}s'.format(job['jobReference']['jobId'], deadline))
 # [END poll_job]
 
 
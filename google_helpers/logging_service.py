@@ -14,10 +14,8 @@
 # limitations under the License.
 # 
 
-from oauth2client.service_account import ServiceAccountCredentials
-from googleapiclient import discovery
 from django.conf import settings
-from httplib2 import Http
+from .client_factory import get_google_service, get_google_http
 
 
 GOOGLE_APPLICATION_CREDENTIALS = settings.GOOGLE_APPLICATION_CREDENTIALS
@@ -33,10 +31,5 @@ def get_logging_resource():
     """Returns a Cloud Logging service client for calling the API.
     """
 
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        GOOGLE_APPLICATION_CREDENTIALS, LOGGING_SCOPES)
-
-    http_auth = credentials.authorize(Http())
-
-    service = discovery.build('logging', 'v1beta3', http=http_auth, cache_discovery=False)
-    return service, http_auth
\ No newline at end of file
+    service = get_google_service('logging', 'v1beta3', LOGGING_SCOPES)
+    return service, get_google_http(LOGGING_SCOPES)
\ No newline at end of file
@@ -14,10 +14,8 @@
 # limitations under the License.
 #
 
-from oauth2client.client import GoogleCredentials
-from googleapiclient import discovery
 from django.conf import settings
-import httplib2
+from .client_factory import get_google_service
 
 
 GOOGLE_APPLICATION_CREDENTIALS = settings.GOOGLE_APPLICATION_CREDENTIALS
@@ -27,11 +25,7 @@ PUBSUB_SCOPES = ["https://www.googleapis.com/auth/pubsub"]
 
 
 def get_pubsub_service():
-    credentials = GoogleCredentials.from_stream(settings.GOOGLE_APPLICATION_CREDENTIALS).create_scoped(PUBSUB_SCOPES)
-    http = httplib2.Http()
-    http = credentials.authorize(http)
-
-    return discovery.build('pubsub', 'v1', http=http, cache_discovery=False)
+    return get_google_service('pubsub', 'v1', PUBSUB_SCOPES)
 
 
 def get_full_topic_name(topic_name):
@@ -14,24 +14,18 @@
 # limitations under the License.
 # 
 
-from oauth2client.service_account import ServiceAccountCredentials
-from googleapiclient import discovery
 from django.conf import settings
-from httplib2 import Http
+from .client_factory import get_google_service, get_google_http
 
 
 GOOGLE_APPLICATION_CREDENTIALS = settings.GOOGLE_APPLICATION_CREDENTIALS
 
 SUPERADMIN_FOR_REPORTS = settings.SUPERADMIN_FOR_REPORTS
 
+REPORTS_SCOPES = ['https://www.googleapis.com/auth/admin.reports.audit.readonly']
 
-def get_reports_resource():
-
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        GOOGLE_APPLICATION_CREDENTIALS, 'https://www.googleapis.com/auth/admin.reports.audit.readonly')
-    delegated_credentials = credentials.create_delegated(SUPERADMIN_FOR_REPORTS)
 
-    http_auth = delegated_credentials.authorize(Http())
+def get_reports_resource():
 
-    service = discovery.build('admin', 'reports_v1', http=http_auth, cache_discovery=False)
-    return service, http_auth
\ No newline at end of file
+    service = get_google_service('admin', 'reports_v1', REPORTS_SCOPES, subject=SUPERADMIN_FOR_REPORTS)
+    return service, get_google_http(REPORTS_SCOPES, subject=SUPERADMIN_FOR_REPORTS)
\ No newline at end of file
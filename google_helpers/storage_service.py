@@ -15,9 +15,7 @@
 #
 from __future__ import absolute_import
 
-from oauth2client.client import GoogleCredentials
-from django.conf import settings
-from .utils import build_with_retries
+from .client_factory import get_google_service
 
 STORAGE_SCOPES = [
     'https://www.googleapis.com/auth/devstorage.read_only',
@@ -27,6 +25,4 @@ STORAGE_SCOPES = [
 
 
 def get_storage_resource():
-    credentials = GoogleCredentials.from_stream(settings.GOOGLE_APPLICATION_CREDENTIALS).create_scoped(STORAGE_SCOPES)
-    service = build_with_retries('storage', 'v1', credentials, 2)
-    return service
+    return get_google_service('storage', 'v1', STORAGE_SCOPES)
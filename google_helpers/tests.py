@@ -0,0 +1,998 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import gzip
+import json
+import datetime
+import tempfile
+import time
+import threading
+from types import SimpleNamespace
+from unittest import skipIf
+from unittest.mock import patch
+from django.test import TestCase
+from google_helpers.bigquery.storage_read import BigQueryStorageReader, pyarrow
+from google_helpers.bigquery.row_decoder import RowDecoder
+from google_helpers.bigquery import admission, streaming_insert
+from google_helpers.bigquery.streaming_insert import StreamingInserter
+from google_helpers.bigquery.load_export import RowExporter
+from google_helpers.bigquery.metrics_support import BufferedMetricsWriter
+from google_helpers.bigquery.export_support import BigQueryExport
+from google_helpers.bigquery.bq_support import BigQuerySupport
+from google_helpers.bigquery import job_waiter
+from google_helpers.bigquery.job_waiter import wait_for_job
+from googleapiclient.errors import HttpError
+from google_helpers.bigquery import result_cache
+from google_helpers.bigquery.result_cache import BigQueryResultCache, LocalResultCacheBackend
+from google_helpers.bigquery.admission import admit_query, QueryBudgetExceeded
+from google_helpers.client_factory import GoogleClientFactory
+from google_helpers.load_data_from_csv import poll_job
+from google_helpers.bigquery import gcs_path_support
+from google_helpers.bigquery.gcs_path_support import BigQueryGcsPathSupport
+
+
+# In-process stand-in for the BigQuery Storage Read API. A read session over one of its tables splits the rows into
+# up to max_stream_count streams, and each stream serves its rows as serialized Arrow record batches of batch_size
+# rows, as the real service does.
+class FakeBigQueryReadClient(object):
+
+    def __init__(self, tables, batch_size=2, fail_stream=None):
+        self.tables = tables
+        self.batch_size = batch_size
+        self.fail_stream = fail_stream
+        self.streams = {}
+        self.batches_served = 0
+
+    def create_read_session(self, parent, read_session, max_stream_count=1):
+        table_path = read_session['table'] if isinstance(read_session, dict) else read_session.table
+        read_options = read_session['read_options'] if isinstance(read_session, dict) else read_session.read_options
+        fields = read_options.get('selected_fields', None) if isinstance(read_options, dict) \
+            else list(read_options.selected_fields)
+        table = self.tables[table_path]
+        if fields:
+            table = table.select(fields)
+        stream_count = max(min(max_stream_count, table.num_rows), 1 if table.num_rows else 0)
+        streams = []
+        for i in range(stream_count):
+            name = "{}/streams/{}".format(table_path, i)
+            self.streams[name] = table.slice(i * table.num_rows // stream_count,
+                                             (i + 1) * table.num_rows // stream_count - i * table.num_rows // stream_count)
+            streams.append(SimpleNamespace(name=name))
+        return SimpleNamespace(
+            streams=streams,
+            arrow_schema=SimpleNamespace(serialized_schema=table.schema.serialize().to_pybytes())
+        )
+
+    def read_rows(self, name, offset=0):
+        if self.fail_stream is not None and name.endswith("/streams/{}".format(self.fail_stream)):
+            raise Exception("Stream {} failed".format(name))
+        for batch in self.streams[name].slice(offset).to_batches(max_chunksize=self.batch_size):
+            self.batches_served += 1
+            yield SimpleNamespace(
+                row_count=batch.num_rows,
+                arrow_record_batch=SimpleNamespace(serialized_record_batch=batch.serialize().to_pybytes())
+            )
+
+
+@skipIf(pyarrow is None, "pyarrow is not installed")
+class StorageReadTest(TestCase):
+    table = {'projectId': 'idc-dev', 'datasetId': 'idc_v1', 'tableId': 'dicom_all'}
+    table_path = "projects/idc-dev/datasets/idc_v1/tables/dicom_all"
+
+    def setUp(self):
+        self.rows = [{
+            'SeriesInstanceUID': "1.2.{}".format(i),
+            'instance_size': i * 1024,
+            'SliceThickness': i / 2.0,
+            'Modality': ['CT', 'SEG'] if i % 2 else ['MR']
+        } for i in range(25)]
+        self.tables = {self.table_path: pyarrow.Table.from_pylist(self.rows)}
+
+    def test_read_all_streams(self):
+        reader = BigQueryStorageReader(client=FakeBigQueryReadClient(self.tables), max_streams=4, buffer_batches=2,
+                                       executing_project='idc-dev')
+        rows = list(reader.iter_rows(self.table))
+        self.assertEqual(sorted(rows, key=lambda x: x['instance_size']), self.rows)
+
+    def test_selected_fields(self):
+        reader = BigQueryStorageReader(client=FakeBigQueryReadClient(self.tables), executing_project='idc-dev')
+        rows = list(reader.iter_rows(self.table, selected_fields=['SeriesInstanceUID']))
+        self.assertEqual(sorted([x['SeriesInstanceUID'] for x in rows]), sorted([x['SeriesInstanceUID'] for x in self.rows]))
+        self.assertEqual(set(rows[0].keys()), {'SeriesInstanceUID'})
+
+    def test_stream_error(self):
+        reader = BigQueryStorageReader(client=FakeBigQueryReadClient(self.tables, fail_stream=2), max_streams=4,
+                                       executing_project='idc-dev')
+        with self.assertRaises(Exception):
+            list(reader.iter_rows(self.table))
+
+    def test_early_close(self):
+        client = FakeBigQueryReadClient(self.tables, batch_size=1)
+        reader = BigQueryStorageReader(client=client, max_streams=2, buffer_batches=1, executing_project='idc-dev')
+        batches = reader.iter_batches(self.table)
+        next(batches)
+        batches.close()
+        self.assertLess(client.batches_served, len(self.rows))
+
+    def test_ordered_job_results(self):
+        client = FakeBigQueryReadClient(self.tables)
+        bqs = BigQuerySupport(None, None, None, executing_project='idc-dev')
+        for sql, streams in [("SELECT * FROM t", 4), ("SELECT * FROM t ORDER BY instance_size", 1)]:
+            client.streams = {}
+            job = {'configuration': {'query': {'query': sql, 'destinationTable': self.table}}}
+            bqs.bq_service = SimpleNamespace(jobs=lambda: SimpleNamespace(
+                get=lambda **job_ref: SimpleNamespace(execute=lambda num_retries=0: job)))
+            with patch('google_helpers.bigquery.bq_support.storage_read_available', return_value=True), \
+                    patch('google_helpers.bigquery.bq_support.BQ_STORAGE_READ_STREAMS', 4), \
+                    patch('google_helpers.bigquery.storage_read.get_storage_read_client', return_value=client):
+                rows = list(bqs.stream_job_results({'projectId': 'idc-dev', 'jobId': 'job_1'}))
+            self.assertEqual(len(client.streams), streams)
+            self.assertEqual(sorted(rows, key=lambda x: x['instance_size']), self.rows)
+            if streams == 1:
+                self.assertEqual(rows, self.rows)
+
+
+class RowDecoderTest(TestCase):
+    schema = {'fields': [
+        {'name': 'SeriesInstanceUID', 'type': 'STRING', 'mode': 'NULLABLE'},
+        {'name': 'instance_size', 'type': 'INTEGER', 'mode': 'NULLABLE'},
+        {'name': 'SliceThickness', 'type': 'FLOAT', 'mode': 'NULLABLE'},
+        {'name': 'is_derived', 'type': 'BOOLEAN', 'mode': 'NULLABLE'},
+        {'name': 'created', 'type': 'TIMESTAMP', 'mode': 'NULLABLE'},
+        {'name': 'Modality', 'type': 'STRING', 'mode': 'REPEATED'},
+        {'name': 'segments', 'type': 'RECORD', 'mode': 'REPEATED', 'fields': [
+            {'name': 'label', 'type': 'STRING', 'mode': 'NULLABLE'},
+            {'name': 'volume', 'type': 'FLOAT', 'mode': 'NULLABLE'}
+        ]}
+    ]}
+    row = {'f': [
+        {'v': '1.2.3'}, {'v': '2048'}, {'v': '2.5'}, {'v': 'true'}, {'v': '1.7E9'},
+        {'v': [{'v': 'CT'}, {'v': 'SEG'}]},
+        {'v': [{'v': {'f': [{'v': 'liver'}, {'v': '10.5'}]}}]}
+    ]}
+    empty_row = {'f': [{'v': '1.2.4'}, {'v': None}, {'v': None}, {'v': None}, {'v': None}, {'v': []}, {'v': []}]}
+
+    def test_decode_tuples(self):
+        rows = RowDecoder(self.schema).decode_rows([self.row, self.empty_row])
+        self.assertEqual(rows[0], (
+            '1.2.3', 2048, 2.5, True, datetime.datetime(2023, 11, 14, 22, 13, 20, tzinfo=datetime.timezone.utc),
+            ['CT', 'SEG'], [('liver', 10.5,)]
+        ))
+        self.assertEqual(rows[1], ('1.2.4', None, None, None, None, [], []))
+
+    def test_decode_namedtuples_and_columns(self):
+        row = RowDecoder(self.schema, 'namedtuple').decode_row(self.row)
+        self.assertEqual(row.instance_size, 2048)
+        self.assertEqual(row.segments[0].label, 'liver')
+        columns = RowDecoder(self.schema).decode_columns([self.row, self.empty_row])
+        self.assertEqual(columns['instance_size'], [2048, None])
+        self.assertEqual(columns['Modality'], [['CT', 'SEG'], []])
+
+
+class QueryAdmissionTest(TestCase):
+
+    def setUp(self):
+        self.dry_runs = []
+
+    def _dry_run(self, sql, parameters):
+        self.dry_runs.append(sql)
+        return 10 * 1024 ** 3
+
+    def _param(self, value):
+        return [{'name': 'collection', 'parameterType': {'type': 'STRING'}, 'parameterValue': {'value': value}}]
+
+    def test_dry_run_cached_by_shape(self):
+        admit_query("SELECT a FROM  t WHERE c = @collection", self._param('tcga_luad'), self._dry_run)
+        admit_query("SELECT a FROM t WHERE c = @collection", self._param('nlst'), self._dry_run)
+        self.assertEqual(len(self.dry_runs), 1)
+
+    def test_user_budget(self):
+        with patch.object(admission, 'BQ_MAX_BYTES_PER_USER', 25 * 1024 ** 3), \
+                patch.object(admission, '_usage_backend', admission.LocalUsageBackend()):
+            admit_query("SELECT b FROM t", None, self._dry_run, 'user@example.com')
+            admit_query("SELECT b FROM t", None, self._dry_run, 'user@example.com')
+            with self.assertRaises(QueryBudgetExceeded) as e:
+                admit_query("SELECT b FROM t", None, self._dry_run, 'user@example.com')
+            self.assertIsNotNone(e.exception.retry_after)
+            # Budgets are per user
+            admit_query("SELECT b FROM t", None, self._dry_run, 'other@example.com')
+
+    def test_query_limit(self):
+        with patch.object(admission, 'BQ_MAX_BYTES_PER_QUERY', 1024 ** 3):
+            with self.assertRaises(QueryBudgetExceeded):
+                admit_query("SELECT c FROM t", None, self._dry_run)
+
+
+# Stand-in for tabledata.insertAll which fails rows on request: rows whose 'fail' field is 'invalid' are always
+# rejected, and rows with a 'flaky' count fail with 'backendError' that many times
+class FakeTableData(object):
+
+    def __init__(self):
+        self.requests = []
+        self.attempts = {}
+        self._lock = threading.Lock()
+
+    def insertAll(self, projectId, datasetId, tableId, body):
+        return SimpleNamespace(execute=lambda: self._insert(body))
+
+    def _insert(self, body):
+        errors = []
+        with self._lock:
+            self.requests.append(body)
+            for i, row in enumerate(body['rows']):
+                attempts = self.attempts[row['insertId']] = self.attempts.get(row['insertId'], 0) + 1
+                if row['json'].get('fail', None) == 'invalid':
+                    errors.append({'index': i, 'errors': [{'reason': 'invalid'}]})
+                elif attempts <= row['json'].get('flaky', 0):
+                    errors.append({'index': i, 'errors': [{'reason': 'backendError'}]})
+        return {'insertErrors': errors} if len(errors) else {}
+
+
+class StreamingInserterTest(TestCase):
+
+    def setUp(self):
+        self.table_data = FakeTableData()
+        self.service = SimpleNamespace(tabledata=lambda: self.table_data)
+
+    def test_pack_by_size(self):
+        inserter = StreamingInserter('p', 'd', 't', max_rows=100, max_bytes=1024)
+        batches, oversized = inserter.pack([{'value': 'x' * 200} for i in range(10)] + [{'value': 'x' * 2000}])
+        self.assertEqual(oversized, [10])
+        self.assertTrue(all(len(x) < 10 for x in batches))
+        self.assertEqual(sum(len(x) for x in batches), 10)
+
+    def test_retry_failed_rows(self):
+        rows = [{'id': i} for i in range(20)]
+        rows[3]['flaky'] = 2
+        rows[15]['fail'] = 'invalid'
+        with patch.object(streaming_insert, 'get_bigquery_service', return_value=self.service), \
+                patch.object(streaming_insert.time, 'sleep'):
+            response = StreamingInserter('p', 'd', 't', max_rows=5, workers=3).insert(rows)
+        self.assertEqual([x['index'] for x in response['insertErrors']], [15])
+        # Only the rows which failed were sent again, under their original insertIds
+        self.assertEqual(sum(len(x['rows']) for x in self.table_data.requests), 20 + 2)
+        self.assertEqual(len(self.table_data.attempts), 20)
+
+
+# Stand-in for the parts of the BigQuery API used by RowExporter: insertAll requests, and load jobs started with a
+# resumable upload, which complete as soon as they're polled
+class FakeBigQueryLoadService(object):
+
+    def __init__(self):
+        self.table_data = FakeTableData()
+        self.loaded_rows = []
+        self.jobs_inserted = []
+
+    def tabledata(self):
+        return self.table_data
+
+    def jobs(self):
+        return self
+
+    def insert(self, projectId, body, media_body=None):
+        self.jobs_inserted.append(body)
+        with gzip.GzipFile(fileobj=media_body.stream(), mode='rb') as load_file:
+            self.loaded_rows.extend([json.loads(x) for x in load_file.read().decode('utf-8').splitlines()])
+        return SimpleNamespace(next_chunk=lambda num_retries=0: (None, body))
+
+    def get(self, projectId, jobId, location=None):
+        return SimpleNamespace(execute=lambda num_retries=0: {'status': {'state': 'DONE'}})
+
+
+class RowExporterTest(TestCase):
+
+    def setUp(self):
+        self.service = FakeBigQueryLoadService()
+        self.rows = [{'cohort_id': 1, 'SeriesInstanceUID': "1.2.{}".format(i)} for i in range(50)]
+
+    def test_small_sets_stream(self):
+        response = RowExporter('p', 'd', 't', min_rows=100, bq_service=self.service).export(self.rows)
+        self.assertNotIn('insertErrors', response)
+        self.assertEqual(len(self.service.jobs_inserted), 0)
+        self.assertEqual(sum(len(x['rows']) for x in self.service.table_data.requests), 50)
+
+    def test_large_sets_load(self):
+        # Over the byte threshold part way through sizing the set up
+        exporter = RowExporter('p', 'd', 't', min_rows=100, min_bytes=1024, executing_project='p',
+                               bq_service=self.service)
+        response = exporter.export(self.rows)
+        self.assertNotIn('insertErrors', response)
+        self.assertEqual(len(self.service.table_data.requests), 0)
+        self.assertEqual(self.service.loaded_rows, self.rows)
+        self.assertEqual(self.service.jobs_inserted[0]['configuration']['load']['sourceFormat'], 'NEWLINE_DELIMITED_JSON')
+
+
+class BufferedMetricsWriterTest(TestCase):
+
+    def setUp(self):
+        self.table_data = FakeTableData()
+        self.patcher = patch.object(streaming_insert, 'get_bigquery_service',
+                                    return_value=SimpleNamespace(tabledata=lambda: self.table_data))
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_flush_on_batch_size_and_close(self):
+        writer = BufferedMetricsWriter(batch_size=10, flush_secs=60, project_id='p', dataset_id='d')
+        writer.add('page_views', [{'page': i} for i in range(25)])
+        writer.close()
+        self.assertEqual(writer.stats(), {'queued': 25, 'flushed': 25, 'dropped': 0, 'failed': 0, 'pending': 0})
+        self.assertEqual(sum(len(x['rows']) for x in self.table_data.requests), 25)
+
+    def test_drop_oldest(self):
+        writer = BufferedMetricsWriter(max_queued=5, batch_size=100, flush_secs=60, project_id='p', dataset_id='d')
+        writer.add('page_views', [{'page': i} for i in range(8)])
+        self.assertEqual(writer.stats()['dropped'], 3)
+        writer.close()
+        self.assertEqual([x['json']['page'] for x in self.table_data.requests[0]['rows']], [3, 4, 5, 6, 7])
+
+
+# Stand-in for the GCS objects API: list, compose (concatenating the sources' contents), insert and delete
+class FakeStorage(object):
+
+    def __init__(self, objects):
+        self.data = dict(objects)
+        self.compose_calls = []
+
+    def objects(self):
+        return self
+
+    def list(self, bucket, prefix, pageToken=None, fields=None):
+        names = sorted([x for x in self.data if x.startswith(prefix)])
+        start = int(pageToken or 0)
+        response = {'items': [{'name': x, 'size': str(len(self.data[x]))} for x in names[start:start+10]]}
+        if start + 10 < len(names):
+            response['nextPageToken'] = str(start + 10)
+        return SimpleNamespace(execute=lambda num_retries=0: response)
+
+    def compose(self, destinationBucket, destinationObject, body):
+        self.compose_calls.append(len(body['sourceObjects']))
+        self.data[destinationObject] = b"".join([self.data[x['name']] for x in body['sourceObjects']])
+        return SimpleNamespace(execute=lambda num_retries=0: {'size': str(len(self.data[destinationObject]))})
+
+    def insert(self, bucket, name, media_body):
+        self.data[name] = media_body.stream().read()
+        return SimpleNamespace(execute=lambda num_retries=0: {})
+
+    def delete(self, bucket, object):
+        del self.data[object]
+        return SimpleNamespace(execute=lambda num_retries=0: None)
+
+
+class ShardedExtractTest(TestCase):
+
+    def setUp(self):
+        self.export = BigQueryExport('p', 'd', 't', 'bucket', 'exports/manifest.csv.gz', None)
+        self.shards = {"exports/manifest-{:012d}.csv.gz".format(i): gzip.compress("row{}\n".format(i).encode()) for i in range(40)}
+        self.storage = FakeStorage(self.shards)
+        self.storage.data['exports/manifest-notes.txt'] = b"unrelated"
+
+    def test_compression_checked(self):
+        self.assertEqual(BigQueryExport._extract_compression('PARQUET'), 'ZSTD')
+        self.assertEqual(BigQueryExport._extract_compression('AVRO', 'DEFLATE'), 'DEFLATE')
+        with self.assertRaises(Exception):
+            BigQueryExport._extract_compression('CSV', 'SNAPPY')
+
+    def test_manifest(self):
+        manifest = self.export._finish_sharded_extract(self.storage, None, None, 'PARQUET', 'ZSTD', False)
+        self.assertEqual(len(manifest['shards']), 40)
+        self.assertEqual(manifest['shards'][0]['uri'], "gs://bucket/exports/manifest-000000000000.csv.gz")
+        self.assertEqual(manifest['total_size'], sum(len(x) for x in self.shards.values()))
+        self.assertIsNone(manifest['composed_uri'])
+
+    def test_compose_in_rounds(self):
+        bq_service = SimpleNamespace(tables=lambda: SimpleNamespace(get=lambda **kwargs: SimpleNamespace(
+            execute=lambda num_retries=0: {'schema': {'fields': [{'name': 'PatientID'}, {'name': 'gcs_url'}]}})))
+        manifest = self.export._finish_sharded_extract(
+            self.storage, bq_service, {'dataset_id': 'd', 'table_id': 't'}, 'CSV', 'GZIP', True)
+        # 41 sources (the header and 40 shards) take two rounds
+        self.assertEqual(self.storage.compose_calls, [32, 9, 2])
+        self.assertEqual(manifest['composed_uri'], "gs://bucket/exports/manifest.csv.gz")
+        self.assertEqual(gzip.decompress(self.storage.data['exports/manifest.csv.gz']).decode().splitlines(),
+                         ["PatientID,gcs_url"] + ["row{}".format(i) for i in range(40)])
+        # Only the composed object (and the unrelated one) are left
+        self.assertEqual(sorted(self.storage.data), ['exports/manifest-notes.txt', 'exports/manifest.csv.gz'])
+
+
+# Stand-in for jobs.query and jobs.getQueryResults: the query is either complete within its timeout, with its results
+# split across two pages, or still running
+class FakeQueryJobs(object):
+
+    def __init__(self, complete):
+        self.complete = complete
+        self.calls = []
+        self.job_ref = {'projectId': 'p', 'jobId': 'job1', 'location': 'US'}
+        self.schema = {'fields': [{'name': 'SeriesInstanceUID', 'type': 'STRING'}]}
+
+    def jobs(self):
+        return self
+
+    def _page(self, rows, page_token=None):
+        page = {'jobReference': self.job_ref, 'jobComplete': True, 'schema': self.schema, 'totalRows': '3',
+                'rows': [{'f': [{'v': x}]} for x in rows], 'totalBytesProcessed': '100'}
+        if page_token:
+            page['pageToken'] = page_token
+        return page
+
+    def query(self, projectId, body):
+        self.calls.append('query')
+        response = self._page(['1.1', '1.2'], 'next') if self.complete else {'jobReference': self.job_ref, 'jobComplete': False}
+        return SimpleNamespace(execute=lambda num_retries=0: response)
+
+    def getQueryResults(self, pageToken=None, **job_ref):
+        self.calls.append('getQueryResults')
+        page = self._page(['1.3']) if pageToken else self._page(['1.1', '1.2'], 'next')
+        return SimpleNamespace(execute=lambda num_retries=0: page)
+
+
+class FastQueryTest(TestCase):
+
+    def _bqs(self, complete):
+        bqs = BigQuerySupport(None, None, None, executing_project='p')
+        bqs.bq_service = FakeQueryJobs(complete)
+        return bqs
+
+    def test_results_in_query_response(self):
+        bqs = self._bqs(True)
+        results = bqs.execute_query("SELECT SeriesInstanceUID FROM t", with_schema=True)
+        self.assertEqual([x['f'][0]['v'] for x in results['results']], ['1.1', '1.2', '1.3'])
+        # The first page came with the query; only the rest needed fetching
+        self.assertEqual(bqs.bq_service.calls, ['query', 'getQueryResults'])
+
+    def test_fall_back_to_job(self):
+        bqs = self._bqs(False)
+        with patch.object(BigQuerySupport, 'await_job_is_done', return_value={
+                'jobReference': bqs.bq_service.job_ref, 'status': {'state': 'DONE'}}):
+            results = bqs.execute_query("SELECT SeriesInstanceUID FROM t")
+        self.assertEqual(len(results), 3)
+        self.assertEqual(bqs.bq_service.calls, ['query', 'getQueryResults', 'getQueryResults'])
+
+
+# Stand-in for jobs.getQueryResults over a finished job of total_rows rows, whose rows are their own indexes. Earlier
+# pages take longer to come back than later ones, so concurrent fetches complete out of order. Pages starting at or
+# beyond gate_start wait for the gate to open; short_pages caps the rows in any one response, as the API's response
+# size limit does. Pages after the first can report another totalRows, and rows from available_rows on are missing.
+class FakePagedResults(object):
+
+    def __init__(self, total_rows, page_size, short_pages=None, gate_start=None, reported_total=None,
+                 available_rows=None):
+        self.total_rows = total_rows
+        self.available_rows = total_rows if available_rows is None else available_rows
+        self.page_size = page_size
+        self.short_pages = short_pages
+        self.gate_start = gate_start
+        self.gate = threading.Event()
+        self.reported_total = reported_total
+        self.lock = threading.Lock()
+        self.started = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def jobs(self):
+        return self
+
+    def _page(self, start, count):
+        with self.lock:
+            self.started.append(start)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        if self.gate_start is not None and start >= self.gate_start:
+            self.gate.wait(5)
+        time.sleep(0.002 * max(self.total_rows - start, 0) / self.page_size)
+        count = max(min(count, self.short_pages or count, self.available_rows - start), 0)
+        with self.lock:
+            self.in_flight -= 1
+        return {
+            'totalRows': str(self.reported_total if start and self.reported_total else self.total_rows),
+            'rows': [{'f': [{'v': str(x)}]} for x in range(start, start + count)]
+        }
+
+    def getQueryResults(self, startIndex=0, maxResults=None, **job_ref):
+        return SimpleNamespace(execute=lambda num_retries=0: self._page(startIndex, maxResults))
+
+
+class IterJobResultsTest(TestCase):
+    job_ref = {'projectId': 'p', 'jobId': 'job1'}
+
+    def _iter(self, results, **kwargs):
+        bqs = BigQuerySupport(None, None, None, executing_project='p')
+        bqs.bq_service = results
+        patcher = patch('google_helpers.bigquery.bq_support.get_bigquery_service', return_value=results)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return bqs.iter_job_results(self.job_ref, page_size=results.page_size, **kwargs)
+
+    def test_ordered_and_bounded(self):
+        results = FakePagedResults(200, 10)
+        rows = []
+        for row in self._iter(results, max_parallel=3, max_buffered_pages=4):
+            index = int(row['f'][0]['v'])
+            rows.append(index)
+            # The page being read, plus at most max_buffered_pages requested ahead of it
+            self.assertLessEqual(len([x for x in results.started if x + results.page_size > index]), 5)
+        self.assertEqual(rows, list(range(200)))
+        self.assertLessEqual(results.max_in_flight, 3)
+        self.assertEqual(sorted(results.started), list(range(0, 200, 10)))
+
+    def test_short_and_empty_pages(self):
+        # Responses cut short are completed in line, in order
+        results = FakePagedResults(95, 10, short_pages=4)
+        self.assertEqual([int(x['f'][0]['v']) for x in self._iter(results, max_parallel=2)], list(range(95)))
+
+        # The first page's totalRows is kept even if a later page reports another
+        results = FakePagedResults(30, 10, reported_total=50)
+        self.assertEqual([int(x['f'][0]['v']) for x in self._iter(results, max_parallel=2)], list(range(30)))
+
+        # Empty pages are skipped rather than stalling the read
+        results = FakePagedResults(50, 10, available_rows=25)
+        self.assertEqual([int(x['f'][0]['v']) for x in self._iter(results, max_parallel=2)], list(range(25)))
+
+    def test_close_cancels_fetches(self):
+        results = FakePagedResults(100, 10, gate_start=30)
+        rows = self._iter(results, max_parallel=2, max_buffered_pages=4)
+        for i in range(11):
+            next(rows)
+        # Pages 10 and 20 have come back and 30 and 40 are held at the gate; 50, queued behind them, is cancelled
+        # when the generator is closed
+        rows.close()
+        results.gate.set()
+        time.sleep(0.2)
+        self.assertNotIn(60, results.started)
+        self.assertNotIn(50, results.started)
+
+
+class ResultCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache = BigQueryResultCache(LocalResultCacheBackend(max_entries=8))
+        self.calls = []
+
+    # A compute which waits for release before returning its result (or raising)
+    def _compute(self, release, result=None, error=None):
+        def compute():
+            self.calls.append(threading.current_thread().name)
+            release.wait(5)
+            if error:
+                raise error
+            return result
+        return compute
+
+    def _wait_for_waiters(self, count):
+        deadline = time.time() + 5
+        while self.cache.stats()['shared_flights'] < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_single_flight(self):
+        release = threading.Event()
+        compute = self._compute(release, [{'f': [{'v': '1'}]}])
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get_or_compute('k', compute)))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        self._wait_for_waiters(3)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        # One query ran, and every caller got its own copy of the result
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(results, [[{'f': [{'v': '1'}]}]] * 4)
+        results[0].append('changed')
+        self.assertEqual(self.cache.get_or_compute('k', compute), [{'f': [{'v': '1'}]}])
+        self.assertEqual(len(self.calls), 1)
+
+    def test_failed_compute_releases_waiters(self):
+        release = threading.Event()
+        errors = []
+        waiter_results = []
+
+        def leader():
+            try:
+                self.cache.get_or_compute('k', self._compute(release, error=Exception("Query failed")))
+            except Exception as e:
+                errors.append(str(e))
+        leading = threading.Thread(target=leader)
+        leading.start()
+        while not len(self.calls):
+            time.sleep(0.01)
+        waiting = threading.Thread(target=lambda: waiter_results.append(
+            self.cache.get_or_compute('k', lambda: ['own result'])))
+        waiting.start()
+        self._wait_for_waiters(1)
+        release.set()
+        leading.join(5)
+        waiting.join(5)
+        # The waiter wasn't left hanging on the failed query, and ran its own
+        self.assertEqual(errors, ["Query failed"])
+        self.assertEqual(waiter_results, [['own result']])
+
+    def test_uncached_results(self):
+        calls = []
+        compute = lambda: calls.append(1)
+        self.assertIsNone(self.cache.get_or_compute('k', compute))
+        self.assertIsNone(self.cache.get_or_compute('k', compute))
+        self.assertEqual(len(calls), 2)
+
+        rows = [{'f': [{'v': str(x)}]} for x in range(10)]
+        with patch.object(result_cache, 'BQ_RESULT_CACHE_MAX_ROWS', 5):
+            self.cache.get_or_compute('rows', lambda: rows)
+        self.assertIsNone(self.cache.backend.get('rows'))
+        with patch.object(result_cache, 'BQ_RESULT_CACHE_MAX_BYTES', 100):
+            self.cache.get_or_compute('bytes', lambda: {'results': rows, 'schema': None})
+        self.assertIsNone(self.cache.backend.get('bytes'))
+        self.assertEqual(self.cache.stats()['oversized'], 2)
+        self.cache.get_or_compute('rows', lambda: rows)
+        self.assertEqual(self.cache.backend.get('rows'), rows)
+
+
+# Stand-in for jobs.get and batched requests: each job ID maps to its status, or to an Exception raised for it. The
+# batch parts of jobs in fail_in_batch fail (while their individual requests succeed), and with fail_batches set, no
+# batch can be sent at all.
+class FakeJobStatuses(object):
+
+    def __init__(self, statuses, fail_in_batch=None, fail_batches=False):
+        self.statuses = statuses
+        self.fail_in_batch = fail_in_batch or []
+        self.fail_batches = fail_batches
+        self.batches = []
+        self.single_gets = []
+
+    def jobs(self):
+        return self
+
+    def _status(self, job_id):
+        status = self.statuses[job_id]
+        if isinstance(status, Exception):
+            raise status
+        return {'jobReference': {'jobId': job_id}, 'status': status}
+
+    def get(self, projectId, jobId):
+        def execute(num_retries=0):
+            self.single_gets.append(jobId)
+            return self._status(jobId)
+        return SimpleNamespace(jobId=jobId, execute=execute)
+
+    def new_batch_http_request(self, callback):
+        fake = self
+        parts = []
+
+        class Batch(object):
+            def add(self, request, request_id):
+                parts.append((request_id, request.jobId,))
+
+            def execute(self):
+                fake.batches.append([x[1] for x in parts])
+                if fake.fail_batches:
+                    raise Exception("Batch request failed")
+                for request_id, job_id in parts:
+                    try:
+                        if job_id in fake.fail_in_batch:
+                            raise Exception("Backend error")
+                        callback(request_id, fake._status(job_id), None)
+                    except Exception as e:
+                        callback(request_id, None, e)
+        return Batch()
+
+
+class JobSetStatusTest(TestCase):
+    statuses = {
+        'done': {'state': 'DONE'},
+        'running': {'state': 'RUNNING'},
+        'failed': {'state': 'DONE', 'errorResult': {'reason': 'invalidQuery'}},
+        'pending': {'state': 'PENDING'},
+        'missing': Exception("Not found")
+    }
+
+    def _bqs(self, service):
+        bqs = BigQuerySupport(None, None, None, executing_project='p')
+        bqs.bq_service = service
+        return bqs
+
+    def _jobs(self):
+        return {x: {'jobReference': {'jobId': x}} for x in self.statuses}
+
+    def test_batched(self):
+        service = FakeJobStatuses(self.statuses)
+        with patch('google_helpers.bigquery.bq_support.BQ_POLL_BATCH_SIZE', 2):
+            statuses = self._bqs(service).get_job_set_status(self._jobs())
+            done = self._bqs(service).job_set_is_done(self._jobs())
+        # Jobs are sent in batches of BQ_POLL_BATCH_SIZE, and each status lands under its own key
+        self.assertEqual(service.batches[:3], [['done', 'running'], ['failed', 'pending'], ['missing']])
+        self.assertEqual(statuses['failed']['status']['errorResult']['reason'], 'invalidQuery')
+        self.assertEqual(statuses['running']['jobReference']['jobId'], 'running')
+        self.assertIsNone(statuses['missing'])
+        # A failed job is done; one whose status can't be found isn't
+        self.assertEqual(done, {'done': True, 'running': False, 'failed': True, 'pending': False, 'missing': False})
+
+    def test_fallback(self):
+        # Jobs whose part of the batch failed are checked individually
+        service = FakeJobStatuses(self.statuses, fail_in_batch=['running'])
+        statuses = self._bqs(service).get_job_set_status(self._jobs())
+        self.assertEqual(statuses['running']['status']['state'], 'RUNNING')
+        self.assertEqual(sorted(service.single_gets), ['missing', 'running'])
+
+        # As is every job, if the batch can't be sent
+        service = FakeJobStatuses(self.statuses, fail_batches=True)
+        statuses = self._bqs(service).get_job_set_status(self._jobs())
+        self.assertEqual(sorted(service.single_gets), sorted(self.statuses.keys()))
+        self.assertEqual(statuses['done']['status']['state'], 'DONE')
+        self.assertIsNone(statuses['missing'])
+
+
+# Stand-in for jobs.get and jobs.getQueryResults on a job which moves through the given states, one per poll. With
+# poll_error set, each long-poll raises it instead of returning, as getQueryResults does for a failed query.
+class FakeWaitJobs(object):
+
+    def __init__(self, states, poll_error=None):
+        self.states = states
+        self.poll_error = poll_error
+        self.polls = []
+        self.gets = 0
+        self.at = 0
+
+    def jobs(self):
+        return self
+
+    def get(self, projectId, jobId):
+        self.gets += 1
+        return SimpleNamespace(execute=lambda num_retries=0: {
+            'jobReference': {'projectId': projectId, 'jobId': jobId}, 'status': self.states[self.at]
+        })
+
+    def getQueryResults(self, timeoutMs, maxResults, projectId, jobId):
+        self.polls.append(timeoutMs)
+        self.at = min(self.at+1, len(self.states)-1)
+
+        def execute(num_retries=0):
+            if self.poll_error:
+                raise self.poll_error
+            return {'jobComplete': self.states[self.at]['state'] == 'DONE', 'totalRows': '0'}
+        return SimpleNamespace(execute=execute)
+
+
+class JobWaiterTest(TestCase):
+    job_ref = {'projectId': 'p', 'jobId': 'job_1'}
+
+    def setUp(self):
+        job_waiter.JOB_WAIT_STATS.clear()
+
+    def test_long_poll(self):
+        service = FakeWaitJobs([{'state': 'RUNNING'}, {'state': 'RUNNING'}, {'state': 'DONE'}])
+        with patch('google_helpers.bigquery.job_waiter.BQ_LONG_POLL_MS', 2000), \
+                patch('google_helpers.bigquery.job_waiter.time.sleep') as sleep:
+            job = wait_for_job(service, self.job_ref, deadline=60)
+        # Query jobs are waited on by long-polls which time out (jobComplete False) until the job is done, without
+        # sleeping in between
+        self.assertEqual(job['status']['state'], 'DONE')
+        self.assertEqual(service.polls, [2000, 2000])
+        self.assertEqual(service.gets, 3)
+        sleep.assert_not_called()
+        self.assertEqual(job_waiter.get_job_wait_stats()['query']['count'], 1)
+
+        # A long-poll never outlasts the deadline
+        service = FakeWaitJobs([{'state': 'RUNNING'}, {'state': 'DONE'}])
+        with patch('google_helpers.bigquery.job_waiter.time.sleep'):
+            wait_for_job(service, self.job_ref, deadline=1.5)
+        self.assertLessEqual(service.polls[0], 1500)
+
+    def test_backoff(self):
+        service = FakeWaitJobs([{'state': 'RUNNING'}]*5 + [{'state': 'DONE'}])
+        with patch('google_helpers.bigquery.job_waiter.BQ_BACKOFF_INITIAL', 1), \
+                patch('google_helpers.bigquery.job_waiter.BQ_BACKOFF_MAX', 3), \
+                patch('google_helpers.bigquery.job_waiter.time.sleep',
+                      side_effect=lambda secs: setattr(service, 'at', service.at+1)) as sleep:
+            job = wait_for_job(service, self.job_ref, deadline=60, job_type='extract')
+        self.assertEqual(job['status']['state'], 'DONE')
+        self.assertEqual(service.polls, [])
+        # Each pause is jittered between half and all of an interval which grows by BQ_BACKOFF_MULTIPLIER, up to
+        # BQ_BACKOFF_MAX
+        intervals = [1, 1.5, 2.25, 3, 3]
+        waits = [x[0][0] for x in sleep.call_args_list]
+        self.assertEqual(len(waits), len(intervals))
+        for wait, interval in zip(waits, intervals):
+            self.assertTrue(interval/2 <= wait <= interval, "{} not in [{}, {}]".format(wait, interval/2, interval))
+
+    def test_error_result(self):
+        failed = {'state': 'DONE', 'errorResult': {'reason': 'invalidQuery', 'message': 'Syntax error'}}
+        service = FakeWaitJobs(
+            [{'state': 'RUNNING'}, failed],
+            poll_error=HttpError(SimpleNamespace(status=400, reason='invalidQuery'), b'{}')
+        )
+        with patch('google_helpers.bigquery.job_waiter.time.sleep') as sleep:
+            job = wait_for_job(service, self.job_ref, deadline=60)
+        # The long-poll's error ends the wait, and the job's errorResult is returned to the caller
+        self.assertEqual(job['status']['errorResult']['reason'], 'invalidQuery')
+        self.assertEqual(len(service.polls), 1)
+        self.assertEqual(service.gets, 2)
+        sleep.assert_not_called()
+
+
+class FakeCredentials(object):
+
+    def __init__(self):
+        self.access_token = None
+        self.token_expiry = None
+
+    def create_scoped_required(self):
+        return True
+
+    def create_scoped(self, scopes):
+        return self
+
+    def authorize(self, http):
+        return http
+
+    def refresh(self, http):
+        self.access_token = "token"
+        self.token_expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+
+class ClientFactoryTest(TestCase):
+    scopes = ['https://www.googleapis.com/auth/bigquery']
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.fetches = []
+        patches = [
+            patch('google_helpers.client_factory.GOOGLE_DISCOVERY_CACHE_DIR', self.cache_dir.name),
+            patch('google_helpers.client_factory.GoogleCredentials.from_stream',
+                  side_effect=lambda path: FakeCredentials()),
+            patch('google_helpers.client_factory.discovery.build_from_document',
+                  side_effect=lambda doc, http=None: SimpleNamespace(doc=doc, http=http)),
+            patch.object(GoogleClientFactory, '_fetch_discovery_document',
+                         side_effect=lambda name, version: self.fetches.append(name) or json.dumps({'name': name}))
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.addCleanup(self.cache_dir.cleanup)
+
+    def test_discovery_tiers(self):
+        factory = GoogleClientFactory(credentials_file="key.json")
+        self.assertEqual(factory.get_discovery_document('bigquery', 'v2'), {'name': 'bigquery'})
+        factory.get_discovery_document('bigquery', 'v2')
+        self.assertEqual(self.fetches, ['bigquery'])
+        # A new process (or worker) finds the document on disk
+        restarted = GoogleClientFactory(credentials_file="key.json")
+        self.assertEqual(restarted.get_discovery_document('bigquery', 'v2'), {'name': 'bigquery'})
+        self.assertEqual(self.fetches, ['bigquery'])
+        self.assertEqual(factory.stats()['discovery_fetches'], 1)
+        self.assertEqual(restarted.stats()['discovery_fetches'], 0)
+        self.assertEqual(restarted.stats()['discovery_disk_hits'], 1)
+
+    def test_clients_and_tokens(self):
+        factory = GoogleClientFactory(credentials_file="key.json")
+        service = factory.get_service('bigquery', 'v2', self.scopes)
+        self.assertIs(factory.get_service('bigquery', 'v2', list(reversed(self.scopes))), service)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(factory.get_service('bigquery', 'v2', self.scopes)))
+        thread.start()
+        thread.join()
+        # Each thread gets its own client, over its own Http, from the one set of credentials
+        self.assertIsNot(other[0], service)
+        self.assertIsNot(other[0].http, service.http)
+        stats = factory.stats()
+        self.assertEqual((stats['clients_built'], stats['clients_reused'], stats['credential_loads'],
+                          stats['token_refreshes']), (2, 1, 1, 1))
+        # A token near its expiry is refreshed before the client is handed out
+        factory.get_credentials(self.scopes).token_expiry = datetime.datetime.utcnow() + datetime.timedelta(seconds=5)
+        factory.get_service('bigquery', 'v2', self.scopes)
+        self.assertEqual(factory.stats()['token_refreshes'], 2)
+
+
+class DiscoveryFetchTest(TestCase):
+
+    @patch('google_helpers.client_factory.time.sleep')
+    @patch('google_helpers.client_factory.httplib2.Http')
+    def test_retries(self, http, sleep):
+        # A server error, then a dropped connection, then the document
+        http.return_value.request.side_effect = [
+            (SimpleNamespace(status=503), b""), (SimpleNamespace(status=404), b""), OSError("Connection reset"),
+            (SimpleNamespace(status=200), b'{"name": "storage"}')
+        ]
+        self.assertEqual(GoogleClientFactory._fetch_discovery_document('storage', 'v1'), '{"name": "storage"}')
+        self.assertEqual(sleep.call_count, 1)
+
+        # A document which isn't found anywhere isn't retried
+        sleep.reset_mock()
+        http.return_value.request.side_effect = [(SimpleNamespace(status=404), b"")] * 2
+        with self.assertRaises(Exception):
+            GoogleClientFactory._fetch_discovery_document('storage', 'v9')
+        self.assertEqual(sleep.call_count, 0)
+
+
+class FakeLoadJobs(object):
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.gets = 0
+
+    def jobs(self):
+        return self
+
+    def get(self, projectId, jobId, location=None):
+        status = self.statuses[min(self.gets, len(self.statuses)-1)]
+        self.gets += 1
+        return SimpleNamespace(execute=lambda num_retries=0: {'status': status})
+
+
+class PollJobTest(TestCase):
+    job = {
+        'jobReference': {'projectId': 'idc-dev', 'jobId': 'load_1'},
+        'configuration': {'load': {'destinationTable': {'tableId': 'dicom_all'}}}
+    }
+
+    def test_done(self):
+        service = FakeLoadJobs([{'state': 'RUNNING'}, {'state': 'DONE'}])
+        poll_job(service, self.job, deadline=5)
+        self.assertEqual(service.gets, 2)
+
+    def test_deadline(self):
+        service = FakeLoadJobs([{'state': 'RUNNING'}])
+        with self.assertRaisesRegex(RuntimeError, "did not complete within"):
+            poll_job(service, self.job, deadline=0.2)
+        self.assertGreater(service.gets, 1)
+
+    def test_errors(self):
+        with self.assertRaises(RuntimeError):
+            poll_job(FakeLoadJobs([{'state': 'DONE', 'errorResult': {'reason': 'invalid'}}]), self.job, deadline=5)
+        with self.assertRaisesRegex(RuntimeError, "invalid"):
+            poll_job(FakeLoadJobs([{'state': 'DONE', 'errors': [{'reason': 'invalid'}]}]), self.job, deadline=5)
+
+
+class GcsPathSourceTest(TestCase):
+    paths = {
+        'f1': {'case_barcode': 'TCGA-01', 'sample_barcode': None, 'case_gdc_id': 'c1', 'sample_gdc_id': None,
+               'gcs_path': 'gs://bucket/f1.bam'},
+        'f2': {'case_barcode': 'TCGA-02', 'sample_barcode': 'TCGA-02-01A', 'case_gdc_id': 'c2', 'sample_gdc_id': 's2',
+               'gcs_path': 'gs://bucket/f2.bam'}
+    }
+
+    def setUp(self):
+        self.bqs = BigQueryGcsPathSupport('isb-cgc', 'temp', 'paths_hg38')
+
+    def test_build_paths_parameter(self):
+        param = BigQueryGcsPathSupport.build_paths_parameter(self.bqs._build_rows(self.paths), 'file_paths')
+        self.assertEqual(param['name'], 'file_paths')
+        self.assertEqual([x['name'] for x in param['parameterType']['arrayType']['structTypes']],
+                         [x['name'] for x in gcs_path_support.TEMP_PATH_SCHEMA['fields']])
+        first = param['parameterValue']['arrayValues'][0]['structValues']
+        self.assertEqual(first['file_gcs_path'], {'value': 'gs://bucket/f1.bam'})
+        # NULLs are given by omission
+        self.assertEqual(first['sample_barcode'], {})
+
+    def test_get_paths_source(self):
+        source = self.bqs.get_paths_source(self.paths)
+        self.assertEqual(source['table_clause'], "UNNEST(@paths)")
+        self.assertEqual(len(source['parameters'][0]['parameterValue']['arrayValues']), 2)
+
+        # Sets too large for a parameter are written to the path table
+        with patch.object(gcs_path_support, 'BQ_PATH_PARAM_MAX_ROWS', 1):
+            with patch.object(BigQueryGcsPathSupport, 'add_temp_path_table',
+                              return_value={'kind': 'bigquery#tableDataInsertAllResponse'}):
+                source = self.bqs.get_paths_source(self.paths)
+            self.assertEqual(source, {'table_clause': "`isb-cgc.temp.paths_hg38`", 'parameters': []})
+            with patch.object(BigQueryGcsPathSupport, 'add_temp_path_table', return_value={'status': 'FAILED'}):
+                self.assertIsNone(self.bqs.get_paths_source(self.paths))
+
+    def test_execute_query_with_paths(self):
+        with patch.object(BigQuerySupport, 'execute_query_and_fetch_results', return_value=[]) as execute:
+            self.bqs.execute_query_with_paths("SELECT file_gcs_path FROM {paths} f WHERE f.case_barcode = @case",
+                                              self.paths, [{'name': 'case'}])
+        query, params = execute.call_args[0]
+        self.assertEqual(query, "SELECT file_gcs_path FROM UNNEST(@paths) f WHERE f.case_barcode = @case")
+        self.assertEqual([x['name'] for x in params], ['case', 'paths'])
@@ -0,0 +1,88 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import re
+import logging
+from django.conf import settings
+
+logger = logging.getLogger('main_logger')
+
+# Plan get_bq_metadata queries: prune unused joins, search child records with one grouped scan rather than an
+# INTERSECT DISTINCT chain, and UNION ALL image tables which can't share rows. Every rewrite returns the same rows as
+# the unplanned query.
+BQ_QUERY_PLANNER = getattr(settings, 'BQ_QUERY_PLANNER', True)
+
+# Record identifiers unique across all data versions: a record with one of these is in only one image table
+UNIQUE_RECORD_KEYS = ["StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID"]
+
+
+# The set of child record IDs (eg. a study's StudyInstanceUID) with at least one record matching each of the
+# conditions, from a single grouped scan of the table. Equivalent to intersecting one
+#   SELECT search_by FROM table WHERE TRUE AND (condition) cart_clause GROUP BY search_by
+# subquery per condition, but reads the table once instead of once per condition.
+def child_record_filter(search_by, table_clause, cart_clause, conditions):
+    return """
+        SELECT {search_by}
+        FROM {table_clause}
+        WHERE TRUE {cart_clause}
+        GROUP BY {search_by}
+        HAVING {having}
+    """.format(
+        search_by=search_by, table_clause=table_clause, cart_clause=cart_clause,
+        having=" AND ".join(["COUNTIF({}) > 0".format(x) for x in conditions])
+    )
+
+
+# Drop the joins whose table supplies none of the query's output or grouping. Each join is a dict of its table
+# 'alias', its SQL 'clause', and whether it's a LEFT join; only LEFT joins are dropped, as an inner join also filters
+# the rows, and only when the query is grouped, as an unused LEFT join can still repeat rows.
+#
+# referenced_sql is the rest of the query (its field, where, group and order clauses)
+# returns: the joins to keep
+def prune_joins(joins, referenced_sql, grouped):
+    kept = []
+    for join in joins:
+        if join['left'] and grouped and not re.search(r'\b{}\.'.format(re.escape(join['alias'])), referenced_sql):
+            logger.debug("[STATUS] Dropping unused join of {}".format(join['alias']))
+            continue
+        kept.append(join)
+    return kept
+
+
+# Whether the union branches (each a dict of its table 'alias', 'aggregate_level', the names of its data 'versions',
+# and its selected 'fields' and 'group_by' columns) can't produce the same row, so UNION ALL gives the same result as
+# UNION DISTINCT. That holds when each branch is grouped on exactly what it selects--so has no duplicates of its
+# own--including its table's record key, and no two branches' tables hold the same data set (any version of it).
+def union_is_disjoint(branches):
+    if len(branches) < 2:
+        return True
+    seen_versions = set()
+    for branch in branches:
+        if branch['aggregate_level'] not in UNIQUE_RECORD_KEYS:
+            return False
+        key = "{}.{}".format(branch['alias'], branch['aggregate_level'])
+        if not branch['group_by'] or set(branch['group_by']) != set(branch['fields']) or key not in branch['fields']:
+            return False
+        versions = set(branch['versions'])
+        if not len(versions) or len(versions & seen_versions):
+            return False
+        seen_versions |= versions
+    return True
+
+
+# The column references ("alias.column") in a comma-joined field clause
+def field_columns(field_clauses):
+    return [y.strip() for x in field_clauses for y in x.split(",") if len(y.strip())]
@@ -0,0 +1,221 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import re
+import copy
+import time
+import logging
+from django.conf import settings
+from idc_collections.metadata_cache import MetadataCache, make_cache_key
+
+logger = logging.getLogger('main_logger')
+
+# Cache the SQL built for each query shape (see compiled_query), so requests which differ only in their filter
+# values skip the rebuild--and get byte-identical SQL, which BigQuery's own result cache needs to hit
+BQ_SQL_TEMPLATE_CACHE = getattr(settings, 'BQ_SQL_TEMPLATE_CACHE', True)
+BQ_SQL_TEMPLATE_CACHE_SIZE = getattr(settings, 'BQ_SQL_TEMPLATE_CACHE_SIZE', 512)
+BQ_SQL_TEMPLATE_CACHE_TTL = getattr(settings, 'BQ_SQL_TEMPLATE_CACHE_TTL', 3600)
+
+BQ_SQL_TEMPLATES = MetadataCache("bq_sql_templates", max_entries=BQ_SQL_TEMPLATE_CACHE_SIZE, ttl=BQ_SQL_TEMPLATE_CACHE_TTL)
+
+# Matches the builders' test for whether a string value is numeric
+_NON_NUMERIC = re.compile(r'[^0-9\.,]', re.UNICODE)
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+# Token for the kind of a single filter value: the builders choose the SQL they emit (IS NULL, a STRING or NUMERIC
+# comparison) by kind, never by the value itself
+def _value_token(value):
+    if value == 'None':
+        return 'None'
+    if isinstance(value, bool):
+        raise _Uncacheable()
+    if isinstance(value, int):
+        return 'i'
+    if isinstance(value, float):
+        return 'f'
+    if isinstance(value, str):
+        return 's' if _NON_NUMERIC.search(value) else 'n'
+    raise _Uncacheable()
+
+
+def _values_shape(values):
+    if isinstance(values, list):
+        return [_values_shape(x) for x in values]
+    return _value_token(values)
+
+
+# The shape of a filter set: its attributes, any value operators, and the number, nesting and kind of each one's
+# values. Filter sets with the same shape produce the same SQL, up to the values themselves.
+def filter_shape(filters):
+    shape = []
+    for attr in sorted(filters.keys()):
+        if 'MUT:' in attr:
+            # Mutation filters look their values up to decide what to emit
+            raise _Uncacheable()
+        values = filters[attr]
+        if isinstance(values, dict):
+            shape.append([attr, {x: (_values_shape(y) if x == 'values' else y) for x, y in values.items()}])
+        else:
+            shape.append([attr, _values_shape(values)])
+    return shape
+
+
+# Placeholder for the index'th value, of the same kind as the value, which can't turn up in any SQL by chance. String
+# placeholders are mixed-case, so one which a builder lower-cased can be told apart.
+def _sentinel(index, token):
+    digits = "73519{:07d}37".format(index)
+    if token == 'i':
+        return int(digits)
+    if token == 'f':
+        return float(digits)
+    if token == 'n':
+        return digits
+    return "Qzx{:07d}Qzx".format(index)
+
+
+# Walk a filter set in a fixed order, replacing each value (other than 'None') with replace(value); keys are sorted,
+# so filter sets with the same content produce the same SQL regardless of the order they were built in
+def _map_values(filters, replace):
+    def _map(values):
+        if isinstance(values, list):
+            return [_map(x) for x in values]
+        return values if values == 'None' else replace(values)
+
+    mapped = {}
+    for attr in sorted(filters.keys()):
+        values = filters[attr]
+        if isinstance(values, dict):
+            mapped[attr] = {x: (_map(y) if x == 'values' else y) for x, y in values.items()}
+        else:
+            mapped[attr] = _map(values)
+    return mapped
+
+
+def _filter_values(filters):
+    values = []
+    _map_values(filters, lambda x: values.append(x) or x)
+    return values
+
+
+def _param_values(params):
+    found = []
+
+    def _walk(node):
+        if isinstance(node, dict):
+            for key, val in node.items():
+                if key == 'value':
+                    found.append(val)
+                else:
+                    _walk(val)
+        elif isinstance(node, list):
+            for item in node:
+                _walk(item)
+    _walk(params)
+    return found
+
+
+# Build a query with every filter value replaced by a placeholder, and check that each placeholder comes through
+# intact--as SQL text or a parameter value--so the output can be re-bound to other values of the same shape. Returns
+# None if it can't.
+def _compile(build, filters):
+    sentinels = []
+
+    def _replace(value):
+        sentinels.append(_sentinel(len(sentinels), _value_token(value)))
+        return sentinels[-1]
+
+    query = build(_map_values(filters, _replace))
+    params = _param_values(query['params'])
+    for sentinel in sentinels:
+        as_str = str(sentinel)
+        if as_str not in query['sql'] and as_str.lower() not in query['sql'] \
+                and sentinel not in params and as_str.lower() not in params:
+            # The builder used the value to decide what to emit, rather than emitting it
+            return None
+    return {'query': query, 'sentinels': sentinels}
+
+
+# Substitute the given values for a compiled template's placeholders
+def _bind(template, values):
+    query = copy.deepcopy(template['query'])
+    sql = query['sql']
+    by_sentinel = {}
+    for sentinel, value in zip(template['sentinels'], values):
+        by_sentinel[sentinel] = value
+        if isinstance(sentinel, str):
+            by_sentinel[sentinel.lower()] = value.lower() if sentinel.lower() != sentinel else value
+            sql = sql.replace(sentinel, str(value)).replace(sentinel.lower(), str(value).lower())
+        else:
+            sql = sql.replace(str(sentinel), str(value))
+    query['sql'] = sql
+
+    def _walk(node):
+        if isinstance(node, dict):
+            for key, val in node.items():
+                if key == 'value':
+                    try:
+                        if val in by_sentinel:
+                            node[key] = by_sentinel[val]
+                    except TypeError:
+                        pass
+                else:
+                    _walk(val)
+        elif isinstance(node, list):
+            for item in node:
+                _walk(item)
+    _walk(query['params'])
+    return query
+
+
+# Build a query through a template cache keyed on its shape. build(filters) must return a dict with at least 'sql'
+# and 'params' (the query's parameters), and depend on the filters only through their shape and values; key_parts is
+# everything else it depends on. The first query of a shape is built with placeholders for its values and cached;
+# every query of that shape then has its own values bound into a copy.
+#
+# Filter sets which can't be templated (eg. mutation filters) are just built, with their keys sorted.
+def compiled_query(kind, build, filters, *key_parts):
+    filters = filters or {}
+    if not BQ_SQL_TEMPLATE_CACHE:
+        return build(_map_values(filters, lambda x: x))
+    start = time.time()
+    try:
+        key = make_cache_key(kind, filter_shape(filters), *key_parts)
+    except _Uncacheable:
+        return build(_map_values(filters, lambda x: x))
+    template = BQ_SQL_TEMPLATES.get(key)
+    if template is None:
+        try:
+            template = _compile(build, filters)
+        except _Uncacheable:
+            template = None
+        # Shapes which can't be templated are remembered too, so they're only tried once
+        BQ_SQL_TEMPLATES.put(key, template or False)
+        if template is None:
+            logger.debug("[STATUS] Filters for {} query can't be templated; building directly.".format(kind))
+            return build(_map_values(filters, lambda x: x))
+    elif template is False:
+        return build(_map_values(filters, lambda x: x))
+    query = _bind(template, _filter_values(filters))
+    logger.debug("[BENCHMARKING] {} query from template in {}s".format(kind, str(round(time.time() - start, 4))))
+    return query
+
+
+def get_sql_template_stats():
+    return BQ_SQL_TEMPLATES.stats()
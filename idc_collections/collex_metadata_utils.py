@@ -23,17 +23,26 @@ import re
 from uuid import uuid4
 import os
 import io
-from time import sleep
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from idc_collections.models import Collection, Attribute_Tooltips, DataSource, Attribute, \
     Attribute_Display_Values, Program, DataVersion, DataSourceJoin, DataSetType, Attribute_Set_Type, \
     ImagingDataCommonsVersion
 
+from idc_collections.metadata_cache import MetadataCache, canonical_filters, make_cache_key
+from idc_collections.bq_sql_templates import compiled_query
+from idc_collections.bq_query_planner import BQ_QUERY_PLANNER, child_record_filter, prune_joins, union_is_disjoint, \
+    field_columns
 from solr_helpers import *
+from solr_helpers.query_recorder import SOLR_QUERY_RECORDER, record_solr_query
 from google_helpers.bigquery.bq_support import BigQuerySupport
+from google_helpers.bigquery.result_cache import bq_result_cache_key, cached_bq_result
+from google_helpers.bigquery.row_decoder import make_result_schema
 from google_helpers.bigquery.export_support import BigQueryExportFileList
 from google_helpers.bigquery.utils import build_bq_filter_and_params as build_bq_filter_and_params_
 import hashlib
 from django.conf import settings
+from django.db import connection
 from django.shortcuts import render, redirect
 from django.urls import reverse
 import math
@@ -47,6 +56,48 @@ from google.auth import jwt
 BQ_ATTEMPT_MAX = 10
 MAX_FILE_LIST_ENTRIES = settings.MAX_FILE_LIST_REQUEST
 
+# Speculative prefetching of explorer refinements. When enabled, each answered explorer request schedules a
+# small number of background fetches for the most likely next clicks--the highest-count values of the most
+# frequently filtered attributes--so the follow-up request can be served out of EXPLORER_RESULT_CACHE.
+EXPLORER_PREFETCH = getattr(settings, 'EXPLORER_PREFETCH', False)
+EXPLORER_PREFETCH_WITH_DOCS = getattr(settings, 'EXPLORER_PREFETCH_WITH_DOCS', False)
+EXPLORER_PREFETCH_REFINEMENTS = getattr(settings, 'EXPLORER_PREFETCH_REFINEMENTS', 6)
+EXPLORER_PREFETCH_VALUES_PER_ATTR = getattr(settings, 'EXPLORER_PREFETCH_VALUES_PER_ATTR', 2)
+EXPLORER_PREFETCH_WORKERS = getattr(settings, 'EXPLORER_PREFETCH_WORKERS', 2)
+EXPLORER_PREFETCH_MAX_PENDING = getattr(settings, 'EXPLORER_PREFETCH_MAX_PENDING', 12)
+EXPLORER_CACHE_SIZE = getattr(settings, 'EXPLORER_CACHE_SIZE', 256)
+EXPLORER_CACHE_TTL = getattr(settings, 'EXPLORER_CACHE_TTL', 3600)
+
+# Aggregate levels of image data sources, coarsest first
+IMAGE_AGGREGATE_LEVELS = ["PatientID", "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID"]
+# Attributes with a single value for all records of a patient, in addition to the aggregate level keys themselves;
+# filtering or faceting on these gives the same answer at any aggregate level
+AGGREGATE_LEVEL_INVARIANT_ATTRS = getattr(settings, 'AGGREGATE_LEVEL_INVARIANT_ATTRS', ["collection_id", "program_name"])
+
+# Use the Solr /export handler for manifest record extraction
+SOLR_MANIFEST_EXPORT = getattr(settings, 'SOLR_MANIFEST_EXPORT', True)
+# Compute all BigQuery facet counts for an image table in a single query, rather than one job per facet
+BQ_FACET_SINGLE_QUERY = getattr(settings, 'BQ_FACET_SINGLE_QUERY', True)
+# Result shapes of the facet count queries; values are kept as the API's strings, as they key the facet count dicts
+BQ_FACET_SCHEMA = make_result_schema(('value', 'STRING'), ('count', 'INTEGER'))
+BQ_COMBINED_FACET_SCHEMA = make_result_schema(('facet', 'STRING'), ('value', 'STRING'), ('count', 'INTEGER'))
+
+# Bucket continuous numeric BigQuery facets with RANGE_BUCKET lookups rather than CASE chains; the bucket bounds and
+# labels are cached per attribute and data version
+BQ_RANGE_BUCKETS = getattr(settings, 'BQ_RANGE_BUCKETS', True)
+BQ_RANGE_BUCKET_CACHE_SIZE = getattr(settings, 'BQ_RANGE_BUCKET_CACHE_SIZE', 512)
+BQ_RANGE_BUCKET_CACHE_TTL = getattr(settings, 'BQ_RANGE_BUCKET_CACHE_TTL', 3600)
+
+# Pass BigQuery cart predicates as one array parameter per hierarchy level, rather than a clause per cart partition
+BQ_CART_ARRAY_PARAMS = getattr(settings, 'BQ_CART_ARRAY_PARAMS', True)
+# The levels of a cart partition's IDs, in order
+CART_PARTITION_LEVELS = ["collection_id", "PatientID", "StudyInstanceUID", "SeriesInstanceUID"]
+
+# Per-attribute Solr facet count caching
+SOLR_FACET_CACHE = getattr(settings, 'SOLR_FACET_CACHE', True)
+SOLR_FACET_CACHE_SIZE = getattr(settings, 'SOLR_FACET_CACHE_SIZE', 4096)
+SOLR_FACET_CACHE_TTL = getattr(settings, 'SOLR_FACET_CACHE_TTL', 3600)
+
 logger = logging.getLogger('main_logger')
 
 BMI_MAPPING = {
@@ -77,6 +128,30 @@ BMI_MAPPING = {
 DATA_SOURCE_ATTR = {}
 DATA_SOURCE_TYPES = {}
 SOLR_FACETS = {}
+# Attribute names by data source ID, and known DataSourceJoin pairs, for aggregate level routing
+DATA_SOURCE_ATTR_NAMES = {}
+DATA_SOURCE_JOINS = {}
+
+# Explorer results by request fingerprint, filled by both answered requests and speculative prefetches
+EXPLORER_RESULT_CACHE = MetadataCache("explorer_results", max_entries=EXPLORER_CACHE_SIZE, ttl=EXPLORER_CACHE_TTL)
+# Number of explorer requests which filtered on a given attribute, used to rank prefetch candidates
+EXPLORER_ATTR_USAGE = {}
+EXPLORER_PREFETCH_STATS = {'scheduled': 0, 'completed': 0, 'failed': 0, 'dropped': 0, 'skipped': 0}
+_explorer_prefetch_lock = threading.Lock()
+_explorer_prefetch_slots = threading.BoundedSemaphore(EXPLORER_PREFETCH_MAX_PENDING)
+_explorer_prefetch_in_flight = set()
+_explorer_prefetch_pool = None
+_explorer_prefetch_pid = None
+
+# Formatted facet counts for a single attribute of a single source. Because facets are built with excludeTags, an
+# attribute's counts depend only on the filters applied to every *other* attribute, so the cache is keyed on that
+# complement; toggling a value of attribute Y leaves attribute X's entry valid.
+SOLR_FACET_COUNTS = MetadataCache("solr_facet_counts", max_entries=SOLR_FACET_CACHE_SIZE, ttl=SOLR_FACET_CACHE_TTL)
+
+# Bucket bounds and labels of continuous numeric attributes, by attribute and data version
+BQ_RANGE_BUCKETS_BY_ATTR = MetadataCache(
+    "bq_range_buckets", max_entries=BQ_RANGE_BUCKET_CACHE_SIZE, ttl=BQ_RANGE_BUCKET_CACHE_TTL
+)
 
 TYPE_SCHEMA = {
     'sample_type': 'STRING',
@@ -166,6 +241,185 @@ def fetch_solr_stats(fetch_settings,cache_as=None):
     return stat_set
 
 
+# Build the facet cache key for each attribute faceted in a set of built Solr facets
+#
+# exclude_own_filter: True when the facets were built with excludeTags (the default facet counts), False when they
+# weren't (the 'filtered' facet counts), in which case the attribute's own filter is part of the key.
+def _solr_facet_cache_keys(source, version_names, solr_facets, filters, exclude_own_filter, query_context):
+    facet_attrs = {}
+    for facet in solr_facets.values():
+        if isinstance(facet, dict) and 'field' in facet:
+            # Null buckets of query facets aren't built with excludeTags, so those attributes can't be keyed
+            # on the complement filter set
+            facet_attrs[facet['field']] = facet_attrs.get(facet['field'], False) or facet.get('type') == 'query'
+    # build_solr_query tags each filter under its attribute name, suffix stripped as it strips it; where several
+    # filters share a name only the last one's tag survives, so that's the only filter excludeTags drops
+    tagged = {}
+    for x in (filters or {}):
+        if 'MUT:' not in x:
+            tagged[x[:x.rfind('_')] if re.search('_[gl]t[e]|_e?btwe?', x) else x] = x
+    keys = {}
+    for attr, is_query in facet_attrs.items():
+        exclude = [tagged[attr]] if (exclude_own_filter and not is_query and attr in tagged) else None
+        keys[attr] = make_cache_key(
+            "solr_facet", source.id, source.name, version_names, attr, exclude_own_filter,
+            canonical_filters(filters, exclude=exclude), query_context
+        )
+    return keys
+
+
+# Remove any attribute whose counts are already cached from a set of Solr facets and stats. Returns the facets and
+# stats still needing to be queried, and the cached counts by attribute name.
+def _split_cached_solr_facets(cache_keys, solr_facets, solr_stats):
+    cached = {}
+    for attr, key in cache_keys.items():
+        counts = SOLR_FACET_COUNTS.get(key)
+        if counts is not None:
+            cached[attr] = counts
+    if not cached:
+        return solr_facets, solr_stats, cached
+    facets_to_query = {
+        name: facet for name, facet in solr_facets.items() if not (isinstance(facet, dict) and facet.get('field') in cached)
+    }
+    stats_to_query = [x for x in (solr_stats or []) if x.split("}")[-1] not in cached] if solr_stats is not None else None
+    logger.debug("[STATUS] Facet counts for {} of {} attributes served from cache.".format(
+        len(cached), len(cache_keys)
+    ))
+    return facets_to_query, stats_to_query, cached
+
+
+# Store freshly counted facets and fold the cached ones back into a formatted Solr result
+def _merge_cached_solr_facets(solr_result, cache_keys, cached):
+    # Don't cache or merge into failed queries
+    if 'numFound' not in solr_result:
+        return solr_result
+    facets = solr_result.get('facets', None) or {}
+    for attr, key in cache_keys.items():
+        if attr not in cached and attr in facets:
+            SOLR_FACET_COUNTS.put(key, copy.deepcopy(facets[attr]))
+    for attr, counts in cached.items():
+        facets[attr] = copy.deepcopy(counts)
+    solr_result['facets'] = facets
+    return solr_result
+
+
+def _get_source_attr_names(source):
+    if source.id not in DATA_SOURCE_ATTR_NAMES:
+        DATA_SOURCE_ATTR_NAMES[source.id] = set(source.attribute_set.filter(active=True).values_list('name', flat=True))
+    return DATA_SOURCE_ATTR_NAMES[source.id]
+
+
+def _sources_are_joined(source_a, source_b):
+    pair = tuple(sorted([source_a.id, source_b.id]))
+    if pair not in DATA_SOURCE_JOINS:
+        DATA_SOURCE_JOINS[pair] = DataSourceJoin.objects.filter(
+            from_src__in=list(pair), to_src__in=list(pair)
+        ).exists()
+    return DATA_SOURCE_JOINS[pair]
+
+
+def _get_aggregate_level_rank(source):
+    return IMAGE_AGGREGATE_LEVELS.index(source.aggregate_level) \
+        if source.aggregate_level in IMAGE_AGGREGATE_LEVELS else len(IMAGE_AGGREGATE_LEVELS)
+
+
+# Determine if an image source can answer a counting request exactly as the finest-grained source would. Returns
+# None if it can, or the reason it can't.
+#
+# A coarser record holds the union of its child records' values, so a coarse record matching two filters may be
+# made up of children which each match only one of them. Counts are therefore only exact at a coarser level when
+# at most one level-varying attribute is constrained (by a filter, or by being the facet being counted), and counts
+# of finer-grained entities (eg. unique(SeriesInstanceUID) at the Study level) are only exact with no such filters.
+def _aggregate_level_insufficiency(source, baseline, filters, facets, counts, other_sources, min_level):
+    rank = _get_aggregate_level_rank(source)
+    if min_level and rank < IMAGE_AGGREGATE_LEVELS.index(min_level):
+        return "aggregate level {} is coarser than the required level {}".format(source.aggregate_level, min_level)
+
+    source_attrs = _get_source_attr_names(source)
+    other_attrs = set()
+    for other in other_sources:
+        if not _sources_are_joined(source, other):
+            return "no join to data source {}".format(other.name)
+        other_attrs |= _get_source_attr_names(other)
+
+    filter_attrs = {}
+    for attr, vals in (filters or {}).items():
+        attr_name = re.sub("(_ebtwe|_ebtw|_btwe|_btw|_lte|_lt|_gte|_gt)$", "", attr)
+        # Filters on non-image sources are joined in at the patient level and so don't vary by image level
+        if attr_name in other_attrs and attr_name not in _get_source_attr_names(baseline):
+            continue
+        is_and = isinstance(vals, dict) and (vals.get('op', None) or '').upper() == 'AND' and len(vals.get('values', [])) > 1
+        filter_attrs[attr_name] = filter_attrs.get(attr_name, False) or is_and
+
+    missing = [x for x in list(filter_attrs.keys()) + list(facets) + list(counts) if x not in source_attrs]
+    if len(missing):
+        return "missing attributes {}".format(missing)
+
+    if source.id == baseline.id:
+        return None
+
+    invariant = set(AGGREGATE_LEVEL_INVARIANT_ATTRS) | set(IMAGE_AGGREGATE_LEVELS[:rank+1])
+    varying_filters = [x for x in filter_attrs if x not in invariant]
+    # An AND across multiple values of one attribute needs them on the same record, just like two attributes
+    varying_weight = len(varying_filters) + len([x for x in varying_filters if filter_attrs[x]])
+    varying_facets = [x for x in facets if x not in invariant]
+    finer_counts = [x for x in counts if x in IMAGE_AGGREGATE_LEVELS and IMAGE_AGGREGATE_LEVELS.index(x) > rank]
+
+    if len(facets) and source.count_col != baseline.count_col:
+        return "facets would be counted on {} rather than {}".format(source.count_col, baseline.count_col)
+    if varying_weight > 1:
+        return "filters on multiple level-varying attributes {}".format(varying_filters)
+    if varying_weight == 1:
+        if len(finer_counts):
+            return "counts of {} with a filter on level-varying attribute {}".format(finer_counts, varying_filters)
+        if len([x for x in varying_facets if x not in varying_filters]):
+            return "facets on level-varying attributes with a filter on level-varying attribute {}".format(
+                varying_filters)
+    return None
+
+
+# Given a set of image data sources at different aggregate levels, pick the coarsest (ie. smallest) one which can
+# answer a counting request exactly. The finest-grained candidate is the fallback, as it's always exact.
+#
+# facets: names of the attributes being faceted
+# counts: names of the attributes being counted via uniques or totals
+# other_sources: the non-image sources which will be joined to the chosen source
+# min_level: the coarsest aggregate level acceptable to the caller, eg. for custom facets which need a given level
+def route_aggregate_level(candidates, filters=None, facets=None, counts=None, other_sources=None, min_level=None):
+    candidates = sorted(list(candidates), key=lambda x: _get_aggregate_level_rank(x))
+    baseline = candidates[-1]
+    facets = facets or []
+    counts = counts or []
+    other_sources = list(other_sources or [])
+    chosen = baseline
+    for source in candidates:
+        reason = _aggregate_level_insufficiency(source, baseline, filters, facets, counts, other_sources, min_level)
+        if reason is None:
+            chosen = source
+            break
+        logger.debug("[STATUS] Aggregate router rejected {} ({}): {}".format(source.name, source.aggregate_level, reason))
+    logger.info("[STATUS] Aggregate router selected {} ({}) from [{}] for filters {}, facets {}, counts {}".format(
+        chosen.name, chosen.aggregate_level, ", ".join([x.name for x in candidates]),
+        list((filters or {}).keys()), facets, counts
+    ))
+    return chosen
+
+
+# Narrow a set of Solr data sources holding image data at several aggregate levels down to the routed image source
+# and the non-image sources
+def route_sources(sources, filters=None, facets=None, counts=None, min_level=None):
+    image_ids = DataSetType.objects.get(data_type=DataSetType.IMAGE_DATA).datasource_set.all().values_list('id', flat=True)
+    image_sources = sources.filter(id__in=image_ids)
+    if len(set(image_sources.values_list('aggregate_level', flat=True))) <= 1:
+        return sources
+    other_sources = sources.exclude(id__in=image_ids)
+    if facets is None:
+        finest = sorted(list(image_sources), key=lambda x: _get_aggregate_level_rank(x))[-1]
+        facets = [x.name for x in finest.get_attr(for_faceting=True, for_ui=True)]
+    chosen = route_aggregate_level(image_sources, filters, facets, counts, other_sources, min_level)
+    return sources.filter(id__in=[chosen.id]+list(other_sources.values_list('id', flat=True)))
+
+
 # Helper method which, given a list of attribute names, a set of data version objects,
 # and a data source type, will produce a list of the Attribute ORM objects. Primarily
 # for use with the API, which will accept filter sets from users, who won't be able to
@@ -234,9 +488,140 @@ def sortNum(x):
             return float(strt)
 
 
+def _explorer_cache_key(filters, fields, metadata_args, source_ids, version_ids, record_source_id):
+    return make_cache_key(
+        "explorer", canonical_filters(filters), sorted([str(x) for x in (fields or [])]),
+        {x: metadata_args[x] for x in sorted(metadata_args.keys())}, sorted(source_ids), sorted(version_ids),
+        record_source_id
+    )
+
+
+def _record_explorer_attr_usage(filters):
+    with _explorer_prefetch_lock:
+        for attr in (filters or {}):
+            EXPLORER_ATTR_USAGE[attr] = EXPLORER_ATTR_USAGE.get(attr, 0) + 1
+
+
+# Pick the most likely one-step refinements of a filter set: the highest-count values of the most frequently
+# used categorical attributes which aren't already selected
+def _rank_explorer_refinements(filters, facet_counts, refinable_attrs, max_refinements):
+    filters = filters or {}
+    candidates = {}
+    for source in facet_counts:
+        for attr, vals in (facet_counts[source].get('facets', None) or {}).items():
+            if attr not in refinable_attrs or isinstance(filters.get(attr, None), dict) or not isinstance(vals, dict):
+                continue
+            selected = [str(x) for x in filters.get(attr, [])]
+            for val, count in vals.items():
+                if val in ['min_max', 'None'] or not isinstance(count, (int, float)) or count <= 0 or str(val) in selected:
+                    continue
+                if attr not in candidates:
+                    candidates[attr] = {}
+                candidates[attr][val] = max(count, candidates[attr].get(val, 0))
+
+    with _explorer_prefetch_lock:
+        usage = dict(EXPLORER_ATTR_USAGE)
+
+    refinements = []
+    for attr in sorted(candidates.keys(), key=lambda x: (-usage.get(x, 0), -max(candidates[x].values()), x)):
+        top_vals = sorted(candidates[attr].items(), key=lambda x: -x[1])[:EXPLORER_PREFETCH_VALUES_PER_ATTR]
+        for val, count in top_vals:
+            refined = copy.deepcopy(filters)
+            refined[attr] = list(refined.get(attr, [])) + [val]
+            refinements.append(refined)
+            if len(refinements) >= max_refinements:
+                return refinements
+    return refinements
+
+
+def _get_explorer_prefetch_pool():
+    global _explorer_prefetch_pool, _explorer_prefetch_pid, _explorer_prefetch_slots
+    with _explorer_prefetch_lock:
+        # Worker threads don't survive a fork, so a pool inherited from a parent process is replaced, along with the
+        # slots and in-flight keys of prefetches which were running in the parent and will never finish here
+        if _explorer_prefetch_pool is None or _explorer_prefetch_pid != os.getpid():
+            _explorer_prefetch_pool = ThreadPoolExecutor(
+                max_workers=EXPLORER_PREFETCH_WORKERS, thread_name_prefix="explorer_prefetch"
+            )
+            _explorer_prefetch_slots = threading.BoundedSemaphore(EXPLORER_PREFETCH_MAX_PENDING)
+            _explorer_prefetch_in_flight.clear()
+            _explorer_prefetch_pid = os.getpid()
+    return _explorer_prefetch_pool
+
+
+def _run_explorer_prefetch(cache_key, filters, fields, metadata_args, source_ids, version_ids, record_source_id):
+    try:
+        start = time.time()
+        sources = DataSource.objects.filter(id__in=source_ids)
+        versions = DataVersion.objects.filter(id__in=version_ids)
+        record_source = DataSource.objects.get(id=record_source_id) if record_source_id else None
+        result = get_collex_metadata(
+            filters, fields, sources=sources, versions=versions, record_source=record_source, **metadata_args
+        )
+        stop = time.time()
+        if result and 'total' in result:
+            EXPLORER_RESULT_CACHE.put(cache_key, result, origin="prefetch")
+            with _explorer_prefetch_lock:
+                EXPLORER_PREFETCH_STATS['completed'] += 1
+            logger.info("[BENCHMARKING] Time to prefetch explorer refinement: {}s".format(str(stop-start)))
+        else:
+            with _explorer_prefetch_lock:
+                EXPLORER_PREFETCH_STATS['failed'] += 1
+    except Exception as e:
+        with _explorer_prefetch_lock:
+            EXPLORER_PREFETCH_STATS['failed'] += 1
+        logger.error("[ERROR] While prefetching an explorer refinement:")
+        logger.exception(e)
+    finally:
+        with _explorer_prefetch_lock:
+            _explorer_prefetch_in_flight.discard(cache_key)
+        _explorer_prefetch_slots.release()
+        # Background threads get their own DB connection, which Django won't clean up for us
+        connection.close()
+
+
+# Queue up background fetches for a set of refined filters. Prefetching is strictly best-effort: refinements
+# already cached or in flight are skipped, and anything beyond EXPLORER_PREFETCH_MAX_PENDING outstanding fetches
+# is dropped rather than queued.
+def _schedule_explorer_prefetch(refinements, fields, metadata_args, source_ids, version_ids, record_source_id):
+    pool = _get_explorer_prefetch_pool()
+    for i, refined in enumerate(refinements):
+        cache_key = _explorer_cache_key(refined, fields, metadata_args, source_ids, version_ids, record_source_id)
+        with _explorer_prefetch_lock:
+            if cache_key in _explorer_prefetch_in_flight or EXPLORER_RESULT_CACHE.contains(cache_key):
+                EXPLORER_PREFETCH_STATS['skipped'] += 1
+                continue
+            if not _explorer_prefetch_slots.acquire(blocking=False):
+                EXPLORER_PREFETCH_STATS['dropped'] += len(refinements)-i
+                break
+            _explorer_prefetch_in_flight.add(cache_key)
+            EXPLORER_PREFETCH_STATS['scheduled'] += 1
+        try:
+            pool.submit(_run_explorer_prefetch, cache_key, refined, fields, metadata_args, source_ids, version_ids,
+                        record_source_id)
+        except Exception as e:
+            with _explorer_prefetch_lock:
+                _explorer_prefetch_in_flight.discard(cache_key)
+                EXPLORER_PREFETCH_STATS['dropped'] += 1
+            _explorer_prefetch_slots.release()
+            logger.error("[ERROR] While scheduling an explorer prefetch:")
+            logger.exception(e)
+
+
+# Counters for explorer prefetching, along with the hit rate of the explorer result cache; hits on
+# entries populated by a prefetch are reported under cache['hits_by_origin']['prefetch']
+def get_explorer_prefetch_stats():
+    with _explorer_prefetch_lock:
+        stats = dict(EXPLORER_PREFETCH_STATS)
+        stats['in_flight'] = len(_explorer_prefetch_in_flight)
+    stats['cache'] = EXPLORER_RESULT_CACHE.stats()
+    return stats
+
+
 # Build data exploration context/response
 def build_explorer_context(is_dicofdic, source, versions, filters, fields, order_docs, counts_only, with_related,
-                           with_derived, collapse_on, is_json, uniques=None, totals=None, disk_size=False):
+                           with_derived, collapse_on, is_json, uniques=None, totals=None, disk_size=False,
+                           prefetch=None):
     attr_by_source = {}
     attr_sets = {}
     context = {}
@@ -275,9 +660,20 @@ def build_explorer_context(is_dicofdic, source, versions, filters, fields, order
                 id__in=versions.get_data_sources().filter(source_type=source).values_list("id", flat=True)
             ).distinct().first()
 
+        # Count-only Solr requests are routed to the coarsest aggregate level which counts them exactly, so offer the
+        # series-level image data alongside the study-level sources; the attribute set is still taken from the latter
+        route_by_level = bool(counts_only and source == DataSource.SOLR)
+        count_sources = sources
+        if route_by_level:
+            count_sources = data_sets.get_data_sources().filter(
+                source_type=source,
+                aggregate_level__in=facet_aggregates+["SeriesInstanceUID"],
+                id__in=versions.get_data_sources().filter(source_type=source).values_list("id", flat=True)
+            ).distinct()
+
         source_attrs = fetch_data_source_attr(sources, {'for_ui': True, 'with_set_map': True, 'active_only': True}, cache_as="ui_faceting_set_map")
 
-        source_data_types = fetch_data_source_types(sources)
+        source_data_types = fetch_data_source_types(count_sources)
 
         for source in sources:
             is_origin = DataSetType.IMAGE_DATA in source_data_types[source.id]
@@ -301,6 +697,12 @@ def build_explorer_context(is_dicofdic, source, versions, filters, fields, order
                     attr_by_source[set_type]['attributes'].update(
                         {attr.name: {'source': source.id, 'obj': attr, 'vals': None, 'id': attr.id} for attr in attrs}
                     )
+        # Only categorical values can be prefetched as a simple one-value refinement
+        refinable_attrs = [
+            name for set_type in attr_by_source for name, attr in attr_by_source[set_type]['attributes'].items()
+            if attr['obj'].data_type != Attribute.CONTINUOUS_NUMERIC
+        ]
+
         custom_facets = None
 
         disk_size=True
@@ -318,12 +720,36 @@ def build_explorer_context(is_dicofdic, source, versions, filters, fields, order
 
             }
 
+        metadata_args = {
+            'record_limit': 3000, 'offset': 0, 'counts_only': counts_only, 'with_ancillary': with_related,
+            'collapse_on': collapse_on, 'order_docs': order_docs, 'uniques': uniques,
+            'search_child_records_by': None, 'totals': totals, 'custom_facets': custom_facets,
+            'route_by_level': route_by_level
+        }
+        prefetch = EXPLORER_PREFETCH if prefetch is None else prefetch
+        prefetch = prefetch and (counts_only or EXPLORER_PREFETCH_WITH_DOCS)
+        explorer_cache_key = None
+        source_metadata = None
+        if prefetch:
+            fields = list(fields)
+            source_ids = [x.id for x in count_sources]
+            version_ids = [x.id for x in versions]
+            record_source_id = record_source.id if record_source else None
+            explorer_cache_key = _explorer_cache_key(filters, fields, metadata_args, source_ids, version_ids,
+                                                     record_source_id)
+            _record_explorer_attr_usage(filters)
+            source_metadata = EXPLORER_RESULT_CACHE.get(explorer_cache_key)
+            # Entries are altered below, so work from a copy
+            source_metadata = copy.deepcopy(source_metadata) if source_metadata is not None else None
+
         start = time.time()
-        source_metadata = get_collex_metadata(
-            filters, fields, record_limit=3000, offset=0, counts_only=counts_only, with_ancillary=with_related,
-            collapse_on=collapse_on, order_docs=order_docs, sources=sources, versions=versions, uniques=uniques,
-            record_source=record_source, search_child_records_by=None, totals=totals, custom_facets=custom_facets
-        )
+        if source_metadata is None:
+            source_metadata = get_collex_metadata(
+                filters, fields, sources=count_sources, versions=versions, record_source=record_source,
+                **metadata_args
+            )
+            if prefetch and source_metadata and 'total' in source_metadata:
+                EXPLORER_RESULT_CACHE.put(explorer_cache_key, copy.deepcopy(source_metadata), origin="request")
         stop = time.time()
         logger.debug("[STATUS] Benchmarking: Time to collect metadata for source type {}: {}s".format(
             "BigQuery" if sources.first().source_type == DataSource.BIGQUERY else "Solr",
@@ -539,6 +965,14 @@ def build_explorer_context(is_dicofdic, source, versions, filters, fields, order
             if set_name in derived_display_info:
                 context['set_attributes']['derived_set'].get(key,{}).update(derived_display_info.get(set_name,{}))
 
+        if prefetch:
+            _schedule_explorer_prefetch(
+                _rank_explorer_refinements(filters, source_metadata.get('facets', {}), refinable_attrs,
+                                           EXPLORER_PREFETCH_REFINEMENTS),
+                fields, metadata_args, source_ids, version_ids, record_source_id
+            )
+            logger.debug("[STATUS] Explorer prefetch stats: {}".format(get_explorer_prefetch_stats()))
+
         if is_json:
             attr_by_source['programs'] = programSet
             attr_by_source['filtered_counts'] = filtered_attr_by_source
@@ -567,7 +1001,10 @@ def build_explorer_context(is_dicofdic, source, versions, filters, fields, order
     return None
 
 
-def filter_manifest(filters, sources, versions, fields, limit, offset, level="SeriesInstanceUID", with_size=False):
+# Fetch a manifest's worth of records. By default (SOLR_MANIFEST_EXPORT) Solr records are pulled through the /export
+# handler, or cursorMark paging if the fields lack docValues, rather than the standard /query handler
+def filter_manifest(filters, sources, versions, fields, limit, offset, level="SeriesInstanceUID", with_size=False,
+                    use_export=None):
     try:
         custom_facets = None
         search_by = {x: "StudyInstanceUID" for x in filters} if level == "SeriesInstanceUID" else None
@@ -582,7 +1019,8 @@ def filter_manifest(filters, sources, versions, fields, limit, offset, level="Se
             filters, fields, limit, offset, sources=sources, versions=versions, counts_only=False,
             collapse_on=level, records_only=bool(custom_facets is None),
             sort="PatientID asc, StudyInstanceUID asc, SeriesInstanceUID asc", filtered_needed=False,
-            search_child_records_by=search_by, custom_facets=custom_facets, default_facets=False
+            search_child_records_by=search_by, custom_facets=custom_facets, default_facets=False,
+            export_records=(SOLR_MANIFEST_EXPORT if use_export is None else use_export)
         )
 
         return records
@@ -600,7 +1038,11 @@ class Echo(object):
         return value
 
 
+# Build the BigQuery filter and parameters selecting the records of a set of cart partitions
 def parse_partition_to_filter(cart_partition):
+    if BQ_CART_ARRAY_PARAMS:
+        return compile_cart_partitions(cart_partition)
+
     cart_filters = None
     cart_params = None
     part_ids = ["collection_id", "PatientID", "StudyInstanceUID", "SeriesInstanceUID"]
@@ -646,6 +1088,93 @@ def parse_partition_to_filter(cart_partition):
     return { 'filter_string': cart_filter_str, 'parameters': cart_params }
 
 
+# The LOWER()ed key columns of a cart partition level, as a value comparable with that level's array parameter
+def _cart_key_expr(levels):
+    if len(levels) == 1:
+        return "LOWER({})".format(levels[0])
+    return "STRUCT({})".format(", ".join(["LOWER({0}) AS {0}".format(x) for x in levels]))
+
+
+# An array parameter of partition keys: an ARRAY<STRING> for collections, and an ARRAY<STRUCT> of the key columns
+# for every level below
+def _cart_key_param(name, levels, keys):
+    if len(levels) == 1:
+        return {
+            'name': name,
+            'parameterType': {'type': 'ARRAY', 'arrayType': {'type': 'STRING'}},
+            'parameterValue': {'arrayValues': [{'value': x[0]} for x in keys]}
+        }
+    return {
+        'name': name,
+        'parameterType': {
+            'type': 'ARRAY',
+            'arrayType': {
+                'type': 'STRUCT',
+                'structTypes': [{'name': x, 'type': {'type': 'STRING'}} for x in levels]
+            }
+        },
+        'parameterValue': {
+            'arrayValues': [{'structValues': {x: {'value': key[i]} for i, x in enumerate(levels)}} for key in keys]
+        }
+    }
+
+
+# Compile cart partitions into a filter whose SQL depends only on which hierarchy levels the partitions are at, not on
+# how many there are. Partitions are grouped by level, and each group matches its records' (LOWER()ed) key columns
+# against an array parameter of the group's keys. A partition with exclusions ('not') is matched the same way, plus
+# an anti-join of (key, child ID) against an array of its excluded children. Partitions are ORed, as in the
+# per-partition clauses: a record is only excluded if every partition with its key excludes it.
+def compile_cart_partitions(cart_partition):
+    included = {}
+    excluded = {}
+    for part in cart_partition:
+        if len(part['id']) > len(CART_PARTITION_LEVELS):
+            logger.warning("[WARNING] Found extra cart partition ID in manifest job submission!")
+            logger.warning("[WARNING] Extra id: {}".format(part['id'][len(CART_PARTITION_LEVELS):]))
+        key = tuple([str(x).lower() for x in part['id'][:len(CART_PARTITION_LEVELS)]])
+        if not len(key):
+            continue
+        nots = set([str(x).lower() for x in part['not']]) if len(key) < len(CART_PARTITION_LEVELS) else set()
+        if not len(nots):
+            included.setdefault(len(key), set()).add(key)
+        else:
+            by_key = excluded.setdefault(len(key), {})
+            by_key[key] = (by_key[key] & nots) if key in by_key else nots
+
+    # Anything a partition with the same key includes outright isn't excluded after all
+    for depth in excluded:
+        for key in list(excluded[depth].keys()):
+            if key in included.get(depth, set()):
+                del excluded[depth][key]
+            elif not len(excluded[depth][key]):
+                # The partitions with this key have no exclusion in common
+                del excluded[depth][key]
+                included.setdefault(depth, set()).add(key)
+
+    clauses = []
+    params = []
+    for depth in sorted(included.keys()):
+        levels = CART_PARTITION_LEVELS[:depth]
+        name = "cart_{}".format(levels[-1])
+        clauses.append("{} IN UNNEST(@{})".format(_cart_key_expr(levels), name))
+        params.append(_cart_key_param(name, levels, sorted(included[depth])))
+    for depth in sorted(excluded.keys()):
+        if not len(excluded[depth]):
+            continue
+        levels = CART_PARTITION_LEVELS[:depth]
+        child = CART_PARTITION_LEVELS[depth]
+        name = "cart_{}_excl".format(levels[-1])
+        clauses.append("({} IN UNNEST(@{}) AND {} IS NOT NULL AND {} NOT IN UNNEST(@{}_{}))".format(
+            _cart_key_expr(levels), name, child, _cart_key_expr(levels + [child]), name, child
+        ))
+        params.append(_cart_key_param(name, levels, sorted(excluded[depth].keys())))
+        params.append(_cart_key_param("{}_{}".format(name, child), levels + [child], sorted([
+            key + (x,) for key in excluded[depth] for x in excluded[depth][key]
+        ])))
+
+    return {'filter_string': "({})".format(" OR ".join(clauses) if len(clauses) else "FALSE"), 'parameters': params}
+
+
 # Manifest types supported: s5cmd, idc_index, json.
 def submit_manifest_job(data_version, filters, storage_loc, manifest_type, instructions, fields, cart_partition=None):
     cart_filters = parse_partition_to_filter(cart_partition) if cart_partition else None
@@ -965,7 +1494,8 @@ def get_collex_metadata(filters, fields, record_limit=3000, offset=0, counts_onl
                         collapse_on='PatientID', order_docs=None, sources=None, versions=None, with_derived=True,
                         facets=None, records_only=False, sort=None, uniques=None, record_source=None, totals=None,
                         search_child_records_by=None, filtered_needed=True, custom_facets=None, raw_format=False,
-                        default_facets=True, aux_sources=None):
+                        default_facets=True, aux_sources=None, export_records=False, route_by_level=False,
+                        min_level=None):
 
     try:
         source_type = sources.first().source_type if sources else DataSource.SOLR
@@ -990,6 +1520,14 @@ def get_collex_metadata(filters, fields, record_limit=3000, offset=0, counts_onl
         if len(versions.filter(active=False)) and len(sources.filter(source_type=DataSource.SOLR)):
             raise Exception("[ERROR] Can't request archived data from Solr, only BigQuery.")
 
+        # If we've been given image sources at more than one aggregate level, count using the coarsest one which
+        # gives an exact answer
+        if route_by_level and source_type == DataSource.SOLR and counts_only:
+            sources = route_sources(
+                sources, filters, facets if (facets or not default_facets) else None,
+                (uniques or []) + (totals or []), min_level
+            )
+
         start = time.time()
         logger.debug("Metadata fetch beginning:")
         if source_type == DataSource.BIGQUERY:
@@ -1003,7 +1541,7 @@ def get_collex_metadata(filters, fields, record_limit=3000, offset=0, counts_onl
                 filters, fields, sources, counts_only, collapse_on, record_limit, offset, facets, records_only, sort,
                 uniques, record_source, totals, search_child_records_by=search_child_records_by,
                 filtered_needed=filtered_needed, custom_facets=custom_facets, raw_format=raw_format,
-                default_facets=default_facets,aux_sources=aux_sources
+                default_facets=default_facets,aux_sources=aux_sources, export_records=export_records
             )
         stop = time.time()
         logger.debug("Metadata received: {}".format(stop-start))
@@ -1404,7 +1942,7 @@ def get_cart_manifest(filtergrp_list, partitions, mxstudies, mxseries, field_lis
 def get_metadata_solr(filters, fields, sources, counts_only, collapse_on, record_limit, offset=0, attr_facets=None,
                       records_only=False, sort=None, uniques=None, record_source=None, totals=None, cursor=None,
                       search_child_records_by=None, filtered_needed=True, custom_facets=None, sort_field=None,
-                      raw_format=False, default_facets=True, aux_sources=None):
+                      raw_format=False, default_facets=True, aux_sources=None, export_records=False):
 
     filters = filters or {}
     results = {'docs': None, 'facets': {}}
@@ -1436,6 +1974,10 @@ def get_metadata_solr(filters, fields, sources, counts_only, collapse_on, record
     image_source = sources.filter(id__in=DataSetType.objects.get(
         data_type=DataSetType.IMAGE_DATA).datasource_set.all()).first()
 
+    # Count queries issued for this request, kept for cache warming if the query recorder is enabled
+    recorded_queries = []
+    requested_uniques = list(uniques) if uniques else None
+
     # Eventually this will need to go per program
     for source in sources:
         # Uniques and totals are only read from Image Data sources; set the actual field names to None for
@@ -1452,6 +1994,15 @@ def get_metadata_solr(filters, fields, sources, counts_only, collapse_on, record
         solr_facets_filtered = None
         solr_stats_filtered = None
         solr_stats = None
+        facet_cache_keys = None
+        cached_facets = None
+        filtered_cache_keys = None
+        cached_facets_filtered = None
+        # The full facet and stats sets, before any cached attributes are removed
+        record_facets = None
+        record_stats = None
+        record_facets_filtered = None
+        record_stats_filtered = None
         if not records_only:
             if attrs_for_faceting:
                 if not filters:
@@ -1476,16 +2027,43 @@ def get_metadata_solr(filters, fields, sources, counts_only, collapse_on, record
                     )
                     solr_stats_filtered = fetch_solr_stats({'attrs': attrs_for_faceting['sources'][source.id]['attrs']})
 
+                if SOLR_FACET_CACHE and not raw_format:
+                    # Anything else which alters the fq set for this source is part of every key
+                    query_context = [
+                        sorted([x.id for x in sources]), sorted([x.id for x in aux_sources]) if aux_sources is not None else None,
+                        canonical_filters(search_child_records_by)
+                    ]
+                    version_names = ";".join(source_versions[source.id].values_list("name", flat=True))
+                    record_facets, record_stats = solr_facets, solr_stats
+                    record_facets_filtered, record_stats_filtered = solr_facets_filtered, solr_stats_filtered
+                    facet_cache_keys = _solr_facet_cache_keys(
+                        source, version_names, solr_facets, filters, True, query_context
+                    )
+                    solr_facets, solr_stats, cached_facets = _split_cached_solr_facets(
+                        facet_cache_keys, solr_facets, solr_stats
+                    )
+                    if solr_facets_filtered:
+                        filtered_cache_keys = _solr_facet_cache_keys(
+                            source, version_names, solr_facets_filtered, filters, False, query_context
+                        )
+                        solr_facets_filtered, solr_stats_filtered, cached_facets_filtered = _split_cached_solr_facets(
+                            filtered_cache_keys, solr_facets_filtered, solr_stats_filtered
+                        )
+
             # For the moment custom facets are only valid on IMAGE_DATA set types
             if custom_facets is not None and DataSetType.IMAGE_DATA in source_data_types[source.id]:
-                if solr_facets is None:
-                    solr_facets = {}
+                solr_facets = dict(solr_facets or {})
                 solr_facets.update(custom_facets)
+                if record_facets is not None:
+                    record_facets = dict(record_facets)
+                    record_facets.update(custom_facets)
 #                solr_facets = custom_facets <-- This looks like a bug???
                 if filtered_needed and filters:
-                    if solr_facets_filtered is None:
-                        solr_facets_filtered = {}
+                    solr_facets_filtered = dict(solr_facets_filtered or {})
                     solr_facets_filtered.update(custom_facets)
+                    if record_facets_filtered is not None:
+                        record_facets_filtered = dict(record_facets_filtered)
+                        record_facets_filtered.update(custom_facets)
 
         if aux_sources is None:
             query_set = create_query_set(solr_query, sources, source, all_ui_attrs, image_source, DataSetType)
@@ -1497,7 +2075,7 @@ def get_metadata_solr(filters, fields, sources, counts_only, collapse_on, record
 
         if not records_only:
             # Get facet counts
-            solr_result = query_solr_and_format_result({
+            count_query = {
                 'collection': source.name,
                 'facets': solr_facets,
                 'fqs': query_set,
@@ -1509,11 +2087,21 @@ def get_metadata_solr(filters, fields, sources, counts_only, collapse_on, record
                 'stats': solr_stats,
                 'totals': curTotals,
                 'sort': sort,
-            }, raw_format=raw_format)
+            }
+            if SOLR_QUERY_RECORDER:
+                # query_solr consumes the uniques list, so this must be copied before the query is made
+                recorded_queries.append(copy.deepcopy(dict(
+                    count_query,
+                    facets=record_facets if record_facets is not None else solr_facets,
+                    stats=record_stats if record_stats is not None else solr_stats
+                )))
+            solr_result = query_solr_and_format_result(count_query, raw_format=raw_format)
+            if facet_cache_keys:
+                solr_result = _merge_cached_solr_facets(solr_result, facet_cache_keys, cached_facets)
 
             solr_count_filtered_result = None
-            if solr_facets_filtered:
-                solr_count_filtered_result = query_solr_and_format_result({
+            if solr_facets_filtered or cached_facets_filtered:
+                filtered_count_query = {
                     'collection': source.name,
                     'facets': solr_facets_filtered,
                     'fqs': query_set,
@@ -1524,7 +2112,18 @@ def get_metadata_solr(filters, fields, sources, counts_only, collapse_on, record
                     'fields': None,
                     'stats': solr_stats_filtered,
                     'totals': curTotals
-                }, raw_format=raw_format)
+                }
+                if SOLR_QUERY_RECORDER:
+                    recorded_queries.append(copy.deepcopy(dict(
+                        filtered_count_query,
+                        facets=record_facets_filtered if record_facets_filtered is not None else solr_facets_filtered,
+                        stats=record_stats_filtered if record_stats_filtered is not None else solr_stats_filtered
+                    )))
+                solr_count_filtered_result = query_solr_and_format_result(filtered_count_query, raw_format=raw_format)
+                if filtered_cache_keys:
+                    solr_count_filtered_result = _merge_cached_solr_facets(
+                        solr_count_filtered_result, filtered_cache_keys, cached_facets_filtered
+                    )
 
             stop = time.time()
             logger.info("[BENCHMARKING] Total time to examine source {} and query: {}".format(
@@ -1555,7 +2154,20 @@ def get_metadata_solr(filters, fields, sources, counts_only, collapse_on, record
             if 'totals' in totals_source:
                 results['totals'] = totals_source['totals']
 
-        if DataSetType.IMAGE_DATA in source_data_types[source.id] and not counts_only:
+        export_result = None
+        if DataSetType.IMAGE_DATA in source_data_types[source.id] and not counts_only and export_records \
+                and not cursor:
+            # Bulk extraction of the records; collapsing is done during the export. Requests it can't stream (paged,
+            # or sorted such that collapsed records would interleave) are left to the /query handler below.
+            export_result = export_solr(
+                source.name if not record_source else record_source.name, fields, fqs=query_set, sort=sort,
+                offset=offset, limit=record_limit, unique_on=collapse_on
+            )
+        if export_result is not None:
+            results['docs'] = export_result['docs']
+            if records_only:
+                results['total'] = export_result['numFound']
+        elif DataSetType.IMAGE_DATA in source_data_types[source.id] and not counts_only:
             # Get the records
             solr_result = query_solr_and_format_result({
                 'collection': source.name if not record_source else record_source.name,
@@ -1574,6 +2186,18 @@ def get_metadata_solr(filters, fields, sources, counts_only, collapse_on, record
             if records_only:
                 results['total'] = solr_result['numFound']
 
+    if SOLR_QUERY_RECORDER and len(recorded_queries):
+        record_solr_query(
+            make_cache_key(
+                "solr_metadata", canonical_filters(filters), sorted([x.id for x in sources]),
+                sorted([x.id for x in aux_sources]) if aux_sources is not None else None,
+                canonical_filters(search_child_records_by), attr_facets, default_facets, filtered_needed,
+                requested_uniques, totals, sorted(list((custom_facets or {}).keys()))
+            ),
+            ";".join(sorted(set([y for x in source_versions.values() for y in x.values_list("name", flat=True)]))),
+            recorded_queries
+        )
+
     return results
 
 
@@ -1606,23 +2230,123 @@ def get_metadata_bq(filters, fields, sources_and_attrs, counts_only, collapse_on
 # BigQuery Methods
 ####################
 #
-# Faceted counting for an arbitrary set of filters and facets.
-# filters and facets can be provided as lists of names (in which case _build_attr_by_source is used to convert them
-# into Attribute objects) or as part of the sources_and_attrs construct, which is a dictionary of objects with the same
-# structure as the dict output by _build_attr_by_source.
+# Neutralize the 'don't filter' toggles of the given parameters in a filter string, so the clauses they guard always
+# pass. This lets a single query apply a different set of exclusions per facet, rather than re-running the query with
+# the toggle parameter values changed.
+def _drop_count_toggles(filter_string, param_names):
+    for param in param_names:
+        filter_string = re.sub(r"@{}_filtering\b".format(re.escape(param)), "'not_filtering'", filter_string)
+    return filter_string
+
+
+# Build and submit one query which counts every facet for an image table. Each facet becomes a (name, value, counted)
+# struct UNNESTed against the joined rows, where 'counted' is the filter set minus that facet's own filters; the
+# rows are then grouped on (name, value). Facet-only tables are LEFT JOINed, and a row only counts toward a facet on
+# such a table when the join matched, so the counts equal those of the per-facet INNER JOIN queries.
 #
-# Queries are structured with the 'image' data type sources as the first table, and all 'ancillary' (i.e. non-image)
-# tables as JOINs into the first table. Faceted counts are done on a per attribute basis (though could be restructed
-# into a single call). Filters are handled by BigQuery API parameterization, and disabled for faceted bucket counts
-# based on their presence in a secondary WHERE clause field which resolves to 'true' if that filter's attribute is the
-# attribute currently being counted
-def get_bq_facet_counts(filters, facets, data_versions, sources_and_attrs=None):
-    filter_attr_by_bq = {}
-    facet_attr_by_bq = {}
+# The struct's value has to be a STRING, and CAST renders numbers differently from the API's own formatting of a
+# numeric column (eg. 3 rather than 3.0 for a FLOAT64), which the value keys are expected to match. Numeric
+# categorical facets are therefore left out, for the caller to count with _submit_bq_facet_job.
+#
+# Populates results['facets'] and facet_map in place, and returns the count job entry, or None if there were no
+# facets to count
+def _submit_bq_combined_facet_job(image_table, image_tables, tables_in_query, table_info, facet_attr_by_bq,
+                                  filter_clauses, joins, query_filters, params, results, facet_map, versions=None):
+    query_base = """
+        #standardSQL
+        SELECT facets.facet_name, facets.facet_value, COUNT(DISTINCT {count_col}) AS count
+        FROM `{image_table}` {image_alias}
+        {join_clause}
+        CROSS JOIN UNNEST([
+            {facet_structs}
+        ]) AS facets
+        WHERE facets.counted {where_clause}
+        GROUP BY facets.facet_name, facets.facet_value
+    """
+
+    join_clause_base = """
+        LEFT JOIN `{join_to_table}` {join_to_alias}
+        ON {join_to_alias}.{join_to_id} = {join_from_alias}.{join_from_id}
+    """
+
+    facet_struct_base = "STRUCT('{facet}' AS facet_name, CAST({sel_col} AS STRING) AS facet_value, ({counted}) AS counted)"
+
+    facet_joins = copy.deepcopy(joins)
+    facet_structs = []
+    facet_order = []
+    all_toggles = []
+
+    for facet_table in facet_attr_by_bq['sources']:
+        join_check = None
+        if facet_table not in image_tables and facet_table not in tables_in_query:
+            source_join = DataSourceJoin.objects.get(
+                from_src__in=[table_info[facet_table]['id'], table_info[image_table]['id']],
+                to_src__in=[table_info[facet_table]['id'], table_info[image_table]['id']]
+            )
+            join_to_id = source_join.get_col(table_info[facet_table]['name'])
+            facet_joins.append(join_clause_base.format(
+                join_from_alias=table_info[image_table]['alias'],
+                join_from_id=source_join.get_col(table_info[image_table]['name']),
+                join_to_alias=table_info[facet_table]['alias'],
+                join_to_table=table_info[facet_table]['name'],
+                join_to_id=join_to_id,
+            ))
+            join_check = "{}.{} IS NOT NULL".format(table_info[facet_table]['alias'], join_to_id)
+        for attr_facet in facet_attr_by_bq['sources'][facet_table]['attrs']:
+            if attr_facet.data_type == Attribute.CATEGORICAL_NUMERIC:
+                continue
+            facet = attr_facet.name
+            source_set = table_info[facet_table]['set']
+            if source_set not in results['facets']:
+                results['facets'][source_set] = {facet_table: {'facets': {}}}
+            if facet_table not in results['facets'][source_set]:
+                results['facets'][source_set][facet_table] = {'facets': {}}
+            results['facets'][source_set][facet_table]['facets'][facet] = {}
+            facet_map[facet] = {'set': source_set, 'source': facet_table}
+            facet_order.append(facet)
+            toggles = []
+            if facet_table in filter_clauses and facet in filter_clauses[facet_table]['attr_params']:
+                toggles = filter_clauses[facet_table]['attr_params'][facet]
+                all_toggles.extend(toggles)
+            if attr_facet.data_type == Attribute.CONTINUOUS_NUMERIC:
+                sel_col = _get_bq_range_clause(
+                    attr_facet, table_info[facet_table]['name'], table_info[facet_table]['alias'], None,
+                    with_alias=False, versions=versions
+                )
+            else:
+                sel_col = "{}.{}".format(table_info[facet_table]['alias'], facet)
+            counted = [_drop_count_toggles(x, toggles) for x in query_filters]
+            if join_check:
+                counted.append(join_check)
+            facet_structs.append(facet_struct_base.format(
+                facet=facet, sel_col=sel_col, counted=" AND ".join(counted) if len(counted) else "TRUE"
+            ))
+
+    if not len(facet_structs):
+        return None
+
+    # Anything filtered on which isn't also a facet applies to every facet, and can be applied up front
+    where_filters = [_drop_count_toggles(x, all_toggles) for x in query_filters]
+
+    count_query = query_base.format(
+        count_col="{}.{}".format(table_info[image_table]['alias'], table_info[image_table]['count_col']),
+        image_table=table_info[image_table]['name'],
+        image_alias=table_info[image_table]['alias'],
+        join_clause=""" """.join(facet_joins),
+        facet_structs=",\n            ".join(facet_structs),
+        where_clause="AND {}".format(" AND ".join(where_filters)) if len(where_filters) else ""
+    )
+
+    return {
+        'job': BigQuerySupport.insert_query_job(count_query, params if len(params) else None),
+        'done': False,
+        'facet_order': facet_order
+    }
 
-    counted_total = False
-    total = 0
 
+# Submit the count job for a single facet, toggling its filter's 'don't filter' var so the facet isn't filtered on itself
+def _submit_bq_facet_job(image_table, image_tables, tables_in_query, table_info, facet_table, attr_facet, filter_clauses,
+                         joins, query_filters, params, results, facet_map, versions=None):
     query_base = """
         #standardSQL
         SELECT {count_clause}
@@ -1639,8 +2363,97 @@ def get_bq_facet_counts(filters, facets, data_versions, sources_and_attrs=None):
         ON {join_to_alias}.{join_to_id} = {join_from_alias}.{join_from_id}
     """
 
-    image_tables = {}
+    facet_joins = copy.deepcopy(joins)
+    source_join = None
+    if facet_table not in image_tables and facet_table not in tables_in_query:
+        source_join = DataSourceJoin.objects.get(
+            from_src__in=[table_info[facet_table]['id'], table_info[image_table]['id']],
+            to_src__in=[table_info[facet_table]['id'], table_info[image_table]['id']]
+        )
+        facet_joins.append(join_clause_base.format(
+            join_from_alias=table_info[image_table]['alias'],
+            join_from_id=source_join.get_col(table_info[image_table]['name']),
+            join_to_alias=table_info[facet_table]['alias'],
+            join_to_table=table_info[facet_table]['name'],
+            join_to_id=source_join.get_col(table_info[facet_table]['name']),
+        ))
+    facet = attr_facet.name
+    source_set = table_info[facet_table]['set']
+    if source_set not in results['facets']:
+        results['facets'][source_set] = { facet_table: {'facets': {}}}
+    if facet_table not in results['facets'][source_set]:
+        results['facets'][source_set][facet_table] = {'facets': {}}
+    results['facets'][source_set][facet_table]['facets'][facet] = {}
+    facet_map[facet] = {'set': source_set, 'source': facet_table}
+    filtering_this_facet = facet_table in filter_clauses and facet in filter_clauses[facet_table]['attr_params']
+    count_job = {}
+    sel_count_col = None
+    if attr_facet.data_type == Attribute.CONTINUOUS_NUMERIC:
+        sel_count_col = _get_bq_range_clause(
+            attr_facet,
+            table_info[facet_table]['name'],
+            table_info[facet_table]['alias'],
+            source_join.get_col(table_info[facet_table]['name']),
+            versions=versions
+        )
+    else:
+        sel_count_col = "{}.{} AS {}".format(table_info[facet_table]['alias'], facet, facet)
+    count_clause = count_clause_base.format(
+        sel_count_col=sel_count_col, count_col="{}.{}".format(
+            table_info[image_table]['alias'], table_info[image_table]['count_col'],))
+    count_query = query_base.format(
+        facet=facet,
+        table_clause="`{}` {}".format(table_info[image_table]['name'], table_info[image_table]['alias']),
+        count_clause=count_clause,
+        where_clause="{}".format("WHERE {}".format(" AND ".join(query_filters)) if len(query_filters) else ""),
+        join_clause=""" """.join(facet_joins)
+    )
+    # Toggle 'don't filter'
+    if filtering_this_facet:
+        for param in filter_clauses[facet_table]['attr_params'][facet]:
+            filter_clauses[facet_table]['count_params'][param]['parameterValue']['value'] = 'not_filtering'
+    count_job['job'] = BigQuerySupport.insert_query_job(count_query, params if len(params) else None)
+    count_job['done'] = False
+    # Toggle 'don't filter'
+    if filtering_this_facet:
+        for param in filter_clauses[facet_table]['attr_params'][facet]:
+            filter_clauses[facet_table]['count_params'][param]['parameterValue']['value'] = 'filtering'
+    return count_job
+
+
+# The data versions read by a set of BigQuery sources, and whether all of them are inactive (and so can't change)
+def _get_bq_cache_versions(source_ids):
+    versions = list(DataVersion.objects.filter(datasource__id__in=source_ids).distinct().values_list('id', 'active'))
+    return sorted([x[0] for x in versions]), bool(len(versions)) and not any([x[1] for x in versions])
+
+
+def _log_bq_facet_job_stats(bqs, job):
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    try:
+        job_resource = bqs.fetch_job_resource(job['jobReference'])
+        stats = job_resource.get('statistics', {})
+        logger.debug("[BENCHMARKING] Facet count job {}: {} bytes processed, {}ms elapsed".format(
+            job['jobReference']['jobId'], stats.get('totalBytesProcessed', None),
+            (int(stats['endTime']) - int(stats['creationTime'])) if 'endTime' in stats else None
+        ))
+    except Exception as e:
+        logger.debug("[STATUS] Couldn't retrieve statistics for job {}: {}".format(job['jobReference']['jobId'], str(e)))
 
+#
+# Faceted counting for an arbitrary set of filters and facets.
+# filters and facets can be provided as lists of names (in which case _build_attr_by_source is used to convert them
+# into Attribute objects) or as part of the sources_and_attrs construct, which is a dictionary of objects with the same
+# structure as the dict output by _build_attr_by_source.
+#
+# Queries are structured with the 'image' data type sources as the first table, and all 'ancillary' (i.e. non-image)
+# tables as JOINs into the first table. Faceted counts are done in a single query per image table (see
+# _submit_bq_combined_facet_job), or on a per attribute basis if BQ_FACET_SINGLE_QUERY is False. Filters are handled by
+# BigQuery API parameterization, and disabled for faceted bucket counts based on their presence in a secondary WHERE
+# clause field which resolves to 'true' if that filter's attribute is the attribute currently being counted.
+#
+# Completed counts are kept in the BigQuery result cache, keyed on the filters, attributes and data versions involved.
+def get_bq_facet_counts(filters, facets, data_versions, sources_and_attrs=None):
     if not sources_and_attrs:
         if not data_versions or not facets:
             raise Exception("Can't determine facet attributes without facets and versions.")
@@ -1650,6 +2463,41 @@ def get_bq_facet_counts(filters, facets, data_versions, sources_and_attrs=None):
         filter_attr_by_bq = sources_and_attrs['filters']
         facet_attr_by_bq = sources_and_attrs['facets']
 
+    source_ids = set(list(filter_attr_by_bq['sources'].keys()) + list(facet_attr_by_bq['sources'].keys()))
+    cache_versions, immutable = _get_bq_cache_versions(list(source_ids))
+    cache_key = bq_result_cache_key(
+        "bq_facet_counts", None, cache_versions, canonical_filters(filters), BQ_FACET_SINGLE_QUERY,
+        {str(x): sorted([y.name for y in facet_attr_by_bq['sources'][x]['attrs']]) for x in facet_attr_by_bq['sources']},
+        {str(x): sorted(filter_attr_by_bq['sources'][x]['list']) for x in filter_attr_by_bq['sources']}
+    )
+
+    # Counts from a timed-out query are incomplete, and are returned but never cached
+    incomplete = {}
+
+    def _count():
+        results, complete = _count_bq_facets(filters, filter_attr_by_bq, facet_attr_by_bq, cache_versions)
+        if not complete:
+            incomplete['results'] = results
+            return None
+        return results
+
+    results = cached_bq_result(cache_key, _count, immutable)
+    return results if results is not None else incomplete['results']
+
+
+# Does the counting for get_bq_facet_counts; returns the results, and whether every count job completed
+def _count_bq_facets(filters, filter_attr_by_bq, facet_attr_by_bq, versions=None):
+    counted_total = False
+    total = 0
+
+    join_clause_base = """
+        JOIN `{join_to_table}` {join_to_alias}
+        ON {join_to_alias}.{join_to_id} = {join_from_alias}.{join_from_id}
+    """
+
+    image_tables = {}
+    complete = True
+
     for attr_set in [filter_attr_by_bq, facet_attr_by_bq]:
         for source in attr_set['sources']:
             if attr_set['sources'][source]['data_type'] == DataSetType.IMAGE_DATA:
@@ -1668,7 +2516,6 @@ def get_bq_facet_counts(filters, facets, data_versions, sources_and_attrs=None):
 
     filter_clauses = {}
 
-    count_jobs = {}
     params = []
     param_sfx = 0
 
@@ -1729,94 +2576,56 @@ def get_bq_facet_counts(filters, facets, data_versions, sources_and_attrs=None):
                     params.append(filter_clauses[filter_bqtable]['parameters'])
                     query_filters.append(filter_clauses[filter_bqtable]['filter_string'])
                     tables_in_query.append(filter_bqtable)
-        # Submit jobs, toggling the 'don't filter' var for each facet
+        # Jobs are per image table, so each table's results are fetched once
+        count_jobs = {}
+        if BQ_FACET_SINGLE_QUERY:
+            # Count every facet in one scan of the joined tables, save for numeric categorical facets (see
+            # _submit_bq_combined_facet_job), which get a job each
+            combined_job = _submit_bq_combined_facet_job(
+                image_table, image_tables, tables_in_query, table_info, facet_attr_by_bq, filter_clauses, joins,
+                query_filters, params, results, facet_map, versions
+            )
+            if combined_job:
+                count_jobs[image_table] = combined_job
         for facet_table in facet_attr_by_bq['sources']:
             for attr_facet in facet_attr_by_bq['sources'][facet_table]['attrs']:
-                facet_joins = copy.deepcopy(joins)
-                source_join = None
-                if facet_table not in image_tables and facet_table not in tables_in_query:
-                    source_join = DataSourceJoin.objects.get(
-                        from_src__in=[table_info[facet_table]['id'], table_info[image_table]['id']],
-                        to_src__in=[table_info[facet_table]['id'], table_info[image_table]['id']]
+                if not BQ_FACET_SINGLE_QUERY or attr_facet.data_type == Attribute.CATEGORICAL_NUMERIC:
+                    count_jobs[attr_facet.name] = _submit_bq_facet_job(
+                        image_table, image_tables, tables_in_query, table_info, facet_table, attr_facet,
+                        filter_clauses, joins, query_filters, params, results, facet_map, versions
                     )
-                    facet_joins.append(join_clause_base.format(
-                        join_from_alias=table_info[image_table]['alias'],
-                        join_from_id=source_join.get_col(table_info[image_table]['name']),
-                        join_to_alias=table_info[facet_table]['alias'],
-                        join_to_table=table_info[facet_table]['name'],
-                        join_to_id=source_join.get_col(table_info[facet_table]['name']),
-                    ))
-                facet = attr_facet.name
-                source_set = table_info[facet_table]['set']
-                if source_set not in results['facets']:
-                    results['facets'][source_set] = { facet_table: {'facets': {}}}
-                if facet_table not in results['facets'][source_set]:
-                    results['facets'][source_set][facet_table] = {'facets': {}}
-                results['facets'][source_set][facet_table]['facets'][facet] = {}
-                facet_map[facet] = {'set': source_set, 'source': facet_table}
-                filtering_this_facet = facet_table in filter_clauses and facet in filter_clauses[facet_table]['attr_params']
-                count_jobs[facet] = {}
-                sel_count_col = None
-                if attr_facet.data_type == Attribute.CONTINUOUS_NUMERIC:
-                    sel_count_col = _get_bq_range_case_clause(
-                        attr_facet,
-                        table_info[facet_table]['name'],
-                        table_info[facet_table]['alias'],
-                        source_join.get_col(table_info[facet_table]['name'])
-                    )
-                else:
-                    sel_count_col = "{}.{} AS {}".format(table_info[facet_table]['alias'], facet, facet)
-                count_clause = count_clause_base.format(
-                    sel_count_col=sel_count_col, count_col="{}.{}".format(
-                        table_info[image_table]['alias'], table_info[image_table]['count_col'],))
-                count_query = query_base.format(
-                    facet=facet,
-                    table_clause="`{}` {}".format(table_info[image_table]['name'], table_info[image_table]['alias']),
-                    count_clause=count_clause,
-                    where_clause="{}".format("WHERE {}".format(" AND ".join(query_filters)) if len(query_filters) else ""),
-                    join_clause=""" """.join(facet_joins)
-                )
-                # Toggle 'don't filter'
-                if filtering_this_facet:
-                    for param in filter_clauses[facet_table]['attr_params'][facet]:
-                        filter_clauses[facet_table]['count_params'][param]['parameterValue']['value'] = 'not_filtering'
-                count_jobs[facet]['job'] = BigQuerySupport.insert_query_job(count_query, params if len(params) else None)
-                count_jobs[facet]['done'] = False
-                # Toggle 'don't filter'
-                if filtering_this_facet:
-                    for param in filter_clauses[facet_table]['attr_params'][facet]:
-                        filter_clauses[facet_table]['count_params'][param]['parameterValue']['value'] = 'filtering'
         # Poll the jobs until they're done, or we've timed out
-        not_done = True
-        still_checking = True
-        num_retries = 0
-        while still_checking and not_done:
-            not_done = False
-            for facet in count_jobs:
-                if not count_jobs[facet]['done']:
-                    count_jobs[facet]['done'] = BigQuerySupport.check_job_is_done(count_jobs[facet]['job'])
-                    if not count_jobs[facet]['done']:
-                        not_done = True
-            sleep(1)
-            num_retries += 1
-            still_checking = (num_retries < BQ_ATTEMPT_MAX)
-
-        if not_done:
+        bqs = BigQuerySupport(None, None, None)
+        jobs_done = bqs.await_job_set_is_done({facet: count_jobs[facet]['job'] for facet in count_jobs})
+        for facet, done in jobs_done.items():
+            count_jobs[facet]['done'] = done
+
+        if not all(jobs_done.values()):
             logger.error("[ERROR] Timed out while trying to count case/sample totals in BQ")
+            complete = False
         else:
-            for facet in count_jobs:
-                bq_results = BigQuerySupport.get_job_results(count_jobs[facet]['job']['jobReference'])
-                for row in bq_results:
-                    val = row['f'][0]['v'] if row['f'][0]['v'] is not None else "None"
-                    count = row['f'][1]['v']
-                    results['facets'][facet_map[facet]['set']][facet_map[facet]['source']]['facets'][facet][val] = int(count)
-                    if not counted_total:
-                        total += int(count)
+            for job_key in count_jobs:
+                bq_results = bqs.fetch_job_results(count_jobs[job_key]['job']['jobReference'])
+                if count_jobs[job_key].get('facet_order', None):
+                    # Combined job: rows are (facet name, value, count), and the total comes from the first facet
+                    for facet, val, count in BigQuerySupport.decode_rows(bq_results, BQ_COMBINED_FACET_SCHEMA):
+                        val = val if val is not None else "None"
+                        results['facets'][facet_map[facet]['set']][facet_map[facet]['source']]['facets'][facet][val] = count
+                        if not counted_total and facet == count_jobs[job_key]['facet_order'][0]:
+                            total += count
+                else:
+                    facet = job_key
+                    for val, count in BigQuerySupport.decode_rows(bq_results, BQ_FACET_SCHEMA):
+                        val = val if val is not None else "None"
+                        results['facets'][facet_map[facet]['set']][facet_map[facet]['source']]['facets'][facet][val] = count
+                        if not counted_total:
+                            total += count
                 counted_total = True
+                _log_bq_facet_job_stats(bqs, count_jobs[job_key]['job'])
 
         results['facets']['total'] = total
 
-    return results
+    return results, complete
 
 
 # Fetch the related metadata from BigQuery
@@ -1828,14 +2637,64 @@ def get_bq_facet_counts(filters, facets, data_versions, sources_and_attrs=None):
 #   no_submit is False: { 'results': <BigQuery API v2 result set>, 'schema': <TableSchema Obj> }
 #   no_submit is True: { 'sql_string': <BigQuery API v2 compatible SQL Standard SQL parameterized query>,
 #     'params': <BigQuery API v2 compatible parameter set> }
+# Key parts identifying the data versions and source attribute sets a query is built against
+def _bq_template_key(data_version, sources_and_attrs):
+    versions = sorted(data_version.values_list('id', flat=True)) if hasattr(data_version, 'values_list') \
+        else [str(x) for x in (data_version or [])]
+    sources = None
+    if sources_and_attrs:
+        sources = {
+            x: {str(y): sorted(sources_and_attrs[x]['sources'][y]['list']) for y in sources_and_attrs[x]['sources']}
+            for x in ['filters', 'fields']
+        }
+    return versions, sources
+
+
 def get_bq_metadata(filters, fields, data_version, sources_and_attrs=None, group_by=None, limit=0, 
                     offset=0, order_by=None, order_asc=True, paginated=False, no_submit=False,
                     search_child_records_by=None, static_fields=None, reformatted_fields=None, with_v2_api=False,
-                    cart_filters=None):
+                    cart_filters=None, plan_query=None):
 
     cart_clause = " AND ({})".format(cart_filters['filter_string']) if cart_filters else ""
     if not data_version and not sources_and_attrs:
         data_version = DataVersion.objects.filter(active=True)
+    plan_query = BQ_QUERY_PLANNER if plan_query is None else plan_query
+
+    # The SQL depends on the filters' values only through its parameters, so it's built once per query shape
+    query = compiled_query(
+        'bq_metadata',
+        lambda shaped_filters: _build_bq_metadata_query(
+            shaped_filters, list(fields), data_version, sources_and_attrs,
+            list(group_by) if type(group_by) in (list, set) else group_by, limit, offset,
+            list(order_by) if order_by else order_by, order_asc, search_child_records_by, static_fields,
+            reformatted_fields, with_v2_api, cart_clause, plan_query
+        ),
+        filters, fields, _bq_template_key(data_version, sources_and_attrs), group_by, limit, offset, order_by,
+        order_asc, search_child_records_by, static_fields, reformatted_fields, with_v2_api, cart_clause, plan_query
+    )
+    full_query_str = query['sql']
+    params = query['params']
+
+    settings.DEBUG and logger.debug("[STATUS] get_bq_metadata: {}".format(full_query_str))
+    if cart_clause:
+        params.extend(cart_filters['parameters'])
+
+    if no_submit:
+        results = {"sql_string": full_query_str, "params": params}
+    else:
+        cache_versions, immutable = _get_bq_cache_versions(query['source_ids'])
+        results = BigQuerySupport.execute_query_and_fetch_results(
+            full_query_str, params, paginated=paginated, cache_versions=cache_versions, immutable=immutable
+        )
+
+    return results
+
+
+# Build the SQL and parameters for get_bq_metadata; returns a dict of the 'sql', its 'params', and the 'source_ids'
+# of the tables it reads. With plan_query, the query is rewritten by the planner (see bq_query_planner).
+def _build_bq_metadata_query(filters, fields, data_version, sources_and_attrs, group_by, limit, offset, order_by,
+                             order_asc, search_child_records_by, static_fields, reformatted_fields, with_v2_api,
+                             cart_clause, plan_query=False):
 
     ranged_numerics = Attribute.get_ranged_attrs()
 
@@ -1950,6 +2809,7 @@ def get_bq_metadata(filters, fields, data_version, sources_and_attrs=None, group
         )
 
     for_union = []
+    union_branches = []
     intersect_statements = []
     params = []
     param_sfx = 0
@@ -1993,6 +2853,8 @@ def get_bq_metadata(filters, fields, data_version, sources_and_attrs=None, group
     for image_table in image_tables:
         tables_in_query = []
         joins = []
+        field_joins = []
+        child_conditions = []
         query_filters = []
         non_related_filters = {}
         fields = [field_clauses[image_table]] if image_table in field_clauses else []
@@ -2006,6 +2868,16 @@ def get_bq_metadata(filters, fields, data_version, sources_and_attrs=None, group
                     for filter in filter_set:
                         if type(filter_set[filter]) is dict and filter_set[filter]['op'] == 'AND':
                             for val in filter_set[filter]['values']:
+                                if plan_query:
+                                    bq_filter = build_bq_flt_and_params(
+                                        {filter: [val]}, param_suffix=str(param_sfx),
+                                        field_prefix=table_info[image_table]['alias'], case_insens=True,
+                                        type_schema=TYPE_SCHEMA, continuous_numerics=ranged_numerics
+                                    )
+                                    child_conditions.append(bq_filter['filter_string'])
+                                    params.extend(bq_filter['parameters'])
+                                    param_sfx += 1
+                                    continue
                                 bq_filter = BigQuerySupport.build_bq_where_clause(
                                     {filter: [val]}, field_prefix=table_info[image_table]['alias'],
                                     case_insens=True, type_schema=TYPE_SCHEMA, continuous_numerics=ranged_numerics
@@ -2027,15 +2899,18 @@ def get_bq_metadata(filters, fields, data_version, sources_and_attrs=None, group
                                 field_prefix=table_info[image_table]['alias'],
                                 case_insens=True, type_schema=TYPE_SCHEMA, continuous_numerics=ranged_numerics
                             )
-                            intersect_statements.append(intersect_base.format(
-                                search_by=child_record_search_field,
-                                table_clause="`{}` {}".format(
-                                    table_info[image_table]['name'], table_info[image_table]['alias']
-                                ),
-                                join_clause="",
-                                where_clause=" AND ({})".format(bq_filter['filter_string']),
-                                cart_clause=cart_clause
-                            ))
+                            if plan_query:
+                                child_conditions.append(bq_filter['filter_string'])
+                            else:
+                                intersect_statements.append(intersect_base.format(
+                                    search_by=child_record_search_field,
+                                    table_clause="`{}` {}".format(
+                                        table_info[image_table]['name'], table_info[image_table]['alias']
+                                    ),
+                                    join_clause="",
+                                    where_clause=" AND ({})".format(bq_filter['filter_string']),
+                                    cart_clause=cart_clause
+                                ))
                             params.extend(bq_filter['parameters'])
                 else:
                     filter_clauses[image_table] = build_bq_flt_and_params(
@@ -2096,14 +2971,20 @@ def get_bq_metadata(filters, fields, data_version, sources_and_attrs=None, group
                     from_src__in=[table_info[field_bqtable]['id'], table_info[image_table]['id']],
                     to_src__in=[table_info[field_bqtable]['id'], table_info[image_table]['id']]
                 )
-                joins.append(join_clause_base.format(
+                field_join = join_clause_base.format(
                     join_type=join_type,
                     field_alias=table_info[image_table]['alias'],
                     field_join_id=source_join.get_col(table_info[image_table]['name']),
                     filter_alias=table_info[field_bqtable]['alias'],
                     filter_table=table_info[field_bqtable]['name'],
                     filter_join_id=source_join.get_col(table_info[field_bqtable]['name'])
-                ))
+                )
+                if plan_query:
+                    field_joins.append({
+                        'alias': table_info[field_bqtable]['alias'], 'clause': field_join, 'left': join_type == "LEFT "
+                    })
+                else:
+                    joins.append(field_join)
 
         intersect_clause = ""
         if len(intersect_statements):
@@ -2111,43 +2992,71 @@ def get_bq_metadata(filters, fields, data_version, sources_and_attrs=None, group
                 INTERSECT DISTINCT
             """.join(intersect_statements)
 
+        selected = [] if reformatted_fields else field_columns(fields)
         if static_fields:
             fields.extend(['"{}" AS {}'.format(static_fields[x],x) for x in static_fields])
         if reformatted_fields:
             fields = reformatted_fields
+
+        table_clause = "`{}` {}".format(table_info[image_table]['name'], table_info[image_table]['alias'])
+        where_clause = (" AND ({})".format((" AND ".join(query_filters) if len(query_filters) else "") if len(filters) else "")) if len(filters) else ""
+        intersect_clause = "{}".format("" if not len(intersect_statements) else "{}{}".format(
+            " AND " if len(non_related_filters) and len(query_filters) else "", "{} IN ({})".format(
+                child_record_search_field, intersect_clause
+        )))
+        order_clause = "{}".format("ORDER BY {}".format(", ".join([
+            "{} {}".format(x, "ASC" if order_asc else "DESC") for x in order_by
+        ])) if order_by and len(order_by) else "")
+        group_clause = "{}".format("GROUP BY {}".format(", ".join(group_by)) if group_by and len(group_by) else "")
+
+        if plan_query:
+            # The child record intersections become a single grouped scan, and all conditions are ANDed together
+            conditions = list(query_filters)
+            if len(child_conditions):
+                conditions.append("{} IN ({})".format(child_record_search_field, child_record_filter(
+                    child_record_search_field, table_clause, cart_clause, child_conditions
+                )))
+            where_clause = " AND ({})".format(" AND ".join(conditions)) if len(conditions) else ""
+            intersect_clause = ""
+            joins.extend([x['clause'] for x in prune_joins(
+                field_joins, " ".join([",".join(fields), where_clause, group_clause, order_clause] + joins),
+                bool(group_by and len(group_by))
+            )])
+            union_branches.append({
+                'id': table_info[image_table]['id'], 'alias': table_info[image_table]['alias'],
+                'fields': selected, 'group_by': group_by
+            })
+
         for_union.append(query_base.format(
             field_clause= ",".join(fields),
-            table_clause="`{}` {}".format(table_info[image_table]['name'], table_info[image_table]['alias']),
+            table_clause=table_clause,
             join_clause=""" """.join(joins),
-            where_clause=(" AND ({})".format((" AND ".join(query_filters) if len(query_filters) else "") if len(filters) else "")) if len(filters) else "",
-            intersect_clause="{}".format("" if not len(intersect_statements) else "{}{}".format(
-                " AND " if len(non_related_filters) and len(query_filters) else "", "{} IN ({})".format(
-                    child_record_search_field, intersect_clause
-            ))),
-            order_clause="{}".format("ORDER BY {}".format(", ".join([
-                "{} {}".format(x, "ASC" if order_asc else "DESC") for x in order_by
-            ])) if order_by and len(order_by) else ""),
-            group_clause="{}".format("GROUP BY {}".format(", ".join(group_by)) if group_by and len(group_by) else ""),
+            where_clause=where_clause,
+            intersect_clause=intersect_clause,
+            order_clause=order_clause,
+            group_clause=group_clause,
             limit_clause="{}".format("LIMIT {}".format(str(limit)) if limit > 0 else ""),
             offset_clause="{}".format("OFFSET {}".format(str(offset)) if offset > 0 else ""),
             search_by=child_record_search_field,
             cart_clause=cart_clause
         ))
 
+    union_op = "UNION DISTINCT"
+    if plan_query and len(union_branches) > 1:
+        image_sources = {x.id: x for x in DataSource.objects.filter(
+            id__in=[y['id'] for y in union_branches]
+        ).prefetch_related('versions')}
+        for branch in union_branches:
+            branch['aggregate_level'] = image_sources[branch['id']].aggregate_level
+            branch['versions'] = [x.name for x in image_sources[branch['id']].versions.all()]
+        if union_is_disjoint(union_branches):
+            union_op = "UNION ALL"
+
     full_query_str = """
             #standardSQL
-    """ + """UNION DISTINCT""".join(for_union)
+    """ + union_op.join(for_union)
 
-    settings.DEBUG and logger.debug("[STATUS] get_bq_metadata: {}".format(full_query_str))
-    if cart_clause:
-        params.extend(cart_filters['parameters'])
-
-    if no_submit:
-        results = {"sql_string": full_query_str, "params": params}
-    else:
-        results = BigQuerySupport.execute_query_and_fetch_results(full_query_str, params, paginated=paginated)
-
-    return results
+    return {'sql': full_query_str, 'params': params, 'source_ids': [table_info[x]['id'] for x in table_info]}
 
 
 # For faceted counting of continuous numeric fields, ranges must be constructed so the faceted counts are properly
@@ -2155,23 +3064,39 @@ def get_bq_metadata(filters, fields, data_version, sources_and_attrs=None, group
 # in order to build a range clause.
 #
 # Attributes must be passed in as a proper Attribute ORM object
-def _get_bq_range_case_clause(attr, table, alias, count_on, include_nulls=True):
-    ranges = Attribute_Ranges.objects.filter(attribute=attr)
-    ranges_case = []
-
-    for attr_range in ranges:
+def _get_bq_range_clause(attr, table, alias, count_on, include_nulls=True, with_alias=True, versions=None):
+    if BQ_RANGE_BUCKETS:
+        clause = _get_bq_range_bucket_clause(attr, alias, versions, include_nulls, with_alias)
+        if clause:
+            return clause
+    return _get_bq_range_case_clause(attr, table, alias, count_on, include_nulls, with_alias)
+
+
+# A set of data versions as a cache key part: their sorted primary keys, or names for any which aren't saved. A
+# QuerySet's string form is truncated, so it can't stand in for the set itself.
+def _versions_cache_key(versions):
+    if versions is None:
+        return None
+    if hasattr(versions, 'values_list'):
+        return sorted([str(x) for x in versions.values_list('id', flat=True)])
+    return sorted([str(x.pk) if getattr(x, 'pk', None) is not None else str(getattr(x, 'name', x)) for x in versions])
+
+
+# The buckets defined by an attribute's Attribute_Ranges, in order, as (lower, upper, label) entries; lower and upper
+# are the bounds as they appear in the SQL, and either can be None. A value matches a bucket if it's < upper when
+# there's no lower, > lower when there's no upper, and BETWEEN lower AND upper otherwise.
+def _get_attr_range_buckets(attr):
+    buckets = []
+
+    for attr_range in Attribute_Ranges.objects.filter(attribute=attr):
         if attr_range.gap == "0":
             # This is a single range, no iteration to be done
             if attr_range.first == "*":
-                ranges_case.append(
-                    "WHEN {}.{} < {} THEN '{}'".format(alias, attr.name, str(attr_range.last), attr_range.label))
+                buckets.append((None, str(attr_range.last), attr_range.label,))
             elif attr_range.last == "*":
-                ranges_case.append(
-                    "WHEN {}.{} > {} THEN '{}'".format(alias, attr.name, str(attr_range.first), attr_range.label))
+                buckets.append((str(attr_range.first), None, attr_range.label,))
             else:
-                ranges_case.append(
-                    "WHEN {}.{} BETWEEN {} AND {} THEN '{}'".format(alias, attr.name, str(attr_range.first),
-                                                                   str(attr_range.last), attr_range.label))
+                buckets.append((str(attr_range.first), str(attr_range.last), attr_range.label,))
         else:
             # Iterated range
             cast = int if attr_range.type == Attribute_Ranges.INT else float
@@ -2186,38 +3111,117 @@ def _get_bq_range_case_clause(attr, table, alias, count_on, include_nulls=True):
 
             while lower == "*" or lower < last:
                 if lower == "*":
-                    ranges_case.append(
-                        "WHEN {}.{} < {} THEN {}".format(alias, attr.name, str(upper), "'* TO {}'".format(str(upper))))
+                    buckets.append((None, str(upper), "* TO {}".format(str(upper)),))
                 else:
-                    ranges_case.append(
-                        "WHEN {}.{} BETWEEN {} AND {} THEN {}".format(
-                            alias, attr.name, str(lower), str(upper), "'{} TO {}'".format(str(lower),str(upper)))
-                    )
+                    buckets.append((str(lower), str(upper), "{} TO {}".format(str(lower), str(upper)),))
                 lower = upper
                 upper = lower + gap
 
             # If we stopped *at* the end, we need to add one last bucket.
             if attr_range.unbounded:
-                ranges_case.append(
-                    "WHEN {}.{} > {} THEN {}".format(
-                        alias, attr.name, str(attr_range.last), "'{} TO *'".format(str(attr_range.last)))
-                )
+                buckets.append((str(attr_range.last), None, "{} TO *".format(str(attr_range.last)),))
+
+    return buckets
+
+
+def _get_bq_range_case_clause(attr, table, alias, count_on, include_nulls=True, with_alias=True):
+    ranges_case = []
+
+    for lower, upper, label in _get_attr_range_buckets(attr):
+        if lower is None:
+            ranges_case.append("WHEN {}.{} < {} THEN '{}'".format(alias, attr.name, upper, label))
+        elif upper is None:
+            ranges_case.append("WHEN {}.{} > {} THEN '{}'".format(alias, attr.name, lower, label))
+        else:
+            ranges_case.append("WHEN {}.{} BETWEEN {} AND {} THEN '{}'".format(alias, attr.name, lower, upper, label))
 
     if include_nulls:
         ranges_case.append(
             "WHEN {}.{} IS NULL THEN 'none'".format(alias, attr.name))
 
-    case_clause = "(CASE {} END) AS {}".format(" ".join(ranges_case), attr.name)
+    case_clause = "(CASE {} END)".format(" ".join(ranges_case))
+    if with_alias:
+        case_clause += " AS {}".format(attr.name)
 
     return case_clause
 
 
+# Flatten bucket definitions into a lookup: the distinct bounds, sorted, and the label of each region they divide
+# the number line into--below the first bound, at it, between it and the next, and so on--taken from the first
+# bucket matching that region, as in the CASE chain. Regions no bucket matches get a label of None.
+def _range_bucket_lookup(buckets):
+    bounds = sorted(set([float(x) for bucket in buckets for x in bucket[:2] if x is not None]))
+
+    def _label(value):
+        for lower, upper, label in buckets:
+            if lower is None:
+                matched = value < float(upper)
+            elif upper is None:
+                matched = value > float(lower)
+            else:
+                matched = float(lower) <= value <= float(upper)
+            if matched:
+                return label
+        return None
+
+    labels = []
+    for index, bound in enumerate(bounds):
+        labels.append(_label(bound - 1 if index == 0 else (bounds[index-1] + bound) / 2))
+        labels.append(_label(bound))
+    labels.append(_label(bounds[-1] + 1) if len(bounds) else None)
+    return {'bounds': bounds, 'labels': labels}
+
+
+# The same bucketing as _get_bq_range_case_clause, as a label array indexed by RANGE_BUCKET. A value's region index
+# is the number of bounds <= it plus the number < it; the latter is the number of bounds less those >= it, which is
+# RANGE_BUCKET on the value's negation against the negated bounds. Its length is fixed by the number of buckets
+# rather than growing with one WHEN per bucket, and the lookup is a binary search instead of a scan of the chain.
+#
+# Returns None if the attribute has no ranges.
+def _get_bq_range_bucket_clause(attr, alias, versions=None, include_nulls=True, with_alias=True):
+    cache_key = make_cache_key("bq_range_buckets", attr.id, attr.name, _versions_cache_key(versions))
+    lookup = BQ_RANGE_BUCKETS_BY_ATTR.get(cache_key)
+    if lookup is None:
+        lookup = _range_bucket_lookup(_get_attr_range_buckets(attr))
+        BQ_RANGE_BUCKETS_BY_ATTR.put(cache_key, lookup)
+    if not len(lookup['bounds']):
+        return None
+
+    col = "{}.{}".format(alias, attr.name)
+    bucket = "[{}][OFFSET(RANGE_BUCKET({}, [{}]) + {} - RANGE_BUCKET(-{}, [{}]))]".format(
+        ", ".join(["NULL" if x is None else "'{}'".format(x) for x in lookup['labels']]),
+        col, ", ".join([repr(x) for x in lookup['bounds']]), len(lookup['bounds']),
+        col, ", ".join([repr(-x) for x in reversed(lookup['bounds'])])
+    )
+    range_clause = "IF({} IS NULL, {}, {})".format(col, "'none'" if include_nulls else "NULL", bucket)
+    if with_alias:
+        range_clause += " AS {}".format(attr.name)
+
+    return range_clause
+
+
 def get_bq_string(filters, fields, data_version, sources_and_attrs=None, group_by=None, limit=0, offset=0,
                     order_by=None, order_asc=True, search_child_records_by=None):
 
     if not data_version and not sources_and_attrs:
         data_version = ImagingDataCommonsVersion.objects.filter(active=True)
 
+    return compiled_query(
+        'bq_string',
+        lambda shaped_filters: _build_bq_string(
+            shaped_filters, list(fields), data_version, sources_and_attrs,
+            list(group_by) if type(group_by) in (list, set) else group_by, limit, offset,
+            list(order_by) if order_by else order_by, order_asc, search_child_records_by
+        ),
+        filters, fields, _bq_template_key(data_version, sources_and_attrs), group_by, limit, offset, order_by,
+        order_asc, search_child_records_by
+    )['sql']
+
+
+# Build the (unparameterized) SQL for get_bq_string, as a dict of its 'sql' and (empty) 'params'
+def _build_bq_string(filters, fields, data_version, sources_and_attrs, group_by, limit, offset, order_by, order_asc,
+                     search_child_records_by):
+
     ranged_numerics = Attribute.get_ranged_attrs()
 
     if not group_by:
@@ -2492,4 +3496,4 @@ def get_bq_string(filters, fields, data_version, sources_and_attrs=None, group_b
             #standardSQL
     """ + """UNION DISTINCT""".join(for_union)
 
-    return full_query_str
+    return {'sql': full_query_str, 'params': []}
@@ -0,0 +1,63 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from idc_collections.collex_metadata_utils import get_bq_metadata
+from google_helpers.bigquery.bq_support import BigQuerySupport
+
+logger = logging.getLogger('main_logger')
+
+
+# Builds a get_bq_metadata query with and without the query planner, and dry runs both to report the difference in
+# bytes scanned. Nothing is billed.
+class Command(BaseCommand):
+    help = "Compare the bytes scanned by a get_bq_metadata query with and without the query planner"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--filters', type=str, default="{}",
+                            help="Filters as a JSON object, eg. '{\"Modality\": [\"CT\", \"MR\"]}'")
+        parser.add_argument('--fields', type=str, required=True, help="Comma-separated fields to select")
+        parser.add_argument('--search-by', type=str, default=None,
+                            help="Return all child records of this level, eg. StudyInstanceUID")
+        parser.add_argument('--show-sql', action='store_true', help="Print both queries")
+
+    def handle(self, *args, **options):
+        try:
+            filters = json.loads(options['filters'])
+        except ValueError as e:
+            raise CommandError("--filters isn't valid JSON: {}".format(str(e)))
+        fields = [x.strip() for x in options['fields'].split(",") if len(x.strip())]
+
+        bqs = BigQuerySupport(None, None, None)
+        scanned = {}
+        for planned in [False, True]:
+            query = get_bq_metadata(
+                filters, fields, None, search_child_records_by=options['search_by'], no_submit=True,
+                plan_query=planned
+            )
+            scanned[planned] = bqs.dry_run_bytes(query['sql_string'], query['params'])
+            if options['show_sql']:
+                self.stdout.write("{} query:\n{}".format("Planned" if planned else "Unplanned", query['sql_string']))
+
+        delta = scanned[True] - scanned[False]
+        self.stdout.write("[STATUS] Unplanned: {} bytes; planned: {} bytes; delta: {} bytes ({}%).".format(
+            scanned[False], scanned[True], delta,
+            str(round(100.0 * delta / scanned[False], 1)) if scanned[False] else "n/a"
+        ))
@@ -0,0 +1,83 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from idc_collections.models import Attribute, Attribute_Ranges, DataSource
+from idc_collections.collex_metadata_utils import _get_bq_range_case_clause, _get_bq_range_bucket_clause
+from google_helpers.bigquery.bq_support import BigQuerySupport
+
+logger = logging.getLogger('main_logger')
+
+COUNT_QUERY = """
+    #standardSQL
+    SELECT {bucket} AS bucket, COUNT(*) AS count
+    FROM `{table}` t
+    GROUP BY bucket
+"""
+
+
+# Compares the CASE chain and RANGE_BUCKET forms of continuous numeric facet bucketing: the length of each clause,
+# and with --run, the slot time of a bucketed count over the attribute's active BigQuery table and whether the two
+# sets of counts agree.
+class Command(BaseCommand):
+    help = "Compare CASE and RANGE_BUCKET bucketing of continuous numeric facets"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--attrs', type=str, default=None,
+                            help="Comma-separated attribute names (default: every ranged attribute)")
+        parser.add_argument('--run', action='store_true', help="Run both count queries and compare slot time")
+
+    def handle(self, *args, **options):
+        ranged = Attribute.objects.filter(
+            active=True, data_type=Attribute.CONTINUOUS_NUMERIC,
+            id__in=Attribute_Ranges.objects.all().values_list('attribute', flat=True)
+        )
+        if options['attrs']:
+            ranged = ranged.filter(name__in=[x.strip() for x in options['attrs'].split(",")])
+        if not len(ranged):
+            raise CommandError("No ranged continuous numeric attributes found.")
+
+        bqs = BigQuerySupport(None, None, None)
+        for attr in ranged:
+            case_clause = _get_bq_range_case_clause(attr, None, "t", None, with_alias=False)
+            bucket_clause = _get_bq_range_bucket_clause(attr, "t", with_alias=False)
+            if not bucket_clause:
+                self.stdout.write("[STATUS] {}: no buckets defined.".format(attr.name))
+                continue
+            self.stdout.write("[STATUS] {}: {} WHENs; CASE is {} characters, RANGE_BUCKET is {}.".format(
+                attr.name, case_clause.count("WHEN "), len(case_clause), len(bucket_clause)))
+            if not options['run']:
+                continue
+
+            source = attr.data_sources.filter(source_type=DataSource.BIGQUERY, versions__active=True).first()
+            if not source:
+                self.stdout.write("[STATUS] {}: no active BigQuery table to run against.".format(attr.name))
+                continue
+            counts = {}
+            slot_ms = {}
+            for form, clause in [("CASE", case_clause), ("RANGE_BUCKET", bucket_clause)]:
+                job = bqs.insert_bq_query_job(COUNT_QUERY.format(bucket=clause, table=source.name))
+                done = bqs.await_job_is_done(job)
+                slot_ms[form] = done.get('statistics', {}).get('query', {}).get('totalSlotMs', None)
+                counts[form] = sorted([
+                    (x['f'][0]['v'], x['f'][1]['v'],) for x in bqs.fetch_job_results(done['jobReference'])
+                ], key=lambda x: str(x))
+            self.stdout.write("[STATUS] {} on {}: CASE used {} slot ms, RANGE_BUCKET {}; counts {}.".format(
+                attr.name, source.name, slot_ms["CASE"], slot_ms["RANGE_BUCKET"],
+                "match" if counts["CASE"] == counts["RANGE_BUCKET"] else "DIFFER"))
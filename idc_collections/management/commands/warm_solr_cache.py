@@ -0,0 +1,95 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand, CommandError
+
+from idc_collections.models import DataSource
+from solr_helpers import query_solr
+from solr_helpers.query_recorder import get_top_solr_queries, flush_solr_queries
+
+logger = logging.getLogger('main_logger')
+
+
+# Replays the exact Solr payloads of the most frequently recorded explorer filter sets, so that Solr's filterCache
+# and queryResultCache are warm before traffic is routed to it (eg. after a restart or a new IDC version going live).
+# Requires SOLR_QUERY_RECORDER to have been enabled on the serving instances.
+class Command(BaseCommand):
+    help = "Warm Solr's caches by replaying the top-N recorded filter set fingerprints"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=50, help="Number of fingerprints to replay (default 50)")
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help="Maximum number of Solr queries in flight at once (default 4)")
+        parser.add_argument('--min-hits', type=int, default=2,
+                            help="Only replay fingerprints seen at least this many times (default 2)")
+        parser.add_argument('--store', type=str, default=None, help="Path to the recorder store, if not the default")
+        parser.add_argument('--all-versions', action='store_true',
+                            help="Replay fingerprints recorded against collections no longer active")
+        parser.add_argument('--dry-run', action='store_true', help="List what would be replayed without querying")
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1:
+            raise CommandError("--concurrency must be at least 1.")
+
+        # Anything recorded by this process (eg. from a shell) should be included
+        flush_solr_queries(options['store'])
+        fingerprints = get_top_solr_queries(options['top'], options['store'], min_hits=options['min_hits'])
+
+        active_collections = set(DataSource.objects.filter(
+            source_type=DataSource.SOLR, versions__active=True
+        ).values_list('name', flat=True))
+
+        payloads = []
+        for fingerprint in fingerprints:
+            stale = [x['collection'] for x in fingerprint['payloads'] if x['collection'] not in active_collections]
+            if len(stale) and not options['all_versions']:
+                self.stdout.write("[STATUS] Skipping fingerprint {} ({} hits): collections {} aren't active.".format(
+                    fingerprint['fingerprint'], fingerprint['hits'], stale))
+                continue
+            payloads.extend([(fingerprint, x) for x in fingerprint['payloads']])
+
+        self.stdout.write("[STATUS] Replaying {} Solr queries from {} fingerprints with concurrency {}.".format(
+            len(payloads), len(fingerprints), options['concurrency']))
+
+        if options['dry_run']:
+            for fingerprint, payload in payloads:
+                self.stdout.write("{} ({} hits): {} with {} filters".format(
+                    fingerprint['fingerprint'], fingerprint['hits'], payload['collection'], len(payload['fqs'] or [])))
+            return
+
+        start = time.time()
+        failed = 0
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            futures = {executor.submit(self.replay, payload): fingerprint for fingerprint, payload in payloads}
+            for future in as_completed(futures):
+                if not future.result():
+                    failed += 1
+        stop = time.time()
+
+        self.stdout.write("[STATUS] Replayed {} Solr queries in {}s; {} failed.".format(
+            len(payloads), str(round(stop-start, 2)), failed))
+
+    @staticmethod
+    def replay(payload):
+        start = time.time()
+        result = query_solr(**payload)
+        logger.info("[BENCHMARKING] Time to replay warming query against {}: {}s".format(
+            payload['collection'], str(time.time()-start)))
+        return bool(result)
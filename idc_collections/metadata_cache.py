@@ -0,0 +1,120 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import time
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('main_logger')
+
+
+# Produce a canonical, order-independent form of a filter set, so that the same logical filters
+# always hash to the same key regardless of attribute or value ordering. Values are compared as
+# strings, as they arrive from both the WebApp and the API in mixed types.
+def canonical_filters(filters, exclude=None):
+    canonical = {}
+    exclude = exclude or []
+    for attr in sorted((filters or {}).keys()):
+        if attr in exclude:
+            continue
+        vals = filters[attr]
+        if isinstance(vals, dict):
+            canonical[attr] = {key: canonical_filter_values(val) for key, val in vals.items()}
+        else:
+            canonical[attr] = canonical_filter_values(vals)
+    return canonical
+
+
+def canonical_filter_values(vals):
+    if isinstance(vals, (list, tuple, set)):
+        return sorted([canonical_filter_values(x) if isinstance(x, (list, tuple)) else str(x) for x in vals], key=str)
+    return str(vals)
+
+
+# Build a stable hash key out of an arbitrary set of JSON-serializable parts
+def make_cache_key(*parts):
+    return hashlib.md5(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+# A thread-safe, size-bounded LRU cache with an optional per-entry time-to-live. Entries can be tagged
+# with an origin (eg. 'prefetch') so that hit rates can be reported per way the entry was populated.
+class MetadataCache(object):
+
+    def __init__(self, name, max_entries=256, ttl=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'hits_by_origin': {}
+        }
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry['expires'] is not None and entry['expires'] < time.time():
+                del self._entries[key]
+                self._stats['expirations'] += 1
+                entry = None
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            if entry['origin']:
+                self._stats['hits_by_origin'][entry['origin']] = self._stats['hits_by_origin'].get(entry['origin'], 0) + 1
+            return entry['value']
+
+    def contains(self, key):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            return bool(entry is not None and (entry['expires'] is None or entry['expires'] >= time.time()))
+
+    def put(self, key, value, origin=None, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        with self._lock:
+            self._entries[key] = {
+                'value': value,
+                'origin': origin,
+                'expires': (time.time() + ttl) if ttl else None
+            }
+            self._entries.move_to_end(key)
+            self._stats['stores'] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['hits_by_origin'] = dict(self._stats['hits_by_origin'])
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
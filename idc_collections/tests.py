@@ -17,7 +17,27 @@
 from django.test import TestCase
 from django.contrib.auth.models import AnonymousUser, User
 from idc_collections.collex_metadata_utils import build_explorer_context, get_collex_metadata, get_metadata_solr, fetch_data_source_attr, fetch_solr_facets
-from idc_collections.models import Program, Project, ImagingDataCommonsVersion, DataSource, DataSetType
+from idc_collections.collex_metadata_utils import _rank_explorer_refinements, _solr_facet_cache_keys, \
+    route_aggregate_level, DATA_SOURCE_ATTR_NAMES, _drop_count_toggles, _range_bucket_lookup, compile_cart_partitions, \
+    _count_bq_facets, SOLR_FACET_COUNTS, _get_bq_range_bucket_clause, BQ_RANGE_BUCKETS_BY_ATTR
+from idc_collections import collex_metadata_utils
+from bisect import bisect_right
+from idc_collections.metadata_cache import MetadataCache, canonical_filters, make_cache_key
+from google_helpers.bigquery.result_cache import bq_result_cache_key
+from idc_collections.bq_sql_templates import compiled_query, BQ_SQL_TEMPLATES
+from idc_collections.bq_query_planner import child_record_filter, prune_joins, union_is_disjoint
+import sqlite3
+import os
+import copy
+import json
+import tempfile
+from io import StringIO
+from unittest.mock import patch
+from django.core.management import call_command
+from solr_helpers.query_recorder import flush_solr_queries, get_top_solr_queries
+from google_helpers.bigquery.bq_support import BigQuerySupport
+from idc_collections.models import Program, Project, ImagingDataCommonsVersion, DataSource, DataSetType, Attribute, \
+    DataVersion
 
 
 class ModelsTest(TestCase):
@@ -205,3 +225,360 @@ class CollexMetaDataUtilsTests(TestCase):
                                         facets, records_only, sort, uniques, record_source, totals,
                                         search_child_records_by=search_child_records_by)'''
         pass
+
+    # Warming replays the full count queries an explorer request made, even where some of its facets were served from
+    # the facet count cache, so the next identical request after a restart sends exactly what Solr has cached
+    def test_warm_solr_cache(self):
+        store = os.path.join(tempfile.mkdtemp(), "fingerprints.sqlite3")
+        args = {
+            "filters": {"collection_id": ["tcga_luad"]}, "fields": [], "sources": self.sources.filter(id=self.sourceList[0].id),
+            "counts_only": True, "collapse_on": None, "record_limit": 0
+        }
+        sent = []
+
+        # Answers every facet, so a repeat of the request is served from the facet count cache
+        def _query(query_settings, raw_format=False):
+            sent.append(copy.deepcopy(query_settings))
+            facets = {x['field']: {} for x in (query_settings['facets'] or {}).values() if 'field' in x}
+            return {'numFound': 1, 'facets': facets}
+
+        SOLR_FACET_COUNTS.clear()
+        with patch('idc_collections.collex_metadata_utils.SOLR_QUERY_RECORDER', True), \
+                patch('solr_helpers.query_recorder.SOLR_QUERY_RECORDER', True), \
+                patch('solr_helpers.query_recorder.SOLR_QUERY_RECORDER_STORE', store), \
+                patch('idc_collections.collex_metadata_utils.query_solr_and_format_result', side_effect=_query):
+            get_metadata_solr(**args)
+            cold = sent[:]
+            get_metadata_solr(**args)
+            self.assertLess(len(sent[-1]['facets'] or {}), len(cold[-1]['facets']))
+            flush_solr_queries()
+
+            # Repeats of a request are recorded under one fingerprint
+            fingerprints = get_top_solr_queries(store=store)
+            self.assertEqual(len(fingerprints), 1)
+            self.assertEqual(fingerprints[0]['hits'], 2)
+
+            replayed = []
+            with patch('idc_collections.management.commands.warm_solr_cache.query_solr',
+                       side_effect=lambda **payload: replayed.append(payload) or {'response': {'numFound': 1}}):
+                call_command('warm_solr_cache', store=store, min_hits=2, stdout=StringIO())
+
+            # A restart empties the facet count cache
+            SOLR_FACET_COUNTS.clear()
+            del sent[:]
+            get_metadata_solr(**args)
+
+        def _canonical(payloads):
+            return sorted([json.dumps(x, sort_keys=True, default=str) for x in payloads])
+        self.assertEqual(_canonical(replayed), _canonical(cold))
+        self.assertEqual(_canonical(replayed), _canonical(sent))
+
+
+class MetadataCacheTests(TestCase):
+
+    def test_canonical_filters(self):
+        self.assertEqual(
+            make_cache_key(canonical_filters({'Modality': ['MR', 'CT'], 'collection_id': ['tcga_luad']})),
+            make_cache_key(canonical_filters({'collection_id': ['tcga_luad'], 'Modality': ['CT', 'MR']}))
+        )
+        self.assertNotIn('Modality', canonical_filters({'Modality': ['CT'], 'collection_id': ['tcga_luad']},
+                                                       exclude=['Modality']))
+
+    def test_cache_eviction_and_stats(self):
+        cache = MetadataCache("test", max_entries=2)
+        cache.put("a", 1, origin="prefetch")
+        cache.put("b", 2)
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+        self.assertEqual(cache.get("c"), 3)
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_rank_explorer_refinements(self):
+        facet_counts = {
+            'dicom_derived_study:v1:1': {'facets': {
+                'Modality': {'CT': 100, 'MR': 40, 'PT': 0},
+                'collection_id': {'tcga_luad': 30, 'nlst': 500},
+                'age_at_diagnosis': {'min_max': {'min': 1, 'max': 90}}
+            }}
+        }
+        refinements = _rank_explorer_refinements({'collection_id': ['tcga_luad']}, facet_counts,
+                                                 ['Modality', 'collection_id'], 3)
+        self.assertEqual(len(refinements), 3)
+        self.assertIn({'collection_id': ['tcga_luad', 'nlst']}, refinements)
+        self.assertIn({'collection_id': ['tcga_luad'], 'Modality': ['CT']}, refinements)
+        self.assertNotIn({'collection_id': ['tcga_luad'], 'Modality': ['PT']}, refinements)
+
+    def test_explorer_prefetch_pool_after_fork(self):
+        parent_pool = collex_metadata_utils._get_explorer_prefetch_pool()
+        parent_slots = collex_metadata_utils._explorer_prefetch_slots
+        # The parent had every slot taken by prefetches which won't run in the child
+        while parent_slots.acquire(blocking=False):
+            pass
+        collex_metadata_utils._explorer_prefetch_in_flight.add("parent_prefetch")
+        with patch('idc_collections.collex_metadata_utils._explorer_prefetch_pid', -1):
+            pool = collex_metadata_utils._get_explorer_prefetch_pool()
+        self.assertIsNot(pool, parent_pool)
+        self.assertIsNot(collex_metadata_utils._explorer_prefetch_slots, parent_slots)
+        self.assertTrue(collex_metadata_utils._explorer_prefetch_slots.acquire(blocking=False))
+        collex_metadata_utils._explorer_prefetch_slots.release()
+        self.assertEqual(len(collex_metadata_utils._explorer_prefetch_in_flight), 0)
+        parent_pool.shutdown()
+
+    def test_solr_facet_cache_keys(self):
+        source = DataSource(id=1, name="dicom_derived_study_v1")
+        facets = {
+            'Modality': {'type': 'terms', 'field': 'Modality', 'limit': -1},
+            'collection_id': {'type': 'terms', 'field': 'collection_id', 'limit': -1},
+        }
+        first = _solr_facet_cache_keys(source, "v1", facets, {'Modality': ['CT'], 'collection_id': ['nlst']}, True, [])
+        second = _solr_facet_cache_keys(source, "v1", facets, {'Modality': ['MR'], 'collection_id': ['nlst']}, True, [])
+        # Toggling Modality leaves the Modality counts valid, but not the collection_id counts
+        self.assertEqual(first['Modality'], second['Modality'])
+        self.assertNotEqual(first['collection_id'], second['collection_id'])
+        filtered = _solr_facet_cache_keys(source, "v1", facets, {'Modality': ['MR'], 'collection_id': ['nlst']}, False, [])
+        self.assertNotEqual(first['Modality'], filtered['Modality'])
+        # Only the filter carrying the attribute's tag is excluded; another range on the same attribute still applies
+        facets['age'] = {'type': 'terms', 'field': 'age', 'limit': -1}
+        ranged = _solr_facet_cache_keys(source, "v1", facets, {'age_gte': [10], 'age_lt': [20]}, True, [])
+        other = _solr_facet_cache_keys(source, "v1", facets, {'age_gte': [30], 'age_lt': [20]}, True, [])
+        moved = _solr_facet_cache_keys(source, "v1", facets, {'age_gte': [10], 'age_lt': [40]}, True, [])
+        self.assertEqual(ranged['age'], other['age'])
+        self.assertNotEqual(ranged['age'], moved['age'])
+
+
+class AggregateLevelRouterTests(TestCase):
+    study_source = DataSource(id=901, name="dicom_derived_study", aggregate_level="StudyInstanceUID", count_col="PatientID")
+    series_source = DataSource(id=902, name="dicom_derived_series", aggregate_level="SeriesInstanceUID", count_col="PatientID")
+
+    def setUp(self):
+        attrs = {'collection_id', 'PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'Modality', 'BodyPartExamined',
+                 'tumor_gtv_volume'}
+        DATA_SOURCE_ATTR_NAMES[self.study_source.id] = attrs
+        DATA_SOURCE_ATTR_NAMES[self.series_source.id] = attrs | {'SliceThickness'}
+
+    def route(self, **kwargs):
+        return route_aggregate_level([self.series_source, self.study_source], **kwargs).aggregate_level
+
+    def test_route_aggregate_level(self):
+        # Patient counts with a single level-varying filter are exact at the study level
+        self.assertEqual(self.route(filters={'Modality': ['CT', 'MR']}, counts=['PatientID']), "StudyInstanceUID")
+        # ...but series counts aren't
+        self.assertEqual(self.route(filters={'Modality': ['CT']}, counts=['SeriesInstanceUID']), "SeriesInstanceUID")
+        self.assertEqual(self.route(filters={'collection_id': ['nlst']}, counts=['SeriesInstanceUID']), "StudyInstanceUID")
+        # Two level-varying filters could be satisfied by different series of the same study
+        self.assertEqual(self.route(filters={'Modality': ['CT'], 'BodyPartExamined': ['CHEST']}, counts=['PatientID']),
+                         "SeriesInstanceUID")
+        self.assertEqual(self.route(filters={'Modality': {'values': ['CT', 'SEG'], 'op': 'AND'}}), "SeriesInstanceUID")
+        self.assertEqual(self.route(filters={'Modality': ['CT']}, facets=['BodyPartExamined']), "SeriesInstanceUID")
+        self.assertEqual(self.route(filters={'Modality': ['CT']}, facets=['Modality', 'collection_id']), "StudyInstanceUID")
+        # Attributes only present at the finer level
+        self.assertEqual(self.route(facets=['SliceThickness']), "SeriesInstanceUID")
+        self.assertEqual(self.route(counts=['PatientID'], min_level="SeriesInstanceUID"), "SeriesInstanceUID")
+        # Only a trailing range suffix is stripped from a filter's name
+        self.assertEqual(self.route(filters={'tumor_gtv_volume_gte': [10]}, counts=['PatientID']), "StudyInstanceUID")
+
+
+class BQFacetQueryTests(TestCase):
+
+    def test_drop_count_toggles(self):
+        filter_string = "((LOWER(i.Modality) IN UNNEST(@Modality_0)) OR @Modality_0_filtering = 'not_filtering') AND " \
+            "((LOWER(i.Modality_0) IN UNNEST(@Modality_0_0)) OR @Modality_0_0_filtering = 'not_filtering')"
+        dropped = _drop_count_toggles(filter_string, ['Modality_0'])
+        self.assertIn("'not_filtering' = 'not_filtering'", dropped)
+        self.assertIn("@Modality_0_0_filtering", dropped)
+        self.assertEqual(_drop_count_toggles(filter_string, []), filter_string)
+
+    def test_bq_result_cache_key(self):
+        params = [
+            {'name': 'Modality_0', 'parameterValue': {'arrayValues': [{'value': 'mr'}, {'value': 'ct'}]}},
+            {'name': 'collection_id_1', 'parameterValue': {'value': 'nlst'}}
+        ]
+        key = bq_result_cache_key("SELECT a\n  FROM t WHERE b = 'x  y'", params, [2, 1])
+        self.assertEqual(key, bq_result_cache_key(
+            "SELECT a FROM t WHERE b = 'x  y'",
+            [[params[1]], {'name': 'Modality_0', 'parameterValue': {'arrayValues': [{'value': 'ct'}, {'value': 'mr'}]}}],
+            [1, 2]
+        ))
+        self.assertNotEqual(key, bq_result_cache_key("SELECT a FROM t WHERE b = 'x y'", params, [1, 2]))
+        self.assertNotEqual(key, bq_result_cache_key("SELECT a FROM t WHERE b = 'x  y'", params, [1, 3]))
+
+    def test_count_bq_facets(self):
+        sources = {
+            name: {'name': name, 'id': i, 'data_type': DataSetType.IMAGE_DATA, 'set_type': 'origin_set',
+                   'count_col': 'PatientID', 'attrs': attrs}
+            for i, (name, attrs) in enumerate([
+                ("idc-dev.idc_v1.dicom_all", [Attribute(name="Modality", data_type=Attribute.CATEGORICAL),
+                                              Attribute(name="SliceThickness", data_type=Attribute.CATEGORICAL_NUMERIC)]),
+                ("idc-dev.idc_v1.dicom_pivot", [Attribute(name="BodyPartExamined", data_type=Attribute.CATEGORICAL)])
+            ])
+        }
+        queries = []
+        fetched = []
+
+        def insert(query, parameters=None):
+            queries.append(query)
+            return {'jobReference': {'jobId': str(len(queries))}}
+
+        def fetch(bqs, job_ref):
+            fetched.append(job_ref['jobId'])
+            if "UNNEST" in queries[int(job_ref['jobId'])-1]:
+                return [{'f': [{'v': "Modality"}, {'v': "CT"}, {'v': "3"}]}]
+            return [{'f': [{'v': "3.0"}, {'v': "2"}]}]
+
+        with patch('google_helpers.bigquery.bq_support.get_bigquery_service', return_value=None), \
+                patch.object(BigQuerySupport, 'insert_query_job', side_effect=insert), \
+                patch.object(BigQuerySupport, 'await_job_set_is_done', autospec=True,
+                             side_effect=lambda bqs, jobs: {x: True for x in jobs}), \
+                patch.object(BigQuerySupport, 'fetch_job_results', autospec=True, side_effect=fetch):
+            results, complete = _count_bq_facets({}, {'sources': {}}, {'sources': sources})
+
+        self.assertTrue(complete)
+        # A combined job and a numeric facet job per image table, each fetched once
+        self.assertEqual(sorted(fetched), ["1", "2", "3", "4"])
+        self.assertNotIn("SliceThickness", "".join([x for x in queries if "UNNEST" in x]))
+        facets = results['facets']['origin_set']["idc-dev.idc_v1.dicom_all"]['facets']
+        self.assertEqual(facets['SliceThickness'], {"3.0": 2})
+        self.assertEqual(facets['Modality'], {"CT": 3})
+        self.assertEqual(results['facets']['total'], 3)
+
+    def test_range_bucket_lookup(self):
+        # Iterated 10 to 80 by 10 with open ends, then a single range overlapping it; the first match wins
+        buckets = [(None, "10", "* TO 10")] + [(str(x), str(x + 10), "{} TO {}".format(x, x + 10)) for x in range(10, 80, 10)] \
+            + [("80", None, "80 TO *"), ("5", "15", "child")]
+        lookup = _range_bucket_lookup(buckets)
+        negated = [-x for x in reversed(lookup['bounds'])]
+
+        def case_label(value):
+            for lower, upper, label in buckets:
+                if (lower is None and value < float(upper)) or (upper is None and value > float(lower)) \
+                        or (lower is not None and upper is not None and float(lower) <= value <= float(upper)):
+                    return label
+            return None
+
+        for value in [x / 2.0 for x in range(-10, 200)]:
+            # RANGE_BUCKET(x, bounds) is the number of bounds <= x, as bisect_right gives
+            index = bisect_right(lookup['bounds'], value) + len(lookup['bounds']) - bisect_right(negated, -value)
+            self.assertEqual(lookup['labels'][index], case_label(value), value)
+
+    def test_range_bucket_cache_key(self):
+        attr = Attribute(id=1, name="age_at_diagnosis", data_type=Attribute.CONTINUOUS_NUMERIC)
+        versions = [DataVersion(id=x, name="v{}".format(x)) for x in range(30)]
+        BQ_RANGE_BUCKETS_BY_ATTR.clear()
+        with patch('idc_collections.collex_metadata_utils._get_attr_range_buckets',
+                   return_value=[(None, "10", "* TO 10"), ("10", None, "10 TO *")]) as fetch:
+            clause = _get_bq_range_bucket_clause(attr, "d", versions)
+            # The same set of versions in any order shares an entry
+            self.assertEqual(_get_bq_range_bucket_clause(attr, "d", list(reversed(versions))), clause)
+            self.assertEqual(fetch.call_count, 1)
+            # Sets differing only past the point a QuerySet's string form is truncated don't
+            _get_bq_range_bucket_clause(attr, "d", versions[:-1] + [DataVersion(id=99, name="v99")])
+            self.assertEqual(fetch.call_count, 2)
+
+
+class BQSqlTemplateTests(TestCase):
+
+    def setUp(self):
+        self.builds = 0
+
+    # Stands in for get_bq_metadata's builder: inlines numerics, and parameterizes (lower-cased) strings
+    def build(self, filters):
+        self.builds += 1
+        clauses = []
+        params = []
+        for attr, values in filters.items():
+            if attr.endswith('_btw'):
+                clauses.append("{} BETWEEN {} AND {}".format(attr[:-4], values[0], values[1]))
+            elif values == ['None']:
+                clauses.append("{} IS NULL".format(attr))
+            else:
+                clauses.append("LOWER({}) IN UNNEST(@{})".format(attr, attr))
+                params.append({'name': attr, 'parameterValue': {'arrayValues': [{'value': x.lower()} for x in values]}})
+        return {'sql': " AND ".join(clauses), 'params': params}
+
+    def test_compiled_query(self):
+        BQ_SQL_TEMPLATES.clear()
+        first = compiled_query('test', self.build, {'Modality': ['CT', 'MR'], 'age_btw': [10, 20]})
+        second = compiled_query('test', self.build, {'age_btw': [30, 45], 'Modality': ['SEG', 'PT']})
+        self.assertEqual(self.builds, 1)
+        self.assertEqual(first['sql'], "LOWER(Modality) IN UNNEST(@Modality) AND age BETWEEN 10 AND 20")
+        self.assertEqual(second['sql'], "LOWER(Modality) IN UNNEST(@Modality) AND age BETWEEN 30 AND 45")
+        self.assertEqual([x['value'] for x in second['params'][0]['parameterValue']['arrayValues']], ['seg', 'pt'])
+        # A different shape is a different template
+        compiled_query('test', self.build, {'Modality': ['None']})
+        self.assertEqual(self.builds, 2)
+
+
+class BQQueryPlannerTests(TestCase):
+
+    def test_child_record_filter(self):
+        # The grouped scan must find the same studies as the INTERSECT DISTINCT chain it replaces; sqlite stands in for
+        # BigQuery, with SUM for COUNTIF
+        db = sqlite3.connect(":memory:")
+        db.execute("CREATE TABLE s (study TEXT, Modality TEXT, BodyPart TEXT, collection TEXT)")
+        db.executemany("INSERT INTO s VALUES (?, ?, ?, ?)", [
+            ('a', 'CT', 'CHEST', 'nlst'), ('a', 'SEG', None, 'nlst'), ('b', 'CT', 'HEAD', 'nlst'),
+            ('b', 'MR', 'CHEST', 'tcga'), ('c', 'CT', 'CHEST', 'tcga'), ('d', None, None, 'nlst'), (None, 'CT', 'CHEST', 'nlst')
+        ])
+        conditions = ["(s.Modality IN ('CT'))", "(s.BodyPart IN ('CHEST'))"]
+        for cart_clause in ["", " AND (s.collection = 'nlst')"]:
+            intersected = "SELECT DISTINCT study FROM s WHERE study IN ({})".format(" INTERSECT ".join([
+                "SELECT study FROM s WHERE TRUE AND {} {} GROUP BY study".format(x, cart_clause) for x in conditions
+            ]))
+            grouped = "SELECT DISTINCT study FROM s WHERE study IN ({})".format(
+                child_record_filter("study", "s", cart_clause, conditions).replace("COUNTIF(", "SUM(")
+            )
+            self.assertEqual(sorted(db.execute(intersected).fetchall()), sorted(db.execute(grouped).fetchall()))
+
+    def test_prune_joins(self):
+        joins = [
+            {'alias': 'clinical', 'clause': "LEFT JOIN clinical", 'left': True},
+            {'alias': 'clin', 'clause': "LEFT JOIN clin", 'left': True},
+            {'alias': 'seg', 'clause': "JOIN seg", 'left': False}
+        ]
+        kept = prune_joins(joins, "dicom.PatientID,clinical.age GROUP BY dicom.PatientID, clinical.age", True)
+        self.assertEqual([x['alias'] for x in kept], ['clinical', 'seg'])
+        self.assertEqual(len(prune_joins(joins, "dicom.PatientID", False)), 3)
+
+    def test_union_is_disjoint(self):
+        branches = [
+            {'alias': 'a', 'aggregate_level': "SeriesInstanceUID", 'versions': ["TCIA Image Data"],
+             'fields': ['a.SeriesInstanceUID', 'a.Modality'], 'group_by': {'a.Modality', 'a.SeriesInstanceUID'}},
+            {'alias': 'b', 'aggregate_level': "SeriesInstanceUID", 'versions': ["IDC Derived Data"],
+             'fields': ['b.SeriesInstanceUID', 'b.Modality'], 'group_by': ['b.SeriesInstanceUID', 'b.Modality']}
+        ]
+        self.assertTrue(union_is_disjoint(branches))
+        branches[1]['versions'] = ["TCIA Image Data"]
+        self.assertFalse(union_is_disjoint(branches))
+        branches[1]['versions'] = ["IDC Derived Data"]
+        branches[1]['fields'] = ['b.Modality']
+        self.assertFalse(union_is_disjoint(branches))
+
+
+class CartPartitionTests(TestCase):
+
+    def test_compile_cart_partitions(self):
+        partitions = [
+            {'id': ['TCGA_LUAD'], 'not': ['P1']},
+            {'id': ['nlst', 'P2'], 'not': []},
+            {'id': ['nlst', 'P3', 'S1'], 'not': ['SE1', 'SE2']},
+            {'id': ['nlst', 'P3', 'S1'], 'not': ['SE2']}
+        ]
+        compiled = compile_cart_partitions(partitions)
+        params = {x['name']: [
+            y.get('value', None) or tuple([z['value'] for z in y['structValues'].values()])
+            for y in x['parameterValue']['arrayValues']
+        ] for x in compiled['parameters']}
+        self.assertEqual(params['cart_PatientID'], [('nlst', 'p2')])
+        self.assertEqual(params['cart_collection_id_excl'], ['tcga_luad'])
+        self.assertEqual(params['cart_collection_id_excl_PatientID'], [('tcga_luad', 'p1')])
+        # Only what every partition for the study excludes stays excluded
+        self.assertEqual(params['cart_StudyInstanceUID_excl_SeriesInstanceUID'], [('nlst', 'p3', 's1', 'se2')])
+
+        # The SQL is the same size however many partitions there are
+        many = compile_cart_partitions([{'id': ['nlst', 'P{}'.format(x)], 'not': []} for x in range(5000)])
+        self.assertEqual(many['filter_string'], compile_cart_partitions(partitions[1:2])['filter_string'])
+        self.assertEqual(len(many['parameters'][0]['parameterValue']['arrayValues']), 5000)
@@ -585,9 +585,10 @@ def get_acls_by_uuid(uuids):
         ) for table in tables]
     )
 
-    results = BigQuerySupport.execute_query_and_fetch_results(query, where_clause['parameters'])
+    results = BigQuerySupport.execute_query_and_fetch_results(query, where_clause['parameters'], with_schema=True)
 
-    acls = [row['f'][0]['v'] for row in results]
+    if results:
+        acls = [acl for acl, in BigQuerySupport.decode_rows(results['results'], results['schema'])]
 
     return acls
 
@@ -616,16 +617,16 @@ def get_paths_by_uuid(uuids):
         ) for table in tables]
     )
 
-    results = BigQuerySupport.execute_query_and_fetch_results(query, where_clause['parameters'])
+    results = BigQuerySupport.execute_query_and_fetch_results(query, where_clause['parameters'], with_schema=True)
     
     if results:
-        for row in results:
+        for uuid, gcs_path, index_path in BigQuerySupport.decode_rows(results['results'], results['schema']):
             item = {
-                'gdc_file_uuid': row['f'][0]['v'],
-                'gcs_path': row['f'][1]['v']
+                'gdc_file_uuid': uuid,
+                'gcs_path': gcs_path
             }
-            if row['f'][2]['v'] is not None and not row['f'][2]['v'] == '':
-                item['index_file_path'] = row['f'][2]['v']
+            if index_path is not None and not index_path == '':
+                item['index_file_path'] = index_path
             
             paths.append(item)
             
@@ -6,6 +6,7 @@ import json
 import re
 import hashlib
 import time
+import codecs
 
 from idc_collections.models import Attribute, DataSource, Attribute_Ranges, DataSetType
 
@@ -17,6 +18,12 @@ SOLR_URI = settings.SOLR_URI
 SOLR_LOGIN = settings.SOLR_LOGIN
 SOLR_PASSWORD = settings.SOLR_PASSWORD
 SOLR_CERT = settings.SOLR_CERT
+SOLR_EXPORT_CHUNK_SIZE = getattr(settings, 'SOLR_EXPORT_CHUNK_SIZE', 65536)
+SOLR_CURSOR_PAGE_SIZE = getattr(settings, 'SOLR_CURSOR_PAGE_SIZE', 5000)
+
+# Cache of the fields in a given Solr collection which have docValues, as the /export handler can only return and
+# sort on those
+SOLR_DOCVALUE_FIELDS = {}
 
 BMI_MAPPING = {
     'underweight': '[* TO 18.5}',
@@ -197,6 +204,231 @@ def query_solr(collection=None, fields=None, query_string=None, fqs=None, facets
     return query_result
 
 
+# Fetch (and cache) the set of fields in a Solr collection which have docValues enabled
+def get_solr_docvalue_fields(collection):
+    if collection not in SOLR_DOCVALUE_FIELDS:
+        schema_uri = "{}{}/schema/fields".format(SOLR_URI, collection)
+        schema_response = requests.get(schema_uri, params={'showDefaults': 'true', 'wt': 'json'},
+                                       auth=(SOLR_LOGIN, SOLR_PASSWORD), verify=SOLR_CERT)
+        if schema_response.status_code != 200:
+            raise Exception("Saw response code {} when fetching the schema of solr collection {}: {}".format(
+                str(schema_response.status_code), collection, schema_response.text
+            ))
+        SOLR_DOCVALUE_FIELDS[collection] = set(
+            [x['name'] for x in schema_response.json().get('fields', []) if x.get('docValues', False)]
+        )
+    return SOLR_DOCVALUE_FIELDS[collection]
+
+
+# Incrementally parse the body of a Solr /export response, yielding each doc as soon as it's been fully received.
+# The body has the form {"responseHeader":{...},"response":{"numFound":N,"docs":[{...},{...},...]}}, so only the docs
+# array needs to be walked; header is filled in with numFound once it's been seen.
+def parse_solr_export_stream(chunks, header=None):
+    decoder = json.JSONDecoder()
+    # Multi-byte characters can be split across chunks
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    header = header if header is not None else {}
+    buffer = ""
+    in_docs = False
+    finished = False
+    chunks = iter(chunks)
+    exhausted = False
+
+    while not finished:
+        if not exhausted:
+            chunk = next(chunks, None)
+            if chunk is None:
+                exhausted = True
+            else:
+                buffer += utf8_decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        if not in_docs:
+            docs_start = re.search(r'"docs"\s*:\s*\[', buffer)
+            if not docs_start:
+                if exhausted:
+                    raise Exception("Solr /export response ended without a docs list: {}".format(buffer[:500]))
+                continue
+            num_found = re.search(r'"numFound"\s*:\s*(\d+)', buffer[:docs_start.start()])
+            if num_found:
+                header['numFound'] = int(num_found.group(1))
+            buffer = buffer[docs_start.end():]
+            in_docs = True
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == ']':
+                finished = True
+                break
+            try:
+                doc, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # Partial document--wait for the next chunk
+                if exhausted:
+                    raise Exception("Solr /export response was truncated mid-document.")
+                break
+            if 'EXCEPTION' in doc:
+                raise Exception("Solr /export reported an error: {}".format(doc['EXCEPTION']))
+            yield doc
+        buffer = buffer[pos:]
+        if exhausted and not finished:
+            raise Exception("Solr /export response ended before the docs list was closed.")
+
+
+# Stream every matching doc out of a collection via the /export handler. All fields in fl and sort must have
+# docValues, and a sort is mandatory.
+def stream_solr_export(collection, fields, query_string=None, fqs=None, sort=None, header=None):
+    export_uri = "{}{}/export".format(SOLR_URI, collection)
+    params = {
+        'q': query_string or "*:*",
+        'fl': ",".join(fields),
+        'sort': sort or "id asc",
+    }
+    if fqs:
+        params['fq'] = fqs if type(fqs) is list else [fqs]
+
+    with requests.post(export_uri, data=params, auth=(SOLR_LOGIN, SOLR_PASSWORD), verify=SOLR_CERT,
+                       stream=True) as export_response:
+        if export_response.status_code != 200:
+            raise Exception("Saw response code {} when exporting from solr collection {}: {}".format(
+                str(export_response.status_code), collection, export_response.text
+            ))
+        for doc in parse_solr_export_stream(export_response.iter_content(chunk_size=SOLR_EXPORT_CHUNK_SIZE),
+                                            header):
+            yield doc
+
+
+# Stream every matching doc out of a collection via cursorMark paging of the standard /query handler
+def stream_solr_cursor(collection, fields, query_string=None, fqs=None, sort=None, header=None,
+                       page_size=SOLR_CURSOR_PAGE_SIZE):
+    cursor = "*"
+    while cursor:
+        result = query_solr(collection=collection, fields=fields, query_string=query_string, fqs=fqs, sort=sort,
+                            counts_only=False, limit=page_size, with_cursor=cursor)
+        if 'response' not in result:
+            raise Exception("Failed to fetch cursor page {} from solr collection {}.".format(cursor, collection))
+        if header is not None:
+            header['numFound'] = result['response']['numFound']
+        for doc in result['response']['docs']:
+            yield doc
+        next_cursor = result.get('nextCursorMark', None)
+        cursor = next_cursor if (next_cursor != cursor and len(result['response']['docs'])) else None
+
+
+# Record identifiers, coarsest to finest. Every doc of a given record has the same value for each coarser level (a
+# series is in one study, of one patient, in one collection).
+RECORD_HIERARCHY = ["collection_id", "PatientID", "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID"]
+
+
+# Returns the sort, with unique_on added if it's not already present, under which all docs sharing a unique_on value
+# arrive together, so they can be de-duplicated against the previous doc alone. That holds when unique_on is only
+# preceded in the sort by coarser record levels. Returns None for any other sort.
+def adjacent_unique_sort(sort, unique_on):
+    if unique_on not in RECORD_HIERARCHY:
+        return None
+    clauses = [x.strip() for x in (sort or "").split(",") if len(x.strip())]
+    sort_fields = [x.split(" ")[0] for x in clauses]
+    if unique_on in sort_fields:
+        preceding = sort_fields[:sort_fields.index(unique_on)]
+    else:
+        preceding = sort_fields
+        clauses.append("{} asc".format(unique_on))
+    coarser = RECORD_HIERARCHY[:RECORD_HIERARCHY.index(unique_on)]
+    if len([x for x in preceding if x not in coarser]):
+        return None
+    return ",".join(clauses)
+
+
+# Bulk record extraction for manifest-shaped requests: a fixed field list, a sort, and potentially very large
+# limits. Uses the /export handler when every requested and sorted field has docValues, otherwise (or if the export
+# fails) falls back to cursorMark paging. Both stream, so only the requested docs are ever held in memory.
+#
+# Returns None if the request can't be served by streaming, in which case the caller should use query_solr:
+#   - offset is nonzero: neither handler can start partway through, and reading and discarding the skipped docs is
+#     O(offset), whereas /query skips them in the index
+#   - unique_on is given and the sort would interleave its records (see adjacent_unique_sort)
+#   - both handlers failed
+#
+# unique_on: optional field to de-duplicate records on, in place of {!collapse}, which /export doesn't support.
+# numFound is then the number of distinct unique_on values, as it would be with {!collapse}.
+def export_solr(collection, fields, query_string=None, fqs=None, sort=None, offset=0, limit=None, unique_on=None):
+    if offset:
+        return None
+    fields = list(fields)
+    if unique_on:
+        sort = adjacent_unique_sort(sort, unique_on)
+        if not sort:
+            logger.info("[STATUS] Sort doesn't group records by {}; not streaming from {}.".format(unique_on,
+                                                                                                 collection))
+            return None
+        if unique_on not in fields:
+            fields.append(unique_on)
+    sort = sort or "id asc"
+    sort_fields = [x.strip().split(" ")[0] for x in sort.split(",")]
+
+    use_export = False
+    try:
+        docvalue_fields = get_solr_docvalue_fields(collection)
+        missing = [x for x in fields+sort_fields if x not in docvalue_fields]
+        use_export = not len(missing)
+        if missing:
+            logger.info("[STATUS] Fields {} in collection {} lack docValues; using cursorMark paging.".format(
+                missing, collection))
+    except Exception as e:
+        logger.error("[ERROR] While checking docValues for solr collection {}; using cursorMark paging:".format(
+            collection))
+        logger.exception(e)
+
+    for handler in (['export', 'cursor'] if use_export else ['cursor']):
+        header = {}
+        docs = []
+        last_key = None
+        read = 0
+        complete = True
+        try:
+            start = time.time()
+            streamer = stream_solr_export if handler == 'export' else stream_solr_cursor
+            for doc in streamer(collection, fields, query_string=query_string, fqs=fqs, sort=sort, header=header):
+                read += 1
+                if unique_on:
+                    key = str(doc.get(unique_on, None))
+                    if key == last_key:
+                        continue
+                    last_key = key
+                if limit and len(docs) >= limit:
+                    complete = False
+                    break
+                docs.append(doc)
+            stop = time.time()
+            logger.info("[BENCHMARKING] Solr {} of {} docs from {}: {}s ({} docs/s)".format(
+                handler, read, collection, str(stop-start),
+                str(round(read/(stop-start), 1)) if stop > start else "-"
+            ))
+            if not unique_on:
+                num_found = header.get('numFound', len(docs))
+            elif complete:
+                num_found = len(docs)
+            else:
+                count_result = query_solr(collection=collection, query_string=query_string,
+                                          fqs=list(fqs if type(fqs) is list else [fqs]) if fqs else None,
+                                          counts_only=True, collapse_on=unique_on)
+                if 'response' not in count_result:
+                    raise Exception("Failed to count the distinct {} values in solr collection {}.".format(
+                        unique_on, collection))
+                num_found = count_result['response']['numFound']
+            return {
+                'numFound': num_found,
+                'docs': docs,
+                'handler': handler
+            }
+        except Exception as e:
+            logger.error("[ERROR] While extracting records from solr collection {} via {}:".format(collection, handler))
+            logger.exception(e)
+
+    return None
+
+
 # Generates the Solr stats block of a JSON API request
 def build_solr_stats(attrs,filter_tags=None):
     stats = []
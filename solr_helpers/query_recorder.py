@@ -0,0 +1,137 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import time
+import json
+import atexit
+import logging
+import sqlite3
+import tempfile
+import threading
+from django.conf import settings
+
+logger = logging.getLogger('main_logger')
+
+# Recording of Solr query fingerprints, used to re-warm Solr's caches after a restart or a version change
+SOLR_QUERY_RECORDER = getattr(settings, 'SOLR_QUERY_RECORDER', False)
+SOLR_QUERY_RECORDER_STORE = getattr(settings, 'SOLR_QUERY_RECORDER_STORE',
+                                    os.path.join(tempfile.gettempdir(), "idc_solr_query_fingerprints.sqlite3"))
+# Pending counts are written out once this many requests have been recorded or this many seconds have passed
+SOLR_QUERY_RECORDER_FLUSH_COUNT = getattr(settings, 'SOLR_QUERY_RECORDER_FLUSH_COUNT', 50)
+SOLR_QUERY_RECORDER_FLUSH_SECS = getattr(settings, 'SOLR_QUERY_RECORDER_FLUSH_SECS', 60)
+# Most fingerprints kept in the store; the least frequently (then least recently) seen are dropped on each flush
+SOLR_QUERY_RECORDER_MAX_FINGERPRINTS = getattr(settings, 'SOLR_QUERY_RECORDER_MAX_FINGERPRINTS', 1000)
+
+_pending = {}
+_pending_count = 0
+_last_flush = time.time()
+_lock = threading.Lock()
+
+
+def _connect(store=None):
+    conn = sqlite3.connect(store or SOLR_QUERY_RECORDER_STORE, timeout=10)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS solr_query_fingerprints (fingerprint TEXT PRIMARY KEY, hits INTEGER NOT NULL, "
+        + "last_seen REAL NOT NULL, versions TEXT, payloads TEXT NOT NULL)"
+    )
+    return conn
+
+
+# Count one more request for a canonical fingerprint, along with the exact Solr payloads it issued
+#
+# fingerprint: stable hash of the canonical filter set and request shape
+# versions: the data version names the payloads were issued against, so stale entries can be skipped
+# payloads: list of query_solr keyword argument dicts
+def record_solr_query(fingerprint, versions, payloads):
+    global _pending_count
+    if not SOLR_QUERY_RECORDER:
+        return
+    try:
+        with _lock:
+            entry = _pending.get(fingerprint, None)
+            if entry is None:
+                entry = _pending[fingerprint] = {'hits': 0}
+            entry['hits'] += 1
+            entry['last_seen'] = time.time()
+            entry['versions'] = versions
+            entry['payloads'] = json.dumps(payloads, default=str)
+            _pending_count += 1
+            due = _pending_count >= SOLR_QUERY_RECORDER_FLUSH_COUNT or \
+                (time.time() - _last_flush) >= SOLR_QUERY_RECORDER_FLUSH_SECS
+        if due:
+            flush_solr_queries()
+    except Exception as e:
+        logger.error("[ERROR] While recording a Solr query fingerprint:")
+        logger.exception(e)
+
+
+def flush_solr_queries(store=None):
+    global _pending, _pending_count, _last_flush
+    with _lock:
+        pending = _pending
+        _pending = {}
+        _pending_count = 0
+        _last_flush = time.time()
+    if not pending:
+        return
+    try:
+        conn = _connect(store)
+        with conn:
+            for fingerprint, entry in pending.items():
+                conn.execute(
+                    "INSERT INTO solr_query_fingerprints (fingerprint, hits, last_seen, versions, payloads) "
+                    + "VALUES (?, ?, ?, ?, ?) ON CONFLICT(fingerprint) DO UPDATE SET hits = hits + excluded.hits, "
+                    + "last_seen = excluded.last_seen, versions = excluded.versions, payloads = excluded.payloads",
+                    (fingerprint, entry['hits'], entry['last_seen'], entry['versions'], entry['payloads'])
+                )
+            conn.execute(
+                "DELETE FROM solr_query_fingerprints WHERE fingerprint NOT IN (SELECT fingerprint FROM "
+                + "solr_query_fingerprints ORDER BY hits DESC, last_seen DESC LIMIT ?)",
+                (SOLR_QUERY_RECORDER_MAX_FINGERPRINTS,)
+            )
+        conn.close()
+        logger.debug("[STATUS] Flushed {} Solr query fingerprints to {}".format(
+            len(pending), store or SOLR_QUERY_RECORDER_STORE))
+    except Exception as e:
+        logger.error("[ERROR] While flushing Solr query fingerprints:")
+        logger.exception(e)
+
+
+# Fetch the most frequently seen fingerprints, hottest first, as a list of dicts with keys fingerprint, hits,
+# last_seen, versions, and payloads (the list of query_solr keyword argument dicts)
+def get_top_solr_queries(limit=50, store=None, versions=None, min_hits=1):
+    conn = _connect(store)
+    try:
+        query = "SELECT fingerprint, hits, last_seen, versions, payloads FROM solr_query_fingerprints WHERE hits >= ?"
+        params = [min_hits]
+        if versions is not None:
+            query += " AND versions = ?"
+            params.append(versions)
+        query += " ORDER BY hits DESC, last_seen DESC LIMIT ?"
+        params.append(limit)
+        return [{
+            'fingerprint': row[0],
+            'hits': row[1],
+            'last_seen': row[2],
+            'versions': row[3],
+            'payloads': json.loads(row[4])
+        } for row in conn.execute(query, params)]
+    finally:
+        conn.close()
+
+
+atexit.register(flush_solr_queries)
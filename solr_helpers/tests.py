@@ -14,8 +14,23 @@
 # limitations under the License.
 #
 
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import patch
+from urllib.parse import parse_qs
+
+import os
+import tempfile
 from django.test import TestCase
-from solr_helpers.__init__ import build_solr_query, build_solr_stats, build_solr_facets
+from solr_helpers import query_recorder
+from solr_helpers.query_recorder import record_solr_query, flush_solr_queries, get_top_solr_queries
+from solr_helpers.__init__ import build_solr_query, build_solr_stats, build_solr_facets, parse_solr_export_stream, \
+    adjacent_unique_sort, export_solr, stream_solr_export, stream_solr_cursor
+
+logger = logging.getLogger('main_logger')
 from idc_collections.collex_metadata_utils import fetch_data_source_attr
 from idc_collections.models import DataSetType, DataSource, ImagingDataCommonsVersion
 
@@ -94,3 +109,150 @@ class InitTest(TestCase):
     #def test_query_solr(self):
         #qs=query_solr(collection=None, fields=None, query_string=None, fqs=None, facets=None, sort=None, counts_only=True,
         #           collapse_on=None, offset=0, limit=1000, uniques=None, with_cursor=None, stats=None, totals=None)
+
+
+class ExportStreamTest(TestCase):
+
+    export_body = '{"responseHeader":{"status":0},"response":{"numFound":3,"docs":[' + \
+        '{"SeriesInstanceUID":"1.2,]"},\n{"SeriesInstanceUID":"1.3","Modality":["CT","SEG"]},{"SeriesInstanceUID":"\u00e9"}]}}'
+
+    def test_parse_solr_export_stream(self):
+        raw = self.export_body.encode('utf-8')
+        for chunk_size in [1, 7, len(raw)]:
+            header = {}
+            docs = list(parse_solr_export_stream([raw[i:i+chunk_size] for i in range(0, len(raw), chunk_size)], header))
+            self.assertEqual(header['numFound'], 3)
+            self.assertEqual([x['SeriesInstanceUID'] for x in docs], ["1.2,]", "1.3", "\u00e9"])
+
+    def test_parse_truncated_solr_export_stream(self):
+        with self.assertRaises(Exception):
+            list(parse_solr_export_stream([self.export_body[:120]]))
+
+
+def stand_in_docs(series, instances):
+    return [
+        {"collection_id": "c{}".format(i % 7), "SeriesInstanceUID": "1.{:06d}".format(i),
+         "SOPInstanceUID": "1.{:06d}.{}".format(i, j)}
+        for i in range(series) for j in range(instances)
+    ]
+
+
+# A stand-in Solr serving one collection of SERIES series of INSTANCES instances each, sorted by series, over
+# /schema/fields, /export (the whole collection, streamed) and /query (cursorMark pages, and {!collapse} counts)
+class StandInSolr(BaseHTTPRequestHandler):
+    SERIES = 2000
+    INSTANCES = 10
+    docs = stand_in_docs(SERIES, INSTANCES)
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        for i in range(0, len(body), 65536):
+            self.wfile.write(body[i:i+65536])
+
+    def do_GET(self):
+        self._send(json.dumps({"fields": [{"name": x, "docValues": True} for x in self.docs[0]]}).encode('utf-8'))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.path.endswith("/export"):
+            fl = parse_qs(body.decode('utf-8'))['fl'][0].split(",")
+            self._send(json.dumps({"responseHeader": {"status": 0}, "response": {
+                "numFound": len(self.docs), "docs": [{x: y[x] for x in fl} for y in self.docs]}}).encode('utf-8'))
+            return
+        payload = json.loads(body)
+        if len([x for x in payload.get('filter', []) if x.startswith("{!collapse")]):
+            self._send(json.dumps({"response": {"numFound": self.SERIES, "docs": []}}).encode('utf-8'))
+            return
+        start = int(payload['params'].get('cursorMark', "*").replace("*", "0"))
+        page = self.docs[start:start+payload['limit']]
+        self._send(json.dumps({"response": {"numFound": len(self.docs), "docs": [
+            {x: y[x] for x in payload['fields']} for y in page]}, "nextCursorMark": str(start+len(page))
+        }).encode('utf-8'))
+
+
+class ExportSolrTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = HTTPServer(("127.0.0.1", 0), StandInSolr)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.solr_uri = patch('{}.SOLR_URI'.format(export_solr.__module__),
+                             "http://127.0.0.1:{}/solr/".format(cls.server.server_port))
+        cls.solr_uri.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.solr_uri.stop()
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def test_adjacent_unique_sort(self):
+        self.assertEqual(adjacent_unique_sort(None, "SeriesInstanceUID"), "SeriesInstanceUID asc")
+        self.assertEqual(adjacent_unique_sort("collection_id asc, StudyInstanceUID desc", "SeriesInstanceUID"),
+                         "collection_id asc,StudyInstanceUID desc,SeriesInstanceUID asc")
+        self.assertEqual(adjacent_unique_sort("SeriesInstanceUID desc,Modality asc", "SeriesInstanceUID"),
+                         "SeriesInstanceUID desc,Modality asc")
+        self.assertIsNone(adjacent_unique_sort("Modality asc", "SeriesInstanceUID"))
+        self.assertIsNone(adjacent_unique_sort("SOPInstanceUID asc", "SeriesInstanceUID"))
+        self.assertIsNone(adjacent_unique_sort(None, "Modality"))
+
+    def test_export_solr_collapse(self):
+        for limit in [None, 25]:
+            result = export_solr("coll", ["SeriesInstanceUID"], limit=limit, unique_on="SeriesInstanceUID")
+            self.assertEqual(result['handler'], 'export')
+            self.assertEqual(result['numFound'], StandInSolr.SERIES)
+            uids = [x['SeriesInstanceUID'] for x in result['docs']]
+            self.assertEqual(len(uids), limit or StandInSolr.SERIES)
+            self.assertEqual(len(set(uids)), len(uids))
+
+    def test_export_solr_falls_back(self):
+        self.assertIsNone(export_solr("coll", ["SeriesInstanceUID"], offset=10, unique_on="SeriesInstanceUID"))
+        self.assertIsNone(export_solr("coll", ["SeriesInstanceUID"], sort="SOPInstanceUID asc",
+                                      unique_on="SeriesInstanceUID"))
+
+    # End-to-end comparison of the two streaming handlers against the stand-in; the rates land in the log
+    def test_export_and_cursor_throughput(self):
+        fields = ["SeriesInstanceUID", "SOPInstanceUID"]
+        extracted = {}
+        for handler, streamer in [('export', stream_solr_export), ('cursor', stream_solr_cursor)]:
+            start = time.time()
+            extracted[handler] = list(streamer("coll", fields, sort="SOPInstanceUID asc"))
+            elapsed = time.time() - start
+            logger.info("[BENCHMARKING] Stand-in Solr {}: {} docs in {}s ({} docs/s)".format(
+                handler, len(extracted[handler]), str(elapsed), str(round(len(extracted[handler])/elapsed, 1))))
+        self.assertEqual(len(extracted['export']), len(StandInSolr.docs))
+        self.assertEqual(extracted['export'], extracted['cursor'])
+
+
+class QueryRecorderTest(TestCase):
+
+    def setUp(self):
+        self.store = os.path.join(tempfile.mkdtemp(), "fingerprints.sqlite3")
+        flush_solr_queries(self.store)
+
+    def test_dedupe_and_cap(self):
+        payloads = [{'collection': 'coll', 'fqs': ['{!tag=f0}Modality:("CT")'], 'facets': {}}]
+        with patch('solr_helpers.query_recorder.SOLR_QUERY_RECORDER', True), \
+                patch('solr_helpers.query_recorder.SOLR_QUERY_RECORDER_FLUSH_COUNT', 2), \
+                patch('solr_helpers.query_recorder.SOLR_QUERY_RECORDER_STORE', self.store), \
+                patch('solr_helpers.query_recorder.SOLR_QUERY_RECORDER_MAX_FINGERPRINTS', 2):
+            # Repeats of a fingerprint are counted against one entry, both before and across flushes
+            for i in range(3):
+                record_solr_query("hot", "v1", payloads)
+            record_solr_query("warm", "v1", payloads)
+            record_solr_query("warm", "v1", payloads)
+            record_solr_query("cold", "v1", payloads)
+            flush_solr_queries()
+            fingerprints = get_top_solr_queries(store=self.store)
+            # Only the SOLR_QUERY_RECORDER_MAX_FINGERPRINTS most frequently seen are kept
+            self.assertEqual([(x['fingerprint'], x['hits']) for x in fingerprints], [("hot", 3), ("warm", 2)])
+            self.assertEqual(fingerprints[0]['payloads'], payloads)
+            self.assertEqual(get_top_solr_queries(store=self.store, min_hits=3)[0]['fingerprint'], "hot")
+        self.assertEqual(query_recorder._pending, {})